@@ -0,0 +1,35 @@
+from helpers.startup import report_startup
+import asyncio
+import os
+from helpers import instrument
+from helpers.options import make_parser, parse_options
+from helpers.service import REQUEST_DEFAULTS, Service
+
+parser = make_parser("Local service answering closed-loop simulation requests (the loop of script 4)")
+parser.add_argument('--socket', default=None, help='listen on this Unix socket instead of a TCP port')
+parser.add_argument('--host', default='127.0.0.1', help='TCP address')
+parser.add_argument('--port', type=int, default=8765, help='TCP port')
+parser.add_argument('--workers', type=int, default=os.cpu_count(), help='simulation worker processes')
+parser.add_argument('--batch-window', type=float, default=5,
+                    help='milliseconds a request waits for requests of the same loop to share its simulation')
+parser.add_argument('--max-batch', type=int, default=256, help='scenarios that dispatch a batch right away')
+options = parse_options(parser=parser)
+
+service = Service(workers=options.workers, batch_window=options.batch_window / 1000, max_batch=options.max_batch)
+
+# Warm start: the default plant and its gains are designed before the first request
+service.design(REQUEST_DEFAULTS)
+
+if options.timings:
+  report_startup()
+
+address = options.socket or f"{options.host}:{options.port}"
+instrument.section("Listening on", f"{address} ({options.workers} workers, "
+                   f"{options.batch_window:g} ms batch window)", newline=False)
+try:
+  asyncio.run(service.serve(options.socket, options.host, options.port))
+except KeyboardInterrupt:
+  pass
+finally:
+  service.close()
+  instrument.section("Served:", service.stats())
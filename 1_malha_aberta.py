@@ -1,83 +1,95 @@
+from helpers.startup import report_startup
 import numpy as np
-import matplotlib.pyplot as plt
+from helpers.integrator import STEP_MATMULS, make_step, prepare, solve_adaptive, report_speedup
+from helpers import instrument, plotting
+from helpers.options import make_parser, parse_options
+from helpers.analytic import AnalyticResponse
+from helpers.plant import Plant
+from helpers.recorder import Recorder
 
-WATER_DENSITY = 1000
-MERCURY_DENSITY = 13546
+parser = make_parser("Open-loop simulation of the mass-tank system", tf=50)
+parser.add_argument('--analytic', action='store_true',
+                    help='also evaluate x(tf) and the steady state in closed form, without stepping')
+options = parse_options(parser=parser)
 
-# Tank
-fluid_density = MERCURY_DENSITY # kg/m^3
-gravity = 9.81                  # m/s^2
-tank_area = 0.05                # m^2 (0.005 is a 7cm x 7cm square tank)
+plant = Plant()
+print(plant.eigenvalues)
 
-# Pipe
-fluid_density = MERCURY_DENSITY  # kg/m^3
-pipe_length = 10                # m
-pipe_section_area = 0.00125664 # m^2
+A, B = plant.A, plant.B
+C = plant.C() # We only observe z´, which is x (car position)
+D = plant.D
 
-# Mechanical system
-mass = 5               # kg
-spring_constant = 500   # N/m
-damping_constant = 40  # Ns/m
+# Simulation parameters
+t0, tf = 0, options.tf
 
-# Coupling system
-piston_area = pipe_section_area
+# Start conditions
+u0, x0 = np.array([0]), np.array([[2], [0], [plant.pressure_scale*1]]) # Move car 3 meters, fill tank to 1 m
 
-# ------------------- 14715
+def simulate(integrator, dt):
+ t, u, x = t0, u0, x0
 
-# Ax´´ + Bx´+ Cx - P1 = 0
-# P1´ = Dx´+ EJ
-_A = (mass / piston_area) + (fluid_density*pipe_length*piston_area / pipe_section_area)
-_B = damping_constant / piston_area
-_C = spring_constant / piston_area
-_D = piston_area*fluid_density*gravity / tank_area
-_E = fluid_density*gravity / tank_area
+ if integrator == 'rk45':
+  # Adaptive Dormand-Prince on x' = Ax (no flow), sampled at uniform times
+  T, X, stats = solve_adaptive(lambda t, x: A@x, x, t0, tf, dt, options.rtol, options.atol)
+  return Recorder.from_arrays(T, X=X, U=np.zeros_like(T))
 
-A = np.array([
-    [ 0,       1,       0  ],
-    [ -_C/_A,  -_B/_A,  1/_A ],
-    [ 0,       _D,     0  ]
-])
+ # Initialize preallocated buffers to store results
+ num_steps = int((tf-t)/dt)
+ recorder = Recorder(t, num_steps, X=x, U=u)
 
-print(np.linalg.eigvals(A))
+ # Euler integration or exact zero-order-hold discretization
+ step = make_step(A, B, dt, integrator)
 
-B = np.array([[0], [0], [_E]]) # Command gain = E
-C = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]) # We only observe z´, which is x (car position)
-D = np.array([[0]])
+ counter = 0
+ for i in range(num_steps):
+  #u = [[.000001*counter]]
+  u = [[0]]
+  t, x = t + dt, step(x, u)
+  recorder.record(t, X=x, U=u)
 
-# Simulation parameters
-t, tf, dt = 0, 50, .001 
+  counter += 1
 
-# Start conditions
-u, x = np.array([0]), np.array([[2], [0], [gravity*fluid_density*1]]) # Move car 3 meters, fill tank to 1 m
+ instrument.count('steps', num_steps)
+ instrument.count('matmuls', num_steps * (STEP_MATMULS[integrator]))
+ return recorder
+
+if options.timings:
+ report_startup()
 
-# Initialize arrays to store results
-X, U, T = x, u, t
+# Discretization and imports are done before the timer, so the speedup compares stepping only
+setup = prepare(options.integrator, A, B, options.dt)
 
-# Euler integration
-dx = lambda x, u, dt: (np.dot(A,x)+np.dot(B,[u]))*dt
+with instrument.timer('simulation') as timing:
+ recorder = simulate(options.integrator, options.dt)
+elapsed = timing.elapsed
 
-counter = 0
-for i in range(int((tf-t)/dt)):
- #u = [.000001*counter]
- u = [0]
- t, x = t + dt, x + dx(x,u,dt)
- X = np.append(X,x,axis=1)
- U = np.append(U,u)
- T = np.append(T,t)
+if options.integrator != 'euler':
+ report_speedup(lambda integrator, dt: simulate(integrator, dt)['X'][:, -1], elapsed, recorder['X'][:, -1], setup)
 
- counter += 1
+X, U, T = recorder['X'], recorder['U'][0], recorder.T
 
 output = np.dot(C,X)
 mass_position = output[0]
 mass_speed = output[1]
-tank_height = output[2] / (gravity*fluid_density)
-print(mass_position[-1], mass_speed[-1], tank_height[-1])
-
-plt.plot(T,mass_position,'k', label='Posição da massa (m)')
-plt.plot(T,mass_speed,'r', label='Velocidade da massa (m/s)')
-plt.plot(T,tank_height,'b', label='Altura da água no tanque (m)')
-plt.legend()
-plt.xlabel('Tempo (s)')
-plt.ylabel('Posição mass | altura água (m)')
-plt.grid(True)
-plt.show()
\ No newline at end of file
+tank_height = output[2] / plant.pressure_scale
+instrument.section("Final x values:", color=instrument.RESULT)
+instrument.note(mass_position[-1], mass_speed[-1], tank_height[-1])
+
+if options.analytic:
+ response = AnalyticResponse(A, None, x0)
+ response.report(T[-1], X[:, -1])
+
+if plotting.enabled():
+ plt = plotting.pyplot()
+
+ plt.plot(*plotting.downsample(T, mass_position),'k', label='Posição da massa (m)')
+ plt.plot(*plotting.downsample(T, mass_speed),'r', label='Velocidade da massa (m/s)')
+ plt.plot(*plotting.downsample(T, tank_height),'b', label='Altura da água no tanque (m)')
+ plt.legend()
+ plt.xlabel('Tempo (s)')
+ plt.ylabel('Posição mass | altura água (m)')
+ plt.grid(True)
+ plotting.show('1_malha_aberta')
+
+if options.timings:
+ report_startup('Total run time')
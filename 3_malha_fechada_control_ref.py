@@ -1,101 +1,131 @@
+from helpers.startup import report_startup
 import numpy as np
-import matplotlib.pyplot as plt
-from helpers.control import calculate_K
-from helpers.reference import calculate_N
-
-WATER_DENSITY = 1000
-MERCURY_DENSITY = 13546
-
-# Tank
-fluid_density = MERCURY_DENSITY # kg/m^3
-gravity = 9.81                  # m/s^2
-tank_area = 0.05                # m^2 (0.005 is a 7cm x 7cm square tank)
-
-# Pipe
-fluid_density = MERCURY_DENSITY  # kg/m^3
-pipe_length = 10                # m
-pipe_section_area = 0.00125664 # m^2
-
-# Mechanical system
-mass = 5               # kg
-spring_constant = 500   # N/m
-damping_constant = 40  # Ns/m
-
-# Coupling system
-piston_area = pipe_section_area
-
-# -------------------
-
-# Ax´´ + Bx´+ Cx - P1 = 0
-# P1´ = Dx´+ EJ
-_A = (mass / piston_area) + (fluid_density*pipe_length*piston_area / pipe_section_area)
-_B = damping_constant / piston_area
-_C = spring_constant / piston_area
-_D = piston_area*fluid_density*gravity / tank_area
-_E = fluid_density*gravity / tank_area
-
-A = np.array([
-    [ 0,       1,       0  ],
-    [ -_C/_A,  -_B/_A,  1/_A ],
-    [ 0,       _D,     0  ]
-])
-B = np.array([[0], [0], [_E]]) # Command gain = E
-C = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]) # We observe all states: mass position, mass speed, and tank pressure
-D = np.array([[0]])
+from helpers.integrator import STEP_MATMULS, make_feedback_step, prepare, solve_adaptive, report_speedup
+from helpers import instrument, plotting
+from helpers.multirate import discrete_gains, report, simulate_multirate
+from helpers.options import add_multirate_options, make_parser, parse_options
+from helpers.analytic import AnalyticResponse
+from helpers.recorder import Recorder
+from helpers.plant import Plant
+
+parser = make_parser("Closed-loop simulation with state feedback and reference tracking", tf=50)
+parser.add_argument('--analytic', action='store_true',
+                    help='also evaluate x(tf) and the steady state in closed form, without stepping')
+add_multirate_options(parser)
+options = parse_options(parser=parser)
+if options.control_period and options.integrator == 'rk45':
+ parser.error("--control-period needs a fixed-step integrator (euler or zoh)")
+
+plant = Plant()
+
+A, B = plant.A, plant.B
+C = plant.C() # We observe all states: mass position, mass speed, and tank pressure
+D = plant.D
 
 # --------------------
 
-K = calculate_K(A, B, poles_gain=10, plot=False)
+K = plant.K(poles_gain=10)
 
 # --------------------
 
-N = calculate_N(A, B, C[:1], D, K, A.shape[1], B.shape[1])
+N = plant.N(poles_gain=10, outputs=(0,))
+
+if options.control_period:
+ # Sampled controller: K and N redesigned for its period
+ discrete = discrete_gains(A, B, C[:1], D, options.control_period, controller_poles_gain=10)
 
 # --------------------
 
 # Simulation parameters
-t, tf, dt = 0, 50, .001 
+t0, tf = 0, options.tf
 
 # Start conditions. We assume there is someone only pulling/pushing the spring.
 # The tank height should reflect that mass position: it depends on.
 initial_mass_position = 2
-initial_tank_height = (spring_constant*initial_mass_position) / (fluid_density*gravity*piston_area)
+initial_tank_height = plant.rest_tank_height(initial_mass_position)
 
 # Set start conditions
-u = np.array([1]) # No water flow at the beginning
-x = np.array([[initial_mass_position], [0], [gravity*fluid_density*initial_tank_height]]) # Move car 3 meters, fill tank to 1 m
+u0 = np.array([1]) # No water flow at the beginning
+x0 = np.array([[initial_mass_position], [0], [plant.pressure_scale*initial_tank_height]]) # Move car 3 meters, fill tank to 1 m
 r = np.array([[5]]) # Set 5 meters to be mass position reference
 
-# Initialize arrays to store results
-X, U, T = x, u, t
+def simulate(integrator, dt):
+ t, u, x = t0, u0, x0
+
+ if options.control_period:
+  # Only the plant runs every dt; the controller updates every control period and u is held in between
+  return simulate_multirate(A, B, x, t0, tf, dt, options.control_period, discrete['K'], N=discrete['N'], r=r,
+                            sample_period=options.sample_period, u0=u, integrator=integrator)
+
+ if integrator == 'rk45':
+  # Adaptive Dormand-Prince on the closed loop x' = Ax + B(Nr - Kx), sampled at uniform times
+  Nr = (N@r)[:, 0]
+  T, X, stats = solve_adaptive(lambda t, x: A@x + B@(Nr - K@x), x, t0, tf, dt, options.rtol, options.atol)
+  return Recorder.from_arrays(T, X=X, U=Nr[:, None] - K@X)
+
+ # Initialize preallocated buffers to store results
+ num_steps = int((tf-t)/dt)
+ recorder = Recorder(t, num_steps, X=x, U=u)
+
+ # Euler integration or exact zero-order-hold discretization of the closed loop
+ step = make_feedback_step(A, B, K, dt, integrator)
+ Nr = N@r
+
+ counter = 0
+ for i in range(num_steps):
+  u = Nr - K@x
+  #print(u)
+  #u = [0]
+  t, x = t + dt, step(x, u, Nr)
+  recorder.record(t, X=x, U=u)
+
+  counter += 1
+
+ instrument.count('steps', num_steps)
+ instrument.count('matmuls', num_steps * (STEP_MATMULS[integrator] + 1)) # K@x
+ return recorder
+
+if options.timings:
+ report_startup()
+
+# Discretization and imports are done before the timer, so the speedup compares stepping only
+setup = prepare(options.integrator, A, B, options.dt, K=K)
+
+with instrument.timer('simulation') as timing:
+ recorder = simulate(options.integrator, options.dt)
+elapsed = timing.elapsed
 
-# Euler integration
-dx = lambda x, u, dt: (np.dot(A,x)+np.dot(B,u))*dt
+if options.control_period:
+ report(options.control_period, options.sample_period, options.dt)
 
-counter = 0
-for i in range(int((tf-t)/dt)):
- u = N@r - K@x
- #print(u)
- #u = [0]
- t, x = t + dt, x + dx(x,u,dt)
- X = np.append(X,x,axis=1)
- U = np.append(U,u)
- T = np.append(T,t)
+if options.integrator != 'euler':
+ report_speedup(lambda integrator, dt: simulate(integrator, dt)['X'][:, -1], elapsed, recorder['X'][:, -1], setup)
 
- counter += 1
+X, U, T = recorder['X'], recorder['U'][0], recorder.T
 
 output = np.dot(C,X)
 mass_position = output[0]
 mass_speed = output[1]
-tank_height = output[2] / (gravity*fluid_density)
-print(mass_position[-1], mass_speed[-1], tank_height[-1])
-
-plt.plot(T,mass_position,'k', label='Posição da massa (m)')
-plt.plot(T,mass_speed,'r', label='Velocidade da massa (m/s)')
-plt.plot(T,tank_height,'b', label='Altura da água no tanque (m)')
-plt.plot(T,U,'y', label='Vazão (m^3/s)')
-plt.legend()
-plt.xlabel('Tempo (s)')
-plt.ylabel('Posição mass | altura água (m)')
-plt.grid(True)
-plt.show()
\ No newline at end of file
+tank_height = output[2] / plant.pressure_scale
+instrument.section("Final x values:", color=instrument.RESULT)
+instrument.note(mass_position[-1], mass_speed[-1], tank_height[-1])
+
+if options.analytic:
+ response = AnalyticResponse(A - B@np.atleast_2d(K), B@N, x0, r)
+ response.report(T[-1], X[:, -1])
+
+if plotting.enabled():
+ plt = plotting.pyplot()
+
+ plt.plot(*plotting.downsample(T, mass_position),'k', label='Posição da massa (m)')
+ plt.plot(*plotting.downsample(T, mass_speed),'r', label='Velocidade da massa (m/s)')
+ plt.plot(*plotting.downsample(T, tank_height),'b', label='Altura da água no tanque (m)')
+ plt.plot(*plotting.downsample(T, U),'y', label='Vazão (m^3/s)')
+ plt.legend()
+ plt.xlabel('Tempo (s)')
+ plt.ylabel('Posição mass | altura água (m)')
+ plt.grid(True)
+ plotting.show('3_malha_fechada_control_ref')
+
+if options.timings:
+ report_startup('Total run time')
@@ -1,135 +1,295 @@
+from helpers.startup import report_startup
+import os
 import numpy as np
-import matplotlib.pyplot as plt
-from tqdm import trange
-from helpers.conditions import check_controllability, check_observability
-from helpers.control import calculate_K
-from helpers.reference import calculate_N
-from helpers.estimator import calculate_L
-
-WATER_DENSITY = 1000
-MERCURY_DENSITY = 13546
-
-# Tank
-fluid_density = MERCURY_DENSITY # kg/m^3
-gravity = 9.81                  # m/s^2
-tank_area = 0.05                # m^2 (0.005 is a 7cm x 7cm square tank)
-
-# Pipe
-fluid_density = MERCURY_DENSITY  # kg/m^3
-pipe_length = 10                # m
-pipe_section_area = 0.00125664 # m^2
-
-# Mechanical system
-mass = 5               # kg
-spring_constant = 500   # N/m
-damping_constant = 40  # Ns/m
-
-# Coupling system
-piston_area = pipe_section_area
-
-# -------------------
-
-# Ax´´ + Bx´+ Cx - P1 = 0
-# P1´ = Dx´+ EJ
-_A = (mass / piston_area) + (fluid_density*pipe_length*piston_area / pipe_section_area)
-_B = damping_constant / piston_area
-_C = spring_constant / piston_area
-_D = piston_area*fluid_density*gravity / tank_area
-_E = fluid_density*gravity / tank_area
-
-A = np.array([
-    [ 0,       1,       0  ],
-    [ -_C/_A,  -_B/_A,  1/_A ],
-    [ 0,       _D,     0  ]
-])
-B = np.array([[0], [0], [_E]]) # Command gain = E
-C = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]) # We can observe all states: mass position, mass speed, and tank pressure
-D = np.array([[0]])
+from helpers.analytic import AnalyticResponse
+from helpers.augmented import AugmentedLoop, closed_loop_system
+from helpers.integrator import make_step, prepare, solve_adaptive, report_speedup
+from helpers import instrument, plotting
+from helpers.estimator import KalmanSchedule
+from helpers.checkpoint import Checkpointer, load_checkpoint, signature
+from helpers.multirate import discrete_gains, report, simulate_multirate
+from helpers.options import add_multirate_options, make_parser, parse_options
+from helpers.plant import Plant
+from helpers.recorder import Recorder
+from helpers.stream import Chunk, stream, mass_tank_outputs, write_npy
+
+parser = make_parser("Closed-loop simulation with reference tracking and state estimation", tf=15)
+parser.add_argument('--stream-to', default=None,
+                    help='stream the trajectory to memory-mapped .npy files in this directory (constant memory)')
+parser.add_argument('--chunk-size', type=int, default=10000, help='samples per simulation chunk')
+parser.add_argument('--checkpoint-every', type=int, default=None, metavar='STEPS',
+                    help='with --stream-to, checkpoint the simulation state every STEPS steps')
+parser.add_argument('--checkpoint-seconds', type=float, default=None, metavar='SECONDS',
+                    help='with --stream-to, checkpoint the simulation state every SECONDS of wall time')
+parser.add_argument('--resume', action='store_true',
+                    help='continue the --stream-to run from its last checkpoint (bit-identical to an uninterrupted run)')
+parser.add_argument('--realtime', action='store_true',
+                    help='also run the loop through the allocation-free real-time controller and report its latency')
+parser.add_argument('--fused', action='store_true',
+                    help='propagate plant, observer and reference as one augmented matrix (one product per step)')
+parser.add_argument('--analytic', action='store_true',
+                    help='also evaluate x(tf) and the steady state in closed form, without stepping')
+parser.add_argument('--estimator', choices=('luenberger', 'kalman'), default='luenberger',
+                    help="observer gain: 'luenberger' (placed poles) or 'kalman' (steady-state gain for the noise levels)")
+parser.add_argument('--kalman-time-varying', action='store_true',
+                    help='with --estimator kalman, propagate the covariance from P0 = I until the gain converges, '
+                         'then switch to the steady-state gain')
+parser.add_argument('--kalman-tolerance', type=float, default=1e-2,
+                    help='relative distance to the steady-state gain at which --kalman-time-varying switches to it')
+parser.add_argument('--process-noise', type=float, default=0,
+                    help='standard deviation of a flow disturbance added to the plant input (m^3/s)')
+parser.add_argument('--measurement-noise', type=float, default=0,
+                    help='standard deviation of the noise of the position measurement (m)')
+parser.add_argument('--noise-seed', type=int, default=0, help='seed of the simulated noises')
+add_multirate_options(parser)
+options = parse_options(parser=parser)
+if options.integrator == 'rk45' and (options.stream_to or options.realtime or options.fused):
+    parser.error("--stream-to, --realtime and --fused need a fixed-step integrator (euler or zoh)")
+if options.fused and options.stream_to:
+    parser.error("--fused cannot be combined with --stream-to")
+if options.control_period and (options.integrator == 'rk45' or options.stream_to or options.realtime or options.fused):
+    parser.error("--control-period needs a fixed-step integrator and cannot be combined with --stream-to, "
+                 "--realtime or --fused")
+noisy = options.process_noise > 0 or options.measurement_noise > 0
+if options.estimator == 'kalman' and not (options.process_noise > 0 and options.measurement_noise > 0):
+    parser.error("--estimator kalman needs --process-noise and --measurement-noise above zero")
+if options.kalman_time_varying and options.estimator != 'kalman':
+    parser.error("--kalman-time-varying needs --estimator kalman")
+if (noisy or options.kalman_time_varying) and (options.integrator == 'rk45' or options.fused or options.control_period):
+    parser.error("noise and --kalman-time-varying need a fixed-step integrator, without --fused or --control-period")
+if (noisy or options.kalman_time_varying) and (options.checkpoint_every or options.checkpoint_seconds or options.resume):
+    parser.error("noise and --kalman-time-varying cannot be combined with checkpoints")
+if (options.checkpoint_every or options.checkpoint_seconds or options.resume) and not options.stream_to:
+    parser.error("--checkpoint-every, --checkpoint-seconds and --resume need --stream-to")
+
+plant = Plant()
+
+A, B = plant.A, plant.B
+C = plant.C() # We can observe all states: mass position, mass speed, and tank pressure
+D = plant.D
 
 # --------------------
 
-controllable = check_controllability(A, B)
-observable = check_observability(A, C)
-print("\033[95mControllable:\033[0m", controllable)
-print("\033[95mObservable:\033[0m", observable)
+controllable = plant.controllable
+observable = plant.observable()
+instrument.section("Controllable:", controllable, newline=False)
+instrument.section("Observable:", observable, newline=False)
 
 # --------------------
 
-K = calculate_K(A, B, poles_gain=10, plot=True)
+K = plant.K(poles_gain=10, plot=True)
 
 # --------------------
 
-N = calculate_N(A, B, C[:1], D, K, A.shape[1], B.shape[1])
+N = plant.N(poles_gain=10, outputs=(0,))
 
 # --------------------
 
-L = calculate_L(A, C[:1], poles_gain=20, plot=True)
+if options.estimator == 'kalman':
+    # Optimal gain for the noise levels, from the discrete Riccati equation solved once
+    L = plant.kalman_L(options.process_noise, options.measurement_noise, options.dt, options.integrator)
+else:
+    L = plant.L(poles_gain=20, outputs=(0,), plot=True)
+
+if options.control_period:
+    # Sampled controller and observer: K, N and L redesigned for their period
+    discrete = discrete_gains(A, B, C[:1], D, options.control_period, controller_poles_gain=10, observer_poles_gain=20)
 
 # --------------------
 
 # Simulation parameters
-t, tf, dt = 0, 15, .001 
+t0, tf = 0, options.tf
 
 # Start conditions. We assume there is someone only pulling/pushing the spring.
 # The tank height should reflect that mass position
 # We get the initial tank height from: P = g*p*h, being P = f/A = k*x/A
 initial_mass_position = 2
-initial_tank_height = (spring_constant*initial_mass_position) / (fluid_density*gravity*piston_area)
+initial_tank_height = plant.rest_tank_height(initial_mass_position)
 
 # Set start conditions
-u = np.array([0]) # No water flow at the beginning
-x = np.array([[initial_mass_position], [-2], [initial_tank_height]])
-x_est = np.array([[initial_mass_position], [0], [0]])
+u0 = np.array([0]) # No water flow at the beginning
+x0 = np.array([[initial_mass_position], [-2], [initial_tank_height]])
+x_est0 = np.array([[initial_mass_position], [0], [0]])
 r = np.array([[5]]) # Set 3 meters to be mass position reference
 
-# Initialize arrays to store results
-X, U, T, X_est = x, u, t, x_est
+def simulate(integrator, dt, desc="Simulating", fused=False):
+    t, u, x, x_est = t0, u0, x0, x_est0
+
+    if fused:
+        # Plant + observer + reference as one augmented linear map: one matrix product per step
+        loop = AugmentedLoop(A, B, C[:1], K, N, L, dt, integrator)
+        num_steps = int((tf-t)/dt)
+        Z = loop.trajectory(loop.augment(x, x_est, r), num_steps)
+        X, X_est = loop.split(Z)
+        # The input recorded with each sample is the one applied during the step leading to it
+        U = np.hstack((np.reshape(u, (-1, 1)), loop.inputs(Z[:, :-1])))
+        return Recorder.from_arrays(t + dt*np.arange(num_steps + 1), X=X, U=U, X_est=X_est)
+
+    if options.control_period:
+        # Only the plant runs every dt; controller and observer update every control period, u is held in between
+        return simulate_multirate(A, B, x, t0, tf, dt, options.control_period, discrete['K'], N=discrete['N'], r=r,
+                                  C=C[:1], L=discrete['L'], x_est0=x_est, sample_period=options.sample_period,
+                                  u0=u, integrator=integrator)
+
+    if integrator == 'rk45':
+        # Adaptive Dormand-Prince on the plant + observer system z = [x; x_est], sampled at uniform times
+        n, Nr, C1 = A.shape[0], (N@r)[:, 0], C[:1]
+
+        def closed_loop(t, z):
+            x, x_est = z[:n], z[n:]
+            u = Nr - K@x_est
+            return np.concatenate((A@x + B@u, A@x_est + B@u + L@(C1@x - C1@x_est)))
 
-# Euler integration
-dx = lambda x, u, dt: (np.dot(A,x)+np.dot(B,u))*dt
-dx_est = lambda x_est, y, y_est, u, dt: (np.dot(A,x_est)+np.dot(B,u)+L@(y-y_est))*dt
+        T, Z, stats = solve_adaptive(closed_loop, np.vstack((x, x_est)), t0, tf, dt, options.rtol, options.atol)
+        return Recorder.from_arrays(T, X=Z[:n], U=Nr[:, None] - K@Z[n:], X_est=Z[n:])
 
-num_steps = int((tf-t)/dt)
-for i in trange(num_steps, desc="Simulating"):
-    # Calculate control from x_est and reference
-    u = N@r - K@x_est
+    # Initialize preallocated buffers to store results
+    num_steps = int((tf-t)/dt)
+    recorder = Recorder(t, num_steps, X=x, U=u, X_est=x_est)
 
+    for chunk in simulation_chunks(integrator, dt, desc, include_initial=False):
+        recorder.extend(chunk.T, X=chunk.X, U=chunk.U, X_est=chunk.X_est)
+
+    return recorder
+
+# Time-varying Kalman gains of every simulation, to report their convergence
+schedules = []
+
+def simulation_chunks(integrator, dt, desc="Simulating", include_initial=True, checkpoint=None, resume=None):
+    from tqdm import tqdm
+
+    # Euler integration or exact zero-order-hold discretization, produced in fixed-size chunks.
     # We use C[:1] since we observe only the first state (mass position)
-    y, y_est = C[:1]@x, C[:1]@x_est
-
-    # Integrate the system and the estimator by euler method
-    t, x = t + dt, x + dx(x,u,dt)
-    x_est = x_est + dx_est(x_est, y, y_est, u,dt)
-
-    X = np.append(X,x,axis=1)
-    X_est = np.append(X_est,x_est,axis=1)
-    U = np.append(U,u)
-    T = np.append(T,t)
-
-output = np.dot(C,X)
-mass_position = output[0]
-mass_speed = output[1]
-tank_height = output[2] / (gravity*fluid_density)
-print("\n\033[96mFinal x values:\033[0m")
-print(mass_position[-1], mass_speed[-1], tank_height[-1])
-
-est_output = np.dot(C,X_est)
-mass_position_est = est_output[0]
-mass_speed_est = est_output[1]
-tank_height_est = est_output[2] / (gravity*fluid_density)
-print("\n\033[96mFinal x_estimated values:\033[0m")
-print(mass_position_est[-1], mass_speed_est[-1], tank_height_est[-1])
-
-plt.plot(T, mass_position, color='black', label='Mass position (m)')
-plt.plot(T, mass_position_est, color='green', label='Estimated mass position (m)')
-plt.plot(T, mass_speed, color='red', label='Mass speed (m/s)')
-plt.plot(T, mass_speed_est, color='magenta', label='Estimated mass speed (m/s)')
-plt.plot(T, tank_height, color='blue', label='Tank water height (m)')
-plt.plot(T, U, 'y', label='Flow rate (m^3/s)')
-plt.axhline(y=r[0,0], color='gray', linestyle='--', label=f'Mass reference position ({r[0,0]} m)')
-plt.title('Closed-loop control with state estimation')
-plt.ylabel('Control variables in SI units')
-plt.xlabel('Time (s)')
-plt.legend()
-plt.grid(True)
-plt.show()
\ No newline at end of file
+    schedule = None
+    if options.kalman_time_varying:
+        schedule = KalmanSchedule(A, B, C[:1], options.process_noise**2, options.measurement_noise**2, dt, integrator,
+                                  tolerance=options.kalman_tolerance)
+        schedules.append(schedule)
+    chunks = stream(A, B, x0, t0, tf, dt, u0=u0, K=K, N=N, r=r, C=C[:1], L=L, x_est0=x_est0,
+                    integrator=integrator, chunk_size=options.chunk_size, include_initial=include_initial,
+                    checkpoint=checkpoint, resume=resume, gain_schedule=schedule, process_noise=options.process_noise,
+                    measurement_noise=options.measurement_noise, seed=options.noise_seed)
+    with tqdm(total=int((tf-t0)/dt), initial=0 if resume is None else int(resume['step']), desc=desc) as progress:
+        for chunk in chunks:
+            yield chunk
+            progress.update(chunk.T.shape[0] - (include_initial and progress.n == 0))
+
+if options.timings:
+    report_startup()
+
+outputs = mass_tank_outputs(C, plant.pressure_scale)
+
+# Discretization and imports are done before the timer, so the speedup compares stepping only
+setup = prepare(options.integrator, A, B, options.dt, C[:1], L, K)
+
+with instrument.timer('simulation') as timing:
+    if options.stream_to:
+        # Outputs are computed per chunk and everything is written to disk, so memory stays constant
+        num_samples = int((tf-t0)/options.dt) + 1
+        checkpoint_path = os.path.join(options.stream_to, 'checkpoint.npz')
+        run_signature = signature(A=A, B=B, C=C[:1], K=K, N=N, L=L, r=r, x0=x0, x_est0=x_est0, u0=u0, t0=t0, tf=tf,
+                                  dt=options.dt, integrator=options.integrator)
+        resume = None
+        if options.resume:
+            if not os.path.exists(checkpoint_path):
+                parser.error(f"no checkpoint to resume in {options.stream_to}")
+            try:
+                resume = load_checkpoint(checkpoint_path, run_signature)
+            except ValueError as error:
+                parser.error(str(error))
+            instrument.section("Resuming from step", resume['step'], color=instrument.WARNING, newline=False)
+        checkpoint = None
+        if options.checkpoint_every or options.checkpoint_seconds:
+            checkpoint = Checkpointer(checkpoint_path, options.checkpoint_every, options.checkpoint_seconds,
+                                      signature=run_signature)
+
+        chunks = simulation_chunks(options.integrator, options.dt, checkpoint=checkpoint, resume=resume)
+        derived = write_npy(chunks, options.stream_to, num_samples, outputs,
+                            start=0 if resume is None else int(resume['samples']))
+        T, U = derived['T'], derived['U'][0]
+        # The run is complete: its checkpoint must not be resumed again
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    else:
+        recorder = simulate(options.integrator, options.dt, fused=options.fused)
+        T, U = recorder.T, recorder['U'][0]
+        derived = outputs(Chunk(T, recorder['X'], recorder['U'], recorder['X_est']))
+elapsed = timing.elapsed
+
+if options.control_period:
+    report(options.control_period, options.sample_period, options.dt)
+
+if schedules:
+    steps = schedules[0].converged_at
+    if steps is None:
+        instrument.section("Kalman gain:", "still time-varying at the end of the run (the covariance had not "
+                           "converged)", newline=False)
+    else:
+        instrument.section("Kalman gain converged after", f"{steps} steps ({steps*options.dt:g} s), "
+                           "then the steady-state gain was used", newline=False)
+
+if options.stream_to:
+    instrument.section("Trajectory written to:", options.stream_to, color=instrument.RESULT)
+
+if options.fused:
+    # Check against a jump straight to tf, with the step matrix raised to num_steps by repeated squaring
+    loop = AugmentedLoop(A, B, C[:1], K, N, L, options.dt, options.integrator)
+    x_jump, _ = loop.split(loop.jump(loop.augment(x0, x_est0, r), int((tf-t0)/options.dt)))
+    instrument.section("Jump to tf by repeated squaring:")
+    instrument.note("x_jump - x at tf:", x_jump - recorder['X'][:, -1])
+
+if options.integrator != 'euler' or options.fused:
+    report_speedup(lambda integrator, dt: simulate(integrator, dt, desc="Euler baseline")['X'][:, -1],
+                   elapsed, recorder['X'][:, -1] if not options.stream_to else derived['X'][:, -1], setup)
+
+if options.realtime:
+    from helpers.realtime import RealtimeController
+
+    # Hardware-in-the-loop emulation: the simulated plant stands in for the rig, sampled at every period
+    controller = RealtimeController(A, B, C[:1], K, N, L, x_est0, options.dt, options.integrator)
+    plant_step = make_step(A, B, options.dt, options.integrator)
+    x, u, y = x0[:, 0].astype(float), np.empty(B.shape[1]), np.empty(1)
+    for i in range(int((tf-t0)/options.dt)):
+        np.dot(C[:1], x, out=y)
+        controller.step(y, r[:, 0], out=u)
+        x = plant_step(x, u)
+    controller.report()
+    instrument.note("x - x_simulated at tf:", x - (derived['X'][:, -1] if options.stream_to else recorder['X'][:, -1]))
+
+mass_position = derived['mass_position']
+mass_speed = derived['mass_speed']
+tank_height = derived['tank_height']
+instrument.section("Final x values:", color=instrument.RESULT)
+instrument.note(mass_position[-1], mass_speed[-1], tank_height[-1])
+
+mass_position_est = derived['mass_position_est']
+mass_speed_est = derived['mass_speed_est']
+tank_height_est = derived['tank_height_est']
+instrument.section("Final x_estimated values:", color=instrument.RESULT)
+instrument.note(mass_position_est[-1], mass_speed_est[-1], tank_height_est[-1])
+
+if options.analytic:
+    # Plant and observer together: z = [x; x_est]
+    response = AnalyticResponse(*closed_loop_system(A, B, C[:1], K, N, L), np.vstack((x0, x_est0)), r)
+    response.report(T[-1], np.concatenate((derived['X'][:, -1], derived['X_est'][:, -1])) if options.stream_to
+                    else np.concatenate((recorder['X'][:, -1], recorder['X_est'][:, -1])))
+
+if plotting.enabled():
+    plt = plotting.pyplot()
+
+    plt.plot(*plotting.downsample(T, mass_position), color='black', label='Mass position (m)')
+    plt.plot(*plotting.downsample(T, mass_position_est), color='green', label='Estimated mass position (m)')
+    plt.plot(*plotting.downsample(T, mass_speed), color='red', label='Mass speed (m/s)')
+    plt.plot(*plotting.downsample(T, mass_speed_est), color='magenta', label='Estimated mass speed (m/s)')
+    plt.plot(*plotting.downsample(T, tank_height), color='blue', label='Tank water height (m)')
+    plt.plot(*plotting.downsample(T, U), 'y', label='Flow rate (m^3/s)')
+    plt.axhline(y=r[0,0], color='gray', linestyle='--', label=f'Mass reference position ({r[0,0]} m)')
+    plt.title('Closed-loop control with state estimation')
+    plt.ylabel('Control variables in SI units')
+    plt.xlabel('Time (s)')
+    plt.legend()
+    plt.grid(True)
+    plotting.show('4_malha_fechada_control_ref_estim')
+
+if options.timings:
+    report_startup('Total run time')
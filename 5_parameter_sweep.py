@@ -0,0 +1,95 @@
+from helpers.startup import report_startup
+import numpy as np
+from helpers import instrument, plotting
+from helpers.conditions import controllability_margins, observability_margins
+from helpers.options import make_parser, parse_options
+from helpers.sweep import make_grid, build_system, design_gains, simulate_sweep
+
+parser = make_parser("Batched parameter sweep of the closed loop with state estimation", integrator='zoh', dt=.01, tf=15)
+parser.add_argument('--output', default=None, help='save parameters and metrics to this .npz file')
+parser.add_argument('--min-margin', type=float, default=0,
+                    help='reject parameter sets whose controllability or observability margin (smallest relative '
+                         'singular value) is not above this value')
+options = parse_options(parser=parser)
+
+WATER_DENSITY = 1000
+MERCURY_DENSITY = 13546
+
+# Swept physical constants (every combination is simulated)
+grid = make_grid(
+  mass=np.linspace(2, 10, 10),               # kg
+  spring_constant=np.linspace(250, 1000, 10), # N/m
+  damping_constant=np.linspace(20, 80, 5),   # Ns/m
+  fluid_density=[WATER_DENSITY, MERCURY_DENSITY], # kg/m^3
+  tank_area=np.linspace(0.01, 0.1, 5),       # m^2
+  pipe_length=[5, 10],                       # m
+)
+
+# Measured output: mass position only, as in script 4
+C = np.array([[1, 0, 0]])
+D = np.array([[0]])
+
+# --------------------
+
+if options.timings:
+  report_startup()
+
+with instrument.timer('design/sweep') as timing:
+  A, B = build_system(**grid)
+
+  # Nearly uncontrollable or unobservable parameter sets would get huge gains: drop them before the design
+  margin = np.minimum(controllability_margins(A, B)['sigma_min'], observability_margins(A, C)['sigma_min'])
+  accepted = margin > options.min_margin
+  if not accepted.all():
+    instrument.section(f"Rejected {np.count_nonzero(~accepted)} parameter sets with a margin below {options.min_margin:g}",
+                       color=instrument.WARNING)
+    grid = {name: values[accepted] for name, values in grid.items()}
+    A, B = A[accepted], B[accepted]
+
+  K, N, L = design_gains(A, B, C, D, controller_poles_gain=10, observer_poles_gain=20)
+design_time = timing.elapsed
+
+# --------------------
+
+# Simulation parameters
+tf = options.tf
+
+# Start conditions (the tank starts empty, and the observer only knows the mass position)
+initial_mass_position = 2
+x0 = np.array([[initial_mass_position], [0], [0]])
+x_est0 = np.array([[initial_mass_position], [0], [0]])
+r = 5 # Set 5 meters to be mass position reference
+
+with instrument.timer('simulation') as timing:
+  metrics = simulate_sweep(A, B, C, K, N, L, x0, x_est0, r, tf, options.dt, options.integrator)
+simulation_time = timing.elapsed
+
+instrument.section(f"Swept {A.shape[0]} parameter sets:")
+instrument.note(f"design: {design_time:.3f} s | simulation: {simulation_time:.3f} s")
+
+instrument.section("Fastest settling parameter sets:", color=instrument.RESULT)
+for i in np.argsort(metrics['settling_time'])[:5]:
+  parameters = ", ".join(f"{name}={values[i]:g}" for name, values in grid.items())
+  instrument.note(f"{parameters} -> settling {metrics['settling_time'][i]:.2f} s, "
+                  f"overshoot {100*metrics['overshoot'][i]:.1f} %, peak flow {metrics['peak_flow'][i]:.3g} m^3/s")
+
+if options.output:
+  np.savez(options.output, **grid, **metrics)
+
+if plotting.enabled():
+  plt = plotting.pyplot()
+
+  for density, color in [(WATER_DENSITY, 'blue'), (MERCURY_DENSITY, 'gray')]:
+    selected = grid['fluid_density'] == density
+    plt.scatter(metrics['settling_time'][selected], metrics['peak_flow'][selected], s=4, color=color,
+                label=f'Fluid density {density} kg/m^3')
+  plt.yscale('log')
+  plt.title('Parameter sweep')
+  plt.xlabel('Settling time (s)')
+  plt.ylabel('Peak flow rate (m^3/s)')
+  plt.legend()
+  plt.grid(True)
+  plotting.show('5_parameter_sweep')
+
+if options.timings:
+  report_startup('Total run time')
@@ -0,0 +1,69 @@
+from helpers.startup import report_startup
+import os
+import numpy as np
+from helpers.montecarlo import PERCENTILES, run_monte_carlo
+from helpers import instrument, plotting
+from helpers.options import make_parser, parse_options
+from helpers.plant import Plant
+
+parser = make_parser("Monte Carlo study of the observer under noise and parameter uncertainty",
+                     integrator='zoh', dt=.01, tf=15)
+parser.add_argument('--runs', type=int, default=2000, help='number of runs')
+parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes')
+parser.add_argument('--seed', type=int, default=0, help='root seed (results are reproducible for a given seed)')
+parser.add_argument('--noise', type=float, default=.01, help='measurement noise standard deviation (m)')
+parser.add_argument('--uncertainty', type=float, default=.1, help='relative uncertainty of the physical constants')
+options = parse_options(parser=parser)
+
+plant = Plant()
+
+A, B = plant.A, plant.B
+C = plant.C((0,)) # We observe only the mass position, with noise
+
+# --------------------
+
+# Gains designed for the nominal plant
+K = plant.K(poles_gain=10)
+N = plant.N(poles_gain=10, outputs=(0,))
+L = plant.L(poles_gain=20, outputs=(0,))
+
+nominal = {**plant.parameters, 'A': A, 'B': B}
+
+# --------------------
+
+# Every run starts from a random mass position and speed; the observer always starts from the same guess
+x_est0 = np.array([2, 0, 0])
+r = 5 # Set 5 meters to be mass position reference
+
+if __name__ == '__main__':
+  if options.timings:
+    report_startup()
+
+  with instrument.timer('simulation') as timing:
+    results = run_monte_carlo(nominal, C, K, N, L, r, x_est0, runs=options.runs, tf=options.tf, dt=options.dt,
+                              integrator=options.integrator, uncertainty=options.uncertainty, noise_std=options.noise,
+                              seed=options.seed, workers=options.workers)
+
+  instrument.section(f"{options.runs} runs on {options.workers} workers:", f"{timing.elapsed:.3f} s")
+  for key in ('estimation_error_rms', 'final_tracking_error', 'peak_flow'):
+    low, median, high = np.percentile(results[key], (5, 50, 95))
+    instrument.note(f"{key}: median {median:.4g} (5%: {low:.4g}, 95%: {high:.4g})")
+
+  if plotting.enabled():
+    plt = plotting.pyplot()
+
+    T = results['T']
+    for key, color in [('estimation_error', 'green'), ('tracking_error', 'black')]:
+      bands = results['bands'][key]
+      plt.fill_between(T, bands[0], bands[-1], color=color, alpha=.15, label=f'{key} {PERCENTILES[0]}-{PERCENTILES[-1]}%')
+      plt.fill_between(T, bands[1], bands[-2], color=color, alpha=.3, label=f'{key} {PERCENTILES[1]}-{PERCENTILES[-2]}%')
+      plt.plot(T, bands[len(PERCENTILES) // 2], color=color, label=f'{key} median')
+    plt.title(f'Monte Carlo ({options.runs} runs)')
+    plt.ylabel('Mass position error (m)')
+    plt.xlabel('Time (s)')
+    plt.legend()
+    plt.grid(True)
+    plotting.show('6_monte_carlo')
+
+  if options.timings:
+    report_startup('Total run time')
@@ -0,0 +1,77 @@
+from helpers.startup import report_startup
+import os
+import numpy as np
+from helpers import instrument, plotting
+from helpers.options import make_parser, parse_options
+from helpers.plant import Plant
+from helpers.tuning import OBJECTIVES, tune
+
+parser = make_parser("Auto-tuning of the controller and observer pole gains", integrator='zoh', dt=.01, tf=15)
+parser.add_argument('--controller-gains', type=float, nargs=2, default=[2, 50], metavar=('LOW', 'HIGH'),
+                    help='range of the controller poles_gain (K)')
+parser.add_argument('--observer-gains', type=float, nargs=2, default=[4, 100], metavar=('LOW', 'HIGH'),
+                    help='range of the observer poles_gain (L)')
+parser.add_argument('--candidates', type=int, default=16, help='gains tried per range (geometric spacing)')
+parser.add_argument('--rungs', type=int, default=4, help='successive halving rungs (the first one runs tf/2^(rungs-1))')
+parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes')
+parser.add_argument('--output', default=None, help='save the final candidates and their metrics to this .npz file')
+options = parse_options(parser=parser)
+
+plant = Plant()
+
+A, B = plant.A, plant.B
+C = plant.C((0,)) # We observe only the mass position, as in script 4
+D = plant.D
+
+# Start conditions of script 4
+initial_mass_position = 2
+x0 = np.array([[initial_mass_position], [-2], [plant.rest_tank_height(initial_mass_position)]])
+x_est0 = np.array([[initial_mass_position], [0], [0]])
+r = 5 # Set 5 meters to be mass position reference
+
+if __name__ == '__main__':
+  if options.timings:
+    report_startup()
+
+  with instrument.timer('simulation') as timing:
+    results = tune(A, B, C, D, np.geomspace(*options.controller_gains, options.candidates),
+                   np.geomspace(*options.observer_gains, options.candidates), x0, x_est0, r, options.tf,
+                   dt=options.dt, integrator=options.integrator, rungs=options.rungs, workers=options.workers)
+
+  instrument.section(f"Successive halving on {options.workers} workers:", f"{timing.elapsed:.3f} s")
+  for horizon, candidates in results['rungs']:
+    instrument.note(f"{candidates} candidates over {horizon:g} s")
+
+  if not results['completed']:
+    instrument.section("No stable candidate:", f"the search stopped after {len(results['rungs'])} of "
+                       f"{options.rungs} rungs ({results['horizon']:g} s instead of {options.tf:g} s)",
+                       color=instrument.WARNING)
+
+  pareto = np.flatnonzero(results['pareto'])
+  instrument.section(f"Pareto front ({pareto.size} gain sets):", color=instrument.RESULT)
+  for i in pareto[np.argsort(results['settling_time'][pareto])]:
+    instrument.note(f"K poles_gain={results['controller_poles_gain'][i]:.3g}, "
+                    f"L poles_gain={results['observer_poles_gain'][i]:.3g} -> "
+                    f"settling {results['settling_time'][i]:.2f} s, overshoot {100*results['overshoot'][i]:.1f} %, "
+                    f"peak flow {results['peak_flow'][i]:.3g} m^3/s, "
+                    f"estimation error rms {results['estimation_error_rms'][i]:.3g} m")
+
+  if options.output:
+    np.savez(options.output, **{key: value for key, value in results.items() if key != 'rungs'})
+
+  if plotting.enabled():
+    plt = plotting.pyplot()
+
+    front = results['pareto']
+    plt.scatter(results['settling_time'][~front], results['peak_flow'][~front], s=8, color='gray', label='Last rung')
+    plt.scatter(results['settling_time'][front], results['peak_flow'][front], s=16, color='red', label='Pareto front')
+    plt.yscale('log')
+    plt.title(f"Pole gain auto-tuning ({', '.join(OBJECTIVES)})")
+    plt.xlabel('Settling time (s)')
+    plt.ylabel('Peak flow rate (m^3/s)')
+    plt.legend()
+    plt.grid(True)
+    plotting.show('7_auto_tune')
+
+  if options.timings:
+    report_startup('Total run time')
@@ -0,0 +1,85 @@
+from helpers.startup import report_startup
+import numpy as np
+from helpers import instrument, plotting
+from helpers.options import make_parser, parse_options
+from helpers.plant import Plant
+from helpers.scenarios import make_scenarios, simulate_scenarios
+
+def floats(text):
+  return [float(value) for value in text.split(',')]
+
+parser = make_parser("Closed loop with state estimation for many references and initial conditions at once", tf=15)
+parser.add_argument('--references', type=floats, default=[3, 4, 5], help='comma-separated mass position references (m)')
+parser.add_argument('--initial-positions', type=floats, default=[1, 2], help='comma-separated initial mass positions (m)')
+parser.add_argument('--initial-speeds', type=floats, default=[-2, 0], help='comma-separated initial mass speeds (m/s)')
+parser.add_argument('--ramp', type=float, default=0,
+                    help='reach each reference through a ramp of this duration (s) from the initial position')
+parser.add_argument('--every', type=int, default=10, help='decimation of the recorded trajectories')
+options = parse_options(parser=parser)
+if options.integrator == 'rk45':
+  parser.error("the scenarios need a fixed-step integrator (euler or zoh)")
+
+plant = Plant()
+
+A, B = plant.A, plant.B
+C = plant.C((0,)) # We observe only the mass position, as in script 4
+
+# Gains of script 4
+K = plant.K(poles_gain=10)
+N = plant.N(poles_gain=10, outputs=(0,))
+L = plant.L(poles_gain=20, outputs=(0,))
+
+# --------------------
+
+# Simulation parameters
+t0, tf = 0, options.tf
+
+# Every combination is a scenario (a column of the state matrix). The tank starts at the height balancing
+# the spring, and the observer only knows the mass position, as in script 4
+scenarios = make_scenarios(r=options.references, initial_mass_position=options.initial_positions,
+                           initial_mass_speed=options.initial_speeds)
+X0 = np.vstack((scenarios['initial_mass_position'], scenarios['initial_mass_speed'],
+                plant.rest_tank_height(scenarios['initial_mass_position'])))
+X_est0 = np.vstack((scenarios['initial_mass_position'], np.zeros_like(X0[1]), np.zeros_like(X0[2])))
+
+R = scenarios['r'][None, :]
+if options.ramp:
+  # Time-varying schedule: a linear ramp from the initial position to the reference, then hold
+  num_steps = int((tf-t0)/options.dt)
+  progress = np.minimum((np.arange(num_steps) * options.dt) / options.ramp, 1)
+  R = (X0[0][:, None] + (R[0][:, None] - X0[0][:, None]) * progress)[None, :, :]
+
+if options.timings:
+  report_startup()
+
+with instrument.timer('simulation') as timing:
+  results = simulate_scenarios(A, B, X0, t0, tf, options.dt, K=K, N=N, R=R, C=C, L=L, X_est0=X_est0,
+                               integrator=options.integrator, every=options.every)
+
+S = X0.shape[1]
+instrument.section(f"{S} scenarios simulated together:", f"{timing.elapsed:.3f} s")
+
+instrument.section("Per-scenario metrics:", color=instrument.RESULT)
+for s in range(S):
+  instrument.note(f"r={scenarios['r'][s]:g}, x0={scenarios['initial_mass_position'][s]:g}, "
+                  f"v0={scenarios['initial_mass_speed'][s]:g} -> final {results['final_position'][s]:.4f} m, "
+                  f"settling {results['settling_time'][s]:.2f} s, overshoot {100*results['overshoot'][s]:.1f} %, "
+                  f"peak flow {results['peak_flow'][s]:.3g} m^3/s, "
+                  f"estimation error rms {results['estimation_error_rms'][s]:.3g} m")
+
+if plotting.enabled():
+  plt = plotting.pyplot()
+
+  T = results['T']
+  for s in range(S):
+    plt.plot(*plotting.downsample(T, results['X'][s, 0]), label=f"r={scenarios['r'][s]:g}, "
+             f"x0={scenarios['initial_mass_position'][s]:g}, v0={scenarios['initial_mass_speed'][s]:g}")
+  plt.title(f'Mass position of {S} scenarios')
+  plt.ylabel('Mass position (m)')
+  plt.xlabel('Time (s)')
+  plt.legend(fontsize='small')
+  plt.grid(True)
+  plotting.show('8_scenarios')
+
+if options.timings:
+  report_startup('Total run time')
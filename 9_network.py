@@ -0,0 +1,80 @@
+from helpers.startup import report_startup
+import numpy as np
+from helpers import instrument, plotting
+from helpers.network import (COUPLING_KINDS, STAGE_STATES, build_network, chain, decentralized_gain, simulate_network,
+                             stage_blocks)
+from helpers.options import make_parser, parse_options
+from helpers.plant import Plant
+from helpers.sweep import design_gains
+
+parser = make_parser("Chain of many coupled mass-tank stages, simulated with sparse matrices", tf=15)
+parser.add_argument('--stages', type=int, default=1000, help='number of stages')
+parser.add_argument('--coupling', choices=COUPLING_KINDS, default='pipe', help='link between consecutive stages')
+parser.add_argument('--coupling-gain', type=float, default=1e-9,
+                    help="gain of every link: N/m (spring), Ns/m (damper) or m^3/(s Pa) (pipe)")
+parser.add_argument('--spread', type=float, default=.1, help='relative spread of the masses and springs between stages')
+parser.add_argument('--seed', type=int, default=0, help='seed of the stage parameters')
+parser.add_argument('--control', action='store_true', help='close every stage with its own state feedback (script 2)')
+parser.add_argument('--every', type=int, default=10, help='decimation of the recorded trajectory')
+options = parse_options(parser=parser)
+if options.integrator != 'euler':
+  parser.error("the network is simulated with forward Euler (exact discretizations of a large network are dense)")
+
+plant = Plant()
+
+# Every stage gets its own mass and spring, around the nominal ones
+rng = np.random.default_rng(options.seed)
+stages = options.stages
+parameters = {
+  'mass': plant.mass * rng.uniform(1 - options.spread, 1 + options.spread, stages),
+  'spring_constant': plant.spring_constant * rng.uniform(1 - options.spread, 1 + options.spread, stages),
+}
+
+with instrument.timer('design/network') as timing:
+  A, B = build_network(stages, chain(stages, options.coupling, options.coupling_gain), **parameters)
+
+  K = None
+  if options.control:
+    # Decentralized control: each stage keeps the pole rule of script 2 on its own block
+    blocks_A, blocks_B = stage_blocks(stages, **parameters)
+    K = decentralized_gain(design_gains(blocks_A, blocks_B, plant.C((0,)), plant.D)[0])
+
+instrument.section(f"{stages} stages, {A.shape[0]} states:",
+                   f"{A.nnz} nonzeros in A ({A.data.nbytes + A.indices.nbytes + A.indptr.nbytes:,} bytes), "
+                   f"built in {timing.elapsed:.3f} s")
+
+# Simulation parameters
+t0, tf = 0, options.tf
+
+# Start conditions: the first mass is pulled 2 meters, its tank balancing the spring (P = kx/A)
+x0 = np.zeros(A.shape[0])
+x0[0] = 2
+x0[2] = parameters['spring_constant'][0] * x0[0] / plant.pipe_section_area
+
+if options.timings:
+  report_startup()
+
+with instrument.timer('simulation') as timing:
+  T, X = simulate_network(A, B, x0, t0, tf, options.dt, K=K, every=options.every)
+
+instrument.section("Simulated in:", f"{timing.elapsed:.3f} s")
+positions = X[0::STAGE_STATES]
+instrument.section("Final mass positions:", color=instrument.RESULT)
+instrument.note(f"first stage {positions[0, -1]:.6g} m, last stage {positions[-1, -1]:.6g} m, "
+                f"largest {np.abs(positions[:, -1]).max():.6g} m")
+
+if plotting.enabled():
+  plt = plotting.pyplot()
+
+  for i in sorted({0, 1, 2, stages // 2, stages - 1}):
+    if i < stages:
+      plt.plot(*plotting.downsample(T, positions[i]), label=f'Stage {i} mass position (m)')
+  plt.title(f'Chain of {stages} stages ({options.coupling} coupling)')
+  plt.ylabel('Mass position (m)')
+  plt.xlabel('Time (s)')
+  plt.legend()
+  plt.grid(True)
+  plotting.show('9_network')
+
+if options.timings:
+  report_startup('Total run time')
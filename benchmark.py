@@ -0,0 +1,220 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+SCRIPTS = ('1_malha_aberta.py', '2_malha_fechada_control.py', '3_malha_fechada_control_ref.py',
+           '4_malha_fechada_control_ref_estim.py')
+
+# Metrics where a larger value is better; every other metric (times, memory) should not grow
+HIGHER_IS_BETTER = ('steps_per_second',)
+
+def _scenario(number):
+  """
+  Builds the simulation of script `number` (nominal plant, same gains and start conditions), as
+  keyword arguments of `helpers.stream.stream`.
+  """
+  from helpers.plant import Plant
+
+  plant = Plant()
+  A, B = plant.A, plant.B
+  pressure = plant.pressure_scale
+  initial_tank_height = plant.rest_tank_height(2)
+
+  with contextlib.redirect_stdout(io.StringIO()):
+    if number == 1:
+      return dict(A=A, B=B, x0=np.array([[2], [0], [pressure]]))
+    K = plant.K(poles_gain=10)
+    if number == 2:
+      return dict(A=A, B=B, x0=np.array([[-2], [0], [pressure]]), K=K)
+    N = plant.N(poles_gain=10, outputs=(0,))
+    if number == 3:
+      return dict(A=A, B=B, x0=np.array([[2], [0], [pressure*initial_tank_height]]), K=K, N=N, r=np.array([[5]]))
+    L = plant.L(poles_gain=20, outputs=(0,))
+    return dict(A=A, B=B, x0=np.array([[2], [-2], [initial_tank_height]]), K=K, N=N, r=np.array([[5]]),
+                C=plant.C((0,)), L=L, x_est0=np.array([[2], [0], [0]]))
+
+def _run_case(number, tf, dt, integrator) -> dict:
+  # Runs in its own process, so ru_maxrss is the peak memory of this case only
+  from helpers.integrator import prepare
+  from helpers.recorder import Recorder
+  from helpers.stream import stream
+
+  scenario = _scenario(number)
+  num_steps = int(tf/dt)
+  series = dict(X=scenario['x0'], U=np.zeros(1))
+  if 'L' in scenario:
+    series['X_est'] = scenario['x_est0']
+
+  # The scipy import and the discretizations are one-off costs: done and reported apart from the stepping
+  setup = prepare(integrator, scenario['A'], scenario['B'], dt, scenario.get('C'), scenario.get('L'), scenario.get('K'))
+
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.perf_counter()
+  recorder = Recorder(0, num_steps, **series)
+  for chunk in stream(t0=0, tf=tf, dt=dt, integrator=integrator, include_initial=False, **scenario):
+    recorder.extend(chunk.T, **{name: getattr(chunk, name) for name in series})
+  elapsed = time.perf_counter() - start
+  rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+  # ru_maxrss is in KiB on Linux and in bytes on macOS
+  scale = 1 if sys.platform == 'darwin' else 1024
+  return {
+    'steps': num_steps,
+    'seconds': elapsed,
+    'setup_seconds': setup,
+    'steps_per_second': num_steps / elapsed,
+    'peak_memory_bytes': rss_after * scale,
+    'simulation_memory_bytes': (rss_after - rss_before) * scale,
+  }
+
+def _time_design(repeat) -> dict:
+  from helpers.control import calculate_K
+  from helpers.estimator import calculate_L
+  from helpers.reference import calculate_N
+
+  scenario = _scenario(4)
+  A, B, C, D = scenario['A'], scenario['B'], scenario['C'], np.array([[0]])
+  K = scenario['K']
+  calls = {
+    'calculate_K': lambda: calculate_K.uncached(A, B, poles_gain=10),
+    'calculate_L': lambda: calculate_L.uncached(A, C, poles_gain=20),
+    'calculate_N': lambda: calculate_N.uncached(A, B, C, D, K, 3, 1),
+    'calculate_K[symbolic]': lambda: calculate_K.uncached(A, B, poles_gain=10, method='symbolic'),
+    'calculate_L[symbolic]': lambda: calculate_L.uncached(A, C, poles_gain=20, method='symbolic'),
+  }
+
+  results = {}
+  for name, call in calls.items():
+    times = []
+    # The symbolic designs take seconds: time them once
+    for _ in range(1 if 'symbolic' in name else repeat):
+      with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    results[f'design/{name}'] = {'seconds': float(np.median(times))}
+  return results
+
+def _time_startup(repeat) -> dict:
+  # Wall time of a headless, zero-length run of each script: interpreter, imports and gain design
+  results = {}
+  env = dict(os.environ, GAIN_CACHE_DIR='')
+  for script in SCRIPTS:
+    times = []
+    for _ in range(repeat):
+      start = time.perf_counter()
+      subprocess.run([sys.executable, script, '--plot', 'none', '--tf', '0'], check=True, env=env,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+      times.append(time.perf_counter() - start)
+    results[f'startup/{script}'] = {'seconds': float(np.median(times))}
+  return results
+
+def run(output, horizons, integrators, dt, repeat):
+  """
+  Runs the whole suite and writes the results to `output` as JSON.
+  """
+  results = {}
+  results.update(_time_design(repeat))
+  results.update(_time_startup(repeat))
+
+  for number in range(1, len(SCRIPTS) + 1):
+    for integrator in integrators:
+      for tf in horizons:
+        name = f'simulation/{number}/{integrator}/tf={tf:g}'
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as f:
+          subprocess.run([sys.executable, __file__, '_case', str(number), str(tf), str(dt), integrator, f.name],
+                         check=True)
+          results[name] = json.load(f)
+        print(f"{name}: {results[name]['steps_per_second']:,.0f} steps/s "
+              f"(+ {results[name]['setup_seconds'] * 1e3:.1f} ms setup), peak memory {results[name]['peak_memory_bytes'] / 2**20:.1f} MiB", flush=True)
+
+  for name, metrics in results.items():
+    if name.startswith(('design', 'startup')):
+      print(f"{name}: {metrics['seconds'] * 1e3:.3f} ms")
+
+  report = {
+    'meta': {
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'python': platform.python_version(),
+      'numpy': np.__version__,
+      'platform': platform.platform(),
+      'dt': dt,
+    },
+    'results': results,
+  }
+  with open(output, 'w') as f:
+    json.dump(report, f, indent=2)
+  print("\n\033[96mBenchmark written to:\033[0m", output)
+
+def compare(baseline, current, tolerance) -> int:
+  """
+  Compares two benchmark files and prints every metric that regressed by more than `tolerance`
+  (relative). Returns the number of regressions.
+  """
+  with open(baseline) as f:
+    baseline_results = json.load(f)['results']
+  with open(current) as f:
+    current_results = json.load(f)['results']
+
+  regressions = 0
+  for name in sorted(set(baseline_results) & set(current_results)):
+    for metric, old in baseline_results[name].items():
+      new = current_results[name].get(metric)
+      if new is None or metric in ('steps', 'simulation_memory_bytes') or old <= 0:
+        continue
+      change = (new - old) / old
+      worse = change < -tolerance if metric in HIGHER_IS_BETTER else change > tolerance
+      if worse:
+        regressions += 1
+      marker = '\033[91mREGRESSION\033[0m' if worse else 'ok'
+      print(f"{name} {metric}: {old:.4g} -> {new:.4g} ({100*change:+.1f} %) {marker}")
+
+  missing = sorted(set(baseline_results) - set(current_results))
+  for name in missing:
+    print(f"{name}: missing from {current}")
+
+  print(f"\n{regressions} regression(s) beyond {100*tolerance:.0f} %")
+  return regressions
+
+def main(args=None):
+  parser = argparse.ArgumentParser(description="Simulation throughput and gain-design benchmark suite")
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  run_parser = commands.add_parser('run', help='run the benchmarks')
+  run_parser.add_argument('--output', default='benchmark.json', help='JSON results file')
+  run_parser.add_argument('--horizons', default='15,50,3600', help='simulated horizons (s), comma separated')
+  run_parser.add_argument('--integrators', default='euler', help='integrators, comma separated (euler, zoh)')
+  run_parser.add_argument('--dt', type=float, default=.001, help='integration step (s)')
+  run_parser.add_argument('--repeat', type=int, default=5, help='repetitions of the timing measurements')
+
+  compare_parser = commands.add_parser('compare', help='flag regressions against a stored baseline')
+  compare_parser.add_argument('baseline', help='baseline JSON file')
+  compare_parser.add_argument('current', nargs='?', default='benchmark.json', help='JSON file to check')
+  compare_parser.add_argument('--tolerance', type=float, default=.1, help='allowed relative slowdown')
+
+  case_parser = commands.add_parser('_case')
+  for name in ('number', 'tf', 'dt', 'integrator', 'output'):
+    case_parser.add_argument(name)
+
+  options = parser.parse_args(args)
+  if options.command == 'run':
+    horizons = [float(h) for h in options.horizons.split(',')]
+    run(options.output, horizons, options.integrators.split(','), options.dt, options.repeat)
+  elif options.command == 'compare':
+    sys.exit(1 if compare(options.baseline, options.current, options.tolerance) else 0)
+  else:
+    result = _run_case(int(options.number), float(options.tf), float(options.dt), options.integrator)
+    with open(options.output, 'w') as f:
+      json.dump(result, f)
+
+if __name__ == '__main__':
+  main()
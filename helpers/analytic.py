@@ -0,0 +1,101 @@
+import numpy as np
+from helpers import instrument
+
+class AnalyticResponse:
+  """
+  Closed-form response of x' = A x + b, x(0) = x0, with constant forcing b = B r (e.g. the closed loop
+  A - BK forced by BNr), evaluated at any times without stepping.
+
+  With an equilibrium x_eq (A x_eq = -b) and a diagonalizable A = V diag(l) V^-1, the response is
+
+    x(t) = x_eq + V diag(exp(l t)) V^-1 (x0 - x_eq)
+
+  computed for all query times at once. When A is defective (ill-conditioned eigenvectors, as with the
+  repeated poles placed by `calculate_K`) or singular with nonzero forcing, it falls back to the matrix
+  exponential of the augmented matrix [[A, b], [0, 0]] * t, evaluated as one stack over the query times.
+
+  Args:
+    A (np.ndarray): State matrix (n x n), e.g. A - BK.
+    B (np.ndarray): Forcing input matrix (n x q), e.g. BN. None for an unforced system.
+    x0 (np.ndarray): Initial state (n or n x 1).
+    r (np.ndarray): Constant input (q or q x 1), e.g. the reference.
+    cond_limit (float): Eigenvector condition number above which A is treated as defective.
+
+  Attributes:
+    method (str): 'eigen' or 'expm'.
+    defective (bool): Whether the eigenvectors of A are (numerically) linearly dependent.
+    stable (bool): Whether every eigenvalue has a negative real part.
+    steady_state (np.ndarray | None): lim x(t) for t -> inf, None when the system is not stable.
+  """
+
+  def __init__(self, A, B, x0, r=None, cond_limit=1e8):
+    A = np.asarray(A, dtype=float)
+    n = A.shape[0]
+    self.A = A
+    self.b = np.zeros(n) if B is None else np.ravel(np.asarray(B, dtype=float) @ np.reshape(r, (-1, 1)))
+    self.x0 = np.ravel(x0).astype(float)
+
+    self.eigenvalues, V = np.linalg.eig(A)
+    self.condition = np.linalg.cond(V)
+    self.defective = not np.isfinite(self.condition) or self.condition > cond_limit
+    # A singular matrix has a zero eigenvalue, which may come out with a tiny negative real part
+    singular = np.linalg.matrix_rank(A) < n
+    self.stable = bool(np.all(self.eigenvalues.real < 0)) and not singular
+
+    x_eq = None
+    if not np.any(self.b):
+      x_eq = np.zeros(n)
+    elif not singular:
+      x_eq = np.linalg.solve(A, -self.b)
+    self.steady_state = x_eq if self.stable else None
+
+    if self.defective or x_eq is None:
+      self.method = 'expm'
+    else:
+      self.method = 'eigen'
+      self._x_eq = x_eq
+      self._V = V
+      self._c = np.linalg.solve(V, self.x0 - x_eq)
+
+  def __call__(self, T) -> np.ndarray:
+    """
+    Evaluates the state at the query times.
+
+    Args:
+      T (float | np.ndarray): Query time(s), measured from the initial state.
+
+    Returns:
+      np.ndarray: States (n x len(T)).
+    """
+    T = np.atleast_1d(np.asarray(T, dtype=float))
+
+    if self.method == 'eigen':
+      X = self._V @ (np.exp(np.outer(self.eigenvalues, T)) * self._c[:, None])
+      return X.real + self._x_eq[:, None]
+
+    from scipy.linalg import expm
+
+    n = self.A.shape[0]
+    M = np.zeros((n + 1, n + 1))
+    M[:n, :n] = self.A
+    M[:n, n] = self.b
+    E = expm(M[None] * T[:, None, None])
+    return (E[:, :n, :n] @ self.x0 + E[:, :n, n]).T
+
+  def report(self, t, simulated=None):
+    """
+    Prints x(t), the steady state and, optionally, the difference to a simulated x(t).
+
+    Args:
+      t (float): Query time.
+      simulated (np.ndarray): Simulated state at t (n,).
+    """
+    x = self(t)[:, 0]
+    instrument.section("Closed-form response:")
+    if self.defective:
+      instrument.note(f"matrix is defective (eigenvector condition number {self.condition:.2e}, "
+                      f"eigenvalues {np.round(self.eigenvalues, 6)}): using the matrix exponential")
+    instrument.note(f"method: {self.method} | x({t:g}):", x)
+    instrument.note("steady state:", self.steady_state if self.stable else "none (not asymptotically stable)")
+    if simulated is not None:
+      instrument.note(f"x_simulated - x at {t:g}:", np.ravel(simulated) - x)
@@ -0,0 +1,134 @@
+import numpy as np
+from helpers import instrument
+from helpers.integrator import loop_step_matrices, step_matrices
+
+def closed_loop_system(A, B, C, K, N, L) -> tuple:
+  """
+  Builds the continuous closed loop of script 4 on the augmented state z = [x; x_est]:
+
+    z' = [[A,   -BK         ],  z + [[BN],  r
+          [L C,  A - LC - BK]]       [BN]]
+
+  Args:
+    A, B (np.ndarray): Plant matrices.
+    C (np.ndarray): Measured output matrix (p x n).
+    K, N, L (np.ndarray): State feedback, reference and observer gains.
+
+  Returns:
+    tuple: (Acl, Bcl), of shapes (2n x 2n) and (2n x q).
+  """
+  K, N = np.atleast_2d(K), np.atleast_2d(N)
+  Acl = np.block([[A, -B@K], [L@C, A - L@C - B@K]])
+  Bcl = np.vstack((B@N, B@N))
+  return Acl, Bcl
+
+class AugmentedLoop:
+  """
+  Plant + observer + reference loop of script 4 propagated as one linear map.
+
+  With the one-step matrices (Ad, Bd) of the plant and (Ao, [Bo_u Bo_y]) of the observer (A - LC, [B L])
+  for the chosen integrator, a step of the scripts (u = Nr - K x_est, then both x and x_est advance with
+  u held over the step and y = Cx) is exactly
+
+    [x; x_est; r] <- P @ [x; x_est; r],   P = [[Ad,      -Bd K,          Bd N  ],
+                                               [Bo_y C,  Ao - Bo_u K,    Bo_u N],
+                                               [0,       0,              I     ]]
+
+  so every step is a single (2n+q) x (2n+q) product, and k steps are P^k, obtained by repeated squaring.
+
+  With 'zoh', the top rows are instead the exact discretization of the continuous closed loop
+  ([M, F N] from `helpers.integrator.loop_step_matrices`), as in `helpers.stream`.
+
+  Args:
+    A, B (np.ndarray): Plant matrices.
+    C (np.ndarray): Measured output matrix (p x n).
+    K, N, L (np.ndarray): State feedback, reference and observer gains.
+    dt (float): Step.
+    integrator (str): 'euler' (same steps as `helpers.stream`) or 'zoh'.
+  """
+
+  def __init__(self, A, B, C, K, N, L, dt, integrator='euler'):
+    n, m = B.shape
+    K, N = np.atleast_2d(K), np.atleast_2d(N)
+    q = N.shape[1]
+
+    P = np.zeros((2*n + q, 2*n + q))
+    if integrator == 'zoh':
+      M, F = loop_step_matrices(A, B, K, dt, integrator, C, L)
+      P[:2*n, :2*n] = M
+      P[:2*n, 2*n:] = F[:, :m]@N
+    else:
+      Ad, Bd = step_matrices(A, B, dt, integrator)
+      Ao, Bo = step_matrices(A - L@C, np.hstack((B, L)), dt, integrator)
+      Bo_u, Bo_y = Bo[:, :m], Bo[:, m:]
+      P[:n, :n] = Ad
+      P[:n, n:2*n] = -Bd@K
+      P[:n, 2*n:] = Bd@N
+      P[n:2*n, :n] = Bo_y@C
+      P[n:2*n, n:2*n] = Ao - Bo_u@K
+      P[n:2*n, 2*n:] = Bo_u@N
+    P[2*n:, 2*n:] = np.eye(q)
+
+    self.P = P
+    self.K, self.N = K, N
+    self.n, self.q = n, q
+    self.dt = dt
+
+  def augment(self, x, x_est, r) -> np.ndarray:
+    """np.ndarray: Augmented state [x; x_est; r], shape (2n+q,)."""
+    return np.concatenate((np.ravel(x), np.ravel(x_est), np.ravel(r))).astype(float)
+
+  def split(self, Z) -> tuple:
+    """
+    Splits augmented states (2n+q,) or (2n+q x samples) into (X, X_est).
+    """
+    return Z[:self.n], Z[self.n:2*self.n]
+
+  def inputs(self, Z) -> np.ndarray:
+    """
+    Control inputs u = Nr - K x_est applied from the given augmented states (m,) or (m x samples).
+    """
+    return self.N@Z[2*self.n:] - self.K@Z[self.n:2*self.n]
+
+  def jump(self, z, steps) -> np.ndarray:
+    """
+    Advances an augmented state by `steps` steps at once, with P^steps computed by repeated squaring
+    (O(log steps) matrix products).
+
+    Args:
+      z (np.ndarray): Augmented state (2n+q,).
+      steps (int): Number of steps.
+
+    Returns:
+      np.ndarray: Augmented state after `steps` steps.
+    """
+    steps = int(steps)
+    instrument.count('steps', steps)
+    # Squarings plus one product per set bit of `steps`, then the product with z
+    instrument.count('matmuls', max(steps.bit_length() - 1, 0) + bin(steps).count('1'))
+    return np.linalg.matrix_power(self.P, steps) @ z
+
+  def trajectory(self, z0, num_steps, every=1) -> np.ndarray:
+    """
+    Propagates an augmented state, one product per step, keeping every `every`-th sample. With every > 1
+    the samples are spaced by P^every, so only the kept samples are computed.
+
+    Args:
+      z0 (np.ndarray): Initial augmented state (2n+q,).
+      num_steps (int): Number of steps.
+      every (int): Decimation factor; num_steps should be a multiple of it.
+
+    Returns:
+      np.ndarray: Augmented states (2n+q x num_steps//every + 1), column-major.
+    """
+    P = self.P if every == 1 else np.linalg.matrix_power(self.P, every)
+    samples = num_steps // every + 1
+    Z = np.empty((P.shape[0], samples), order='F')
+    Z[:, 0] = z0
+    for k in range(samples - 1):
+      np.dot(P, Z[:, k], out=Z[:, k + 1])
+
+    instrument.count('steps', (samples - 1) * every)
+    instrument.count('matmuls', samples - 1)
+    instrument.count('allocated_bytes', Z.nbytes)
+    return Z
@@ -0,0 +1,196 @@
+import functools
+import hashlib
+import inspect
+import os
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from helpers import instrument, plotting
+
+# Bump when the design functions change, so stale on-disk entries are not reused
+CACHE_VERSION = 1
+
+class GainCache:
+  """
+  Two-level cache for designed gains: an in-process LRU in front of an on-disk store of .npz files.
+
+  Entries are keyed by a content hash of the input arrays plus the design settings (see `make_key`).
+  The disk store is shared between runs and processes; when it grows past `max_bytes`, the least
+  recently used files are evicted.
+
+  Args:
+    directory (str | None): Directory of the on-disk store. None disables it.
+    max_entries (int): Capacity of the in-process LRU.
+    max_bytes (int): Size budget of the on-disk store.
+  """
+
+  def __init__(self, directory=None, max_entries=128, max_bytes=16 * 2**20):
+    self.directory = directory
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self._memory = OrderedDict()
+    self.memory_hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+
+  def stats(self) -> dict:
+    """dict: Hit/miss counters and current sizes of both levels."""
+    disk_files = self._disk_files()
+    return {
+      'memory_hits': self.memory_hits,
+      'disk_hits': self.disk_hits,
+      'misses': self.misses,
+      'memory_entries': len(self._memory),
+      'disk_entries': len(disk_files),
+      'disk_bytes': sum(size for _, _, size in disk_files),
+    }
+
+  def clear(self):
+    """Empties both levels and resets the counters."""
+    self._memory.clear()
+    for path, _, _ in self._disk_files():
+      os.remove(path)
+    self.memory_hits = self.disk_hits = self.misses = 0
+
+  def get(self, key):
+    """
+    Looks a key up in memory first, then on disk.
+
+    Returns:
+      np.ndarray | None: A copy of the cached value, or None on a miss.
+    """
+    if key in self._memory:
+      self._memory.move_to_end(key)
+      self.memory_hits += 1
+      return self._memory[key].copy()
+
+    path = self._path(key)
+    if path is not None and os.path.exists(path):
+      try:
+        with np.load(path) as data:
+          value = data['value']
+        os.utime(path) # Refresh the LRU order of the disk store
+      except (OSError, ValueError, KeyError):
+        value = None
+      if value is not None:
+        self.disk_hits += 1
+        self._remember(key, value)
+        return value.copy()
+
+    self.misses += 1
+    return None
+
+  def put(self, key, value):
+    """Stores a value in memory and (atomically) on disk."""
+    value = np.array(value)
+    self._remember(key, value)
+
+    if self.directory is None:
+      return
+    os.makedirs(self.directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        np.savez(f, value=value)
+      os.replace(tmp_path, self._path(key))
+    except OSError:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      return
+    self._evict()
+
+  def _remember(self, key, value):
+    self._memory[key] = value
+    self._memory.move_to_end(key)
+    while len(self._memory) > self.max_entries:
+      self._memory.popitem(last=False)
+
+  def _path(self, key):
+    return None if self.directory is None else os.path.join(self.directory, f'{key}.npz')
+
+  def _disk_files(self) -> list:
+    if self.directory is None or not os.path.isdir(self.directory):
+      return []
+    files = []
+    for entry in os.scandir(self.directory):
+      if entry.name.endswith('.npz'):
+        stat = entry.stat()
+        files.append((entry.path, stat.st_mtime, stat.st_size))
+    return files
+
+  def _evict(self):
+    files = sorted(self._disk_files(), key=lambda f: f[1])
+    total = sum(size for _, _, size in files)
+    for path, _, size in files:
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      total -= size
+
+def make_key(name, arguments) -> str:
+  """
+  Hashes a function name and its (bound) arguments. Arrays contribute their dtype, shape and contents;
+  everything else contributes its repr.
+
+  Args:
+    name (str): Qualified function name.
+    arguments (dict): Argument name -> value.
+
+  Returns:
+    str: Hex digest identifying the call.
+  """
+  digest = hashlib.sha256(f'{CACHE_VERSION}:{name}'.encode())
+  for arg_name, value in sorted(arguments.items()):
+    digest.update(arg_name.encode())
+    if isinstance(value, np.ndarray):
+      value = np.ascontiguousarray(value)
+      digest.update(f'{value.dtype.str}{value.shape}'.encode())
+      digest.update(value.tobytes())
+    else:
+      digest.update(repr(value).encode())
+  return digest.hexdigest()
+
+gain_cache = GainCache(directory=os.environ.get('GAIN_CACHE_DIR', '.gain_cache') or None)
+
+def memoize(label, ignore=(), cache=None):
+  """
+  Decorator caching a gain design function in `gain_cache` (or the given cache).
+
+  Arguments listed in `ignore` do not take part in the key. A truthy `plot` argument always runs the
+  function (unless plotting is disabled), so the pole plot can still be shown.
+
+  Args:
+    label (str): Name of the gain, used in the cache-hit message.
+    ignore (tuple): Argument names excluded from the key.
+    cache (GainCache): Cache to use instead of the module-level `gain_cache`.
+  """
+  def decorator(func):
+    signature = inspect.signature(func)
+    name = f'{func.__module__}.{func.__qualname__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      target = gain_cache if cache is None else cache
+      bound = signature.bind(*args, **kwargs)
+      bound.apply_defaults()
+      key = make_key(name, {k: v for k, v in bound.arguments.items() if k not in ignore})
+
+      if not (bound.arguments.get('plot') and plotting.enabled()):
+        value = target.get(key)
+        if value is not None:
+          instrument.count('gain_cache/hits')
+          instrument.section(f"Solution for {label} (cached):")
+          instrument.note(value)
+          return value
+        instrument.count('gain_cache/misses')
+
+      value = func(*args, **kwargs)
+      target.put(key, value)
+      return value
+
+    wrapper.uncached = func
+    return wrapper
+  return decorator
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import time
+import numpy as np
+from helpers import instrument
+from helpers.cache import make_key
+
+# Bump when the checkpointed state changes, so old checkpoints are refused instead of misread
+CHECKPOINT_VERSION = 1
+
+def signature(**configuration) -> str:
+  """
+  Hashes everything a run depends on (matrices, gains, step, horizon, integrator, ...), so a checkpoint
+  is only resumed by the run that wrote it.
+
+  Returns:
+    str: Hex digest of the configuration.
+  """
+  return make_key(f'checkpoint:{CHECKPOINT_VERSION}', configuration)
+
+def save_checkpoint(path, **state):
+  """
+  Writes a checkpoint atomically: the .npz is written and synced to a temporary file next to `path`,
+  then renamed over it, so a crash leaves either the previous checkpoint or the new one, never a
+  partial file. Arrays are stored in binary, so floats are restored exactly.
+
+  Args:
+    path (str): Checkpoint file.
+    **state: Arrays and scalars to store.
+  """
+  directory = os.path.dirname(os.path.abspath(path))
+  os.makedirs(directory, exist_ok=True)
+  fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+  try:
+    with instrument.timer('checkpoint/save'), os.fdopen(fd, 'wb') as f:
+      np.savez(f, version=CHECKPOINT_VERSION, **state)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+  instrument.count('checkpoint/saves')
+
+def load_checkpoint(path, expected_signature=None) -> dict:
+  """
+  Reads a checkpoint written by `save_checkpoint`.
+
+  Args:
+    path (str): Checkpoint file.
+    expected_signature (str): When given, the checkpoint must have been written with this `signature`.
+
+  Returns:
+    dict: The stored state; 0-d arrays are returned as scalars.
+  """
+  with np.load(path) as data:
+    state = {name: data[name][()] if data[name].ndim == 0 else data[name] for name in data.files}
+
+  if state.pop('version') != CHECKPOINT_VERSION:
+    raise ValueError(f"Checkpoint {path} was written by another version of the simulator")
+  if expected_signature is not None and state.get('signature') != expected_signature:
+    raise ValueError(f"Checkpoint {path} was written by a run with other matrices, gains or settings")
+  return state
+
+class Checkpointer:
+  """
+  Decides when a simulation saves its state, every `every_steps` integration steps and/or every
+  `every_seconds` of wall time, whichever comes first, and saves it with `save_checkpoint`.
+
+  Args:
+    path (str): Checkpoint file.
+    every_steps (int): Step interval (None disables it).
+    every_seconds (float): Wall-time interval (None disables it).
+    **fixed: Values stored with every checkpoint (e.g. the run `signature`).
+  """
+
+  def __init__(self, path, every_steps=None, every_seconds=None, **fixed):
+    if not every_steps and not every_seconds:
+      raise ValueError("Checkpointer needs every_steps or every_seconds")
+    self.path = path
+    self.every_steps = every_steps
+    self.every_seconds = every_seconds
+    self.fixed = fixed
+    self.start(0)
+
+  def start(self, step):
+    """Restarts both intervals from `step` (the first step of the run, or the resumed one)."""
+    self._last_step = step
+    self._last_time = time.perf_counter()
+
+  def due(self, step) -> bool:
+    """bool: Whether a checkpoint should be taken before integration step `step`."""
+    if self.every_steps and step - self._last_step >= self.every_steps:
+      return True
+    return bool(self.every_seconds) and time.perf_counter() - self._last_time >= self.every_seconds
+
+  def save(self, step, **state):
+    """Saves the state reached before integration step `step`, and restarts the intervals."""
+    save_checkpoint(self.path, step=step, **self.fixed, **state)
+    self.start(step)
@@ -1,33 +1,121 @@
 import numpy as np
-from numpy.linalg import matrix_rank
+from helpers import instrument
 
-def check_controllability(A, B):
+def krylov_blocks(A, B) -> np.ndarray:
+    """
+    Builds the controllability (Krylov) matrix [B, AB, ..., A^(n-1)B] for any state dimension n, one
+    block from the previous one (a single product per block). Every column is scaled to unit norm as it
+    is built: the rank is unchanged, and large n or badly scaled plants neither overflow nor hide small
+    directions behind large ones.
+
+    Parameters:
+    A (np.ndarray): State matrix (n x n), or stacked state matrices (P x n x n).
+    B (np.ndarray): Input matrix (n x m), or stacked input matrices (P x n x m). A single B is shared by
+    all the stacked A.
+
+    Returns:
+    np.ndarray: Column-normalized Krylov matrix (n x n*m), or (P x n x n*m) when stacked.
+    """
+    A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+    n = A.shape[-1]
+    block = np.broadcast_to(B, A.shape[:-2] + B.shape[-2:])
+    blocks = []
+    for _ in range(n):
+        norms = np.linalg.norm(block, axis=-2, keepdims=True)
+        block = block / np.where(norms > 0, norms, 1)
+        blocks.append(block)
+        block = A @ block
+    instrument.count('matmuls', (n - 1) * int(np.prod(A.shape[:-2], dtype=int)))
+    return np.concatenate(blocks, axis=-1)
+
+def rank_margins(M) -> dict:
+    """
+    Numerical rank of one or many matrices from their singular values (batched SVD), with the margin
+    by which the rank is full.
+
+    Parameters:
+    M (np.ndarray): Matrix (n x k), or stacked matrices (P x n x k), with n <= k.
+
+    Returns:
+    dict: 'rank', 'full_rank', 'sigma_min' (smallest singular value relative to the largest one, 0 for
+    a rank-deficient matrix) and 'condition' (its inverse), as scalars or (P,) arrays.
+    """
+    singular_values = np.linalg.svd(M, compute_uv=False)
+    largest, smallest = singular_values[..., 0], singular_values[..., -1]
+    # Same tolerance as np.linalg.matrix_rank
+    tolerance = largest * max(M.shape[-2:]) * np.finfo(float).eps
+    rank = np.sum(singular_values > tolerance[..., None], axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_min = np.where(largest > 0, smallest / largest, 0.)
+        condition = np.where(smallest > 0, largest / smallest, np.inf)
+    # [()] turns the 0-d results of a single matrix into scalars
+    return {
+        'rank': rank,
+        'full_rank': rank == M.shape[-2],
+        'sigma_min': sigma_min[()],
+        'condition': condition[()],
+    }
+
+@instrument.timer('design/controllability_margins')
+def controllability_margins(A, B) -> dict:
+    """
+    Controllability of one or many systems, with its margin (see `rank_margins`). A small 'sigma_min'
+    (large 'condition') flags a system that is nearly uncontrollable.
+
+    Parameters:
+    A (np.ndarray): State matrix (n x n), or stacked state matrices (P x n x n).
+    B (np.ndarray): Input matrix (n x m), or stacked input matrices (P x n x m).
+
+    Returns:
+    dict: 'rank', 'full_rank', 'sigma_min' and 'condition', as scalars or (P,) arrays.
+    """
+    return rank_margins(krylov_blocks(A, B))
+
+@instrument.timer('design/observability_margins')
+def observability_margins(A, C) -> dict:
+    """
+    Observability of one or many systems, with its margin, by duality: (A, C) is observable when
+    (A^T, C^T) is controllable.
+
+    Parameters:
+    A (np.ndarray): State matrix (n x n), or stacked state matrices (P x n x n).
+    C (np.ndarray): Output matrix (p x n), or stacked output matrices (P x p x n).
+
+    Returns:
+    dict: 'rank', 'full_rank', 'sigma_min' and 'condition', as scalars or (P,) arrays.
+    """
+    return rank_margins(krylov_blocks(np.swapaxes(A, -1, -2), np.swapaxes(C, -1, -2)))
+
+@instrument.timer('design/check_controllability')
+def check_controllability(A, B, min_margin=0):
     """
     Check if the system is controllable.
-    
+
     Parameters:
-    A (np.ndarray): State matrix.
-    B (np.ndarray): Input matrix.
-    
+    A (np.ndarray): State matrix (n x n), or stacked state matrices (P x n x n).
+    B (np.ndarray): Input matrix (n x m), or stacked input matrices (P x n x m).
+    min_margin (float): Smallest relative singular value of the controllability matrix below which the
+    system is considered not controllable (0 only requires full rank).
+
     Returns:
-    bool: True if the system is controllable, False otherwise.
+    bool: True if the system is controllable, False otherwise ((P,) array when stacked).
     """
-    n = A.shape[0]
-    controllability_matrix = np.hstack([B, A @ B, A @ A @ B, A @ A @ A @ B])
-    rank_C = matrix_rank(controllability_matrix)
-    return rank_C == n
-def check_observability(A, C):
+    margins = controllability_margins(A, B)
+    return margins['full_rank'] & (margins['sigma_min'] > min_margin)
+
+@instrument.timer('design/check_observability')
+def check_observability(A, C, min_margin=0):
     """
     Check if the system is observable.
-    
+
     Parameters:
-    A (np.ndarray): State matrix.
-    C (np.ndarray): Output matrix.
-    
+    A (np.ndarray): State matrix (n x n), or stacked state matrices (P x n x n).
+    C (np.ndarray): Output matrix (p x n), or stacked output matrices (P x p x n).
+    min_margin (float): Smallest relative singular value of the observability matrix below which the
+    system is considered not observable (0 only requires full rank).
+
     Returns:
-    bool: True if the system is observable, False otherwise.
+    bool: True if the system is observable, False otherwise ((P,) array when stacked).
     """
-    n = A.shape[0]
-    observability_matrix = np.vstack([C, C @ A, C @ A @ A, C @ A @ A @ A])
-    rank_O = matrix_rank(observability_matrix)
-    return rank_O == n
\ No newline at end of file
+    margins = observability_margins(A, C)
+    return margins['full_rank'] & (margins['sigma_min'] > min_margin)
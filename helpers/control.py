@@ -1,51 +1,129 @@
 import numpy as np
-import sympy as sp
-import matplotlib.pyplot as plt
+from helpers import instrument, plotting
+from helpers.cache import memoize
 
-def calculate_K(A, B, poles_gain, plot) -> np.ndarray:
+def desired_poles(A, poles_gain) -> np.ndarray:
   """
-  Calculates the state feedback gain matrix K for pole placement in a state-space control system.
-
-  This function computes the gain matrix K such that the closed-loop system (A - B*K) has its poles
-  placed at desired locations in the complex plane. The desired pole locations are determined by
-  shifting the original poles further left on the real axis (for increased stability) and adjusting
-  their imaginary parts, both controlled by the `poles_gain` parameter.
+  Computes the pole set used by default for K and L: a pole of multiplicity n, further left on the real axis
+  and closer to it than the original poles.
 
   Args:
     A (np.ndarray): The state matrix of the system (n x n).
-    B (np.ndarray): The input matrix of the system (n x m).
     poles_gain (float): Gain factor to adjust the placement of the new poles.
-    plot (bool): If True, plots the original and new pole locations on the complex plane.
 
   Returns:
-    np.ndarray: The computed state feedback gain matrix K (1 x n).
-
-  Notes:
-    - The function uses symbolic computation to solve for K such that the characteristic polynomial
-      of (A - B*K) matches the desired polynomial with new pole locations.
-    - The function assumes a 3-state system (n=3) and a single input (m=1).
-    - If `plot` is True, a plot of the original and new poles is displayed.
+    np.ndarray: The n desired poles.
   """
-  # Calculate new poles
   poles = np.linalg.eigvals(A)
 
   # Set new poles to be more closer to infinity on real axis and close to zero on imaginary axis
   new_x, new_y = -abs(np.mean(np.real(poles))) * poles_gain, abs(np.mean(np.imag(poles))) / poles_gain
 
+  # The imaginary parts of the eigenvalues of a real matrix cancel out, so new_y only holds rounding noise
+  return np.real_if_close(np.full(A.shape[0], new_x + new_y * 1j))
+
+def ackermann(A, B, poles) -> np.ndarray:
+  """
+  Places the poles of (A - BK) for a single input system with Ackermann's formula:
+  K = [0 ... 0 1] @ inv([B, AB, ..., A^(n-1)B]) @ phi(A), with phi the desired characteristic polynomial.
+
+  Stacked systems (P x n x n, P x n x 1, P x n poles) are handled at once.
+
+  Args:
+    A (np.ndarray): The state matrix (n x n), or a stack of them.
+    B (np.ndarray): The input matrix (n x 1), or a stack of them.
+    poles (np.ndarray): The n desired poles, or a stack of them.
+
+  Returns:
+    np.ndarray: The gain matrix K (1 x n), or a stack of them.
+  """
+  n = A.shape[-1]
+  blocks = [B]
+  for _ in range(n - 1):
+    blocks.append(A @ blocks[-1])
+  controllability_matrix = np.concatenate(blocks, axis=-1)
+
+  identity = np.eye(n)
+  poles = np.asarray(poles)
+  phi = np.broadcast_to(identity, A.shape).astype(complex)
+  for i in range(n):
+    phi = phi @ (A - poles[..., i, None, None] * identity)
+
+  e_n = np.zeros(A.shape[:-2] + (n, 1))
+  e_n[..., -1, 0] = 1
+  v = np.linalg.solve(np.swapaxes(controllability_matrix, -1, -2), e_n)
+  return np.real(np.swapaxes(v, -1, -2) @ phi)
+
+def place_poles(A, B, poles) -> np.ndarray:
+  """
+  Numerically computes K such that the eigenvalues of (A - BK) are `poles`.
+
+  Single input systems use Ackermann's formula. Multiple input systems use the robust eigenstructure
+  assignment of Tits and Yang (scipy.signal.place_poles), which requires each pole multiplicity
+  to be at most rank(B).
+
+  Args:
+    A (np.ndarray): The state matrix of the system (n x n).
+    B (np.ndarray): The input matrix of the system (n x m).
+    poles (np.ndarray): The n desired poles. Complex poles must come in conjugate pairs.
+
+  Returns:
+    np.ndarray: The gain matrix K (m x n).
+  """
+  A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+  poles = np.asarray(poles)
+  n = A.shape[0]
+
+  if poles.shape != (n,):
+    raise ValueError(f"Expected {n} poles, got {poles.shape[0] if poles.ndim else 0}")
+  if not np.allclose(np.sort_complex(poles), np.sort_complex(np.conj(poles))):
+    raise ValueError("Complex poles must come in conjugate pairs")
+
+  if B.shape[1] == 1:
+    return ackermann(A, B, poles)
+
+  from scipy.signal import place_poles as robust_place_poles
+  return robust_place_poles(A, B, poles, method='YT').gain_matrix
+
+def plot_poles(original_poles, new_poles, name='pole_placement'):
+  """
+  Plots the original and new pole locations on the complex plane.
+
+  Args:
+    original_poles (np.ndarray): Poles of the open-loop system.
+    new_poles (np.ndarray): Placed poles.
+    name (str): Figure name used when figures are saved to files.
+  """
+  if not plotting.enabled():
+    return
+
+  plt = plotting.pyplot()
+  plt.plot(np.real(original_poles),np.imag(original_poles),'bx', label='Original poles')
+  plt.plot(np.real(new_poles),np.imag(new_poles),'rx', label='New poles')
+  plt.xlabel('Real axis')
+  plt.ylabel('Imaginary axis')
+  plt.grid(True)
+  plt.legend()
+  plt.title('Pole Placement')
+  plotting.show(name)
+
+def _symbolic_K(A, B, poles) -> tuple:
+  # SymPy is only imported when the symbolic method is requested
+  import sympy as sp
+
   # det(sI - A + BK) = (s - p1)(s - p2)(s - p3)
   s = sp.symbols('s')
 
   k1, k2, k3 = sp.symbols('k1 k2 k3')
   K = sp.Matrix([[k1, k2, k3]])
 
-  # This creates a polynome with the s as symbolic variable 
+  # This creates a polynome with the s as symbolic variable
   # and the coefficients as k1, k2, k3
   left_side_poly = (sp.eye(3) * s - A + B@K).det().simplify()
 
   # This creates a polynomial with the s as symbolic variable
-  # and the coefficients as new_x, new_y, out aimed poles
-  # p1 = p2 = p3 = new_x + new_y*j
-  p1, p2, p3 = new_x + new_y * 1j, new_x + new_y * 1j, new_x + new_y * 1j
+  # and the coefficients as the aimed poles
+  p1, p2, p3 = poles
   right_side_poly = sp.expand((s - p1) * (s - p2) * (s - p3))
 
   # Create Polynomials objects and match coefficients
@@ -54,19 +132,53 @@ def calculate_K(A, B, poles_gain, plot) -> np.ndarray:
   eqs = [sp.Eq(c1, c2) for c1, c2 in zip(left_side_poly_coeffs, right_side_poly_coeffs)]
 
   # Compute Ks
-  solution = sp.solve(eqs, (k1, k2, k3))
-  K = solution[k1], solution[k2], solution[k3]
-  print("\n\033[95mSolution for K:\033[0m")
-  print(K)
+  with instrument.timer('design/sympy_solve'):
+    solution = sp.solve(eqs, (k1, k2, k3))
+  return solution[k1], solution[k2], solution[k3]
+
+@instrument.timer('design/calculate_K')
+@memoize('K', ignore=('plot',))
+def calculate_K(A, B, poles_gain=10, plot=False, poles=None, method='numeric') -> np.ndarray:
+  """
+  Calculates the state feedback gain matrix K for pole placement in a state-space control system.
+
+  This function computes the gain matrix K such that the closed-loop system (A - B*K) has its poles
+  placed at desired locations in the complex plane. Unless `poles` is given, the desired pole locations
+  are determined by shifting the original poles further left on the real axis (for increased stability)
+  and adjusting their imaginary parts, both controlled by the `poles_gain` parameter.
+
+  Args:
+    A (np.ndarray): The state matrix of the system (n x n).
+    B (np.ndarray): The input matrix of the system (n x m).
+    poles_gain (float): Gain factor to adjust the placement of the new poles.
+    plot (bool): If True, plots the original and new pole locations on the complex plane.
+    poles (np.ndarray): Optional set of n desired poles (distinct or repeated), overriding `poles_gain`.
+    method (str): 'numeric' (Ackermann / robust eigenstructure assignment) or 'symbolic' (SymPy).
+
+  Returns:
+    np.ndarray: The computed state feedback gain matrix K, shape (n,) for a single input system,
+    (m x n) otherwise.
+
+  Notes:
+    - The numeric method handles any number of states and inputs.
+    - The symbolic method solves det(sI - A + BK) = prod(s - p_i) by matching coefficients with SymPy.
+      It assumes a 3-state system (n=3) and a single input (m=1).
+    - If `plot` is True, a plot of the original and new poles is displayed.
+  """
+  new_poles = desired_poles(A, poles_gain) if poles is None else np.asarray(poles)
+
+  if method == 'numeric':
+    K = place_poles(A, B, new_poles)
+    K = K[0] if K.shape[0] == 1 else K
+  elif method == 'symbolic':
+    K = np.array(_symbolic_K(A, B, new_poles), dtype=float)
+  else:
+    raise ValueError(f"Unknown method '{method}', expected 'numeric' or 'symbolic'")
+
+  instrument.section("Solution for K:")
+  instrument.note(K)
 
   if plot:
-    plt.plot(np.real(poles),np.imag(poles),'bx', label='Original poles')
-    plt.plot(np.real([p1, p2, p3]),np.imag([k1, k2, k3]),'rx', label='New poles')
-    plt.xlabel('Real axis')
-    plt.ylabel('Imaginary axis')
-    plt.grid(True)
-    plt.legend()
-    plt.title('Pole Placement')
-    plt.show()
-
-  return np.array(K, dtype=float)
\ No newline at end of file
+    plot_poles(np.linalg.eigvals(A), new_poles, 'pole_placement_K')
+
+  return K
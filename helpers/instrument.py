@@ -0,0 +1,193 @@
+import atexit
+import contextlib
+import json
+import os
+import sys
+import time
+from helpers.startup import STARTED
+
+PROFILERS = ('cprofile', 'tracemalloc')
+
+# ANSI colors of the diagnostics: section headers, results and warnings
+HEADER, RESULT, WARNING = 95, 96, 93
+
+_timers = {}
+_counters = {}
+_diagnostics = []
+_settings = {'report': None, 'profile': (), 'profiler': None, 'registered': False}
+
+class Timer(contextlib.ContextDecorator):
+  """
+  Named wall-clock timer, usable as a context manager or a decorator. Every use adds one call and its
+  duration to the totals of `name`; the duration of the last use is kept in `elapsed`.
+
+  Args:
+    name (str): Phase name, '/'-separated by area (e.g. 'design/calculate_K').
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.elapsed = None
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.elapsed = time.perf_counter() - self._start
+    calls, seconds = _timers.get(self.name, (0, 0.))
+    _timers[self.name] = (calls + 1, seconds + self.elapsed)
+    return False
+
+def timer(name) -> Timer:
+  """
+  Times a phase:
+
+    with instrument.timer('simulation') as timing:
+      ...
+    elapsed = timing.elapsed
+
+  or, for every call of a function, `@instrument.timer('design/calculate_K')`.
+  """
+  return Timer(name)
+
+def count(name, amount=1):
+  """
+  Adds `amount` to the counter `name` (e.g. 'steps', 'matmuls', 'allocated_bytes').
+  """
+  _counters[name] = _counters.get(name, 0) + amount
+
+def section(title, *values, color=HEADER, newline=True):
+  """
+  Prints a colored diagnostic header, optionally followed by values on the same line, and starts a
+  section of the report with it.
+
+  Args:
+    title (str): Header text.
+    *values: Values printed after the header.
+    color (int): ANSI color (HEADER, RESULT or WARNING).
+    newline (bool): Whether a blank line precedes the header.
+  """
+  print(("\n" if newline else "") + f"\033[{color}m{title}\033[0m", *values)
+  _diagnostics.append({'title': title, 'lines': [" ".join(str(value) for value in values)] if values else []})
+
+def note(*values):
+  """
+  Prints a diagnostic line and adds it to the current report section.
+  """
+  print(*values)
+  if not _diagnostics:
+    _diagnostics.append({'title': None, 'lines': []})
+  _diagnostics[-1]['lines'].append(" ".join(str(value) for value in values))
+
+def configure(report=None, profile=()):
+  """
+  Enables the instrumentation report, written when the process exits.
+
+  Args:
+    report (str): Path of the JSON report, or '-' for the terminal summary only. None disables the
+      report (timers and counters still run, they are cheap).
+    profile (iterable): Profilers to capture from now on: 'cprofile' and/or 'tracemalloc'.
+  """
+  profile = tuple(profile or ())
+  for name in profile:
+    if name not in PROFILERS:
+      raise ValueError(f"Unknown profiler '{name}', expected one of {PROFILERS}")
+
+  _settings['report'], _settings['profile'] = report, profile
+  _timers['startup'] = (1, time.perf_counter() - STARTED)
+
+  if 'tracemalloc' in profile:
+    import tracemalloc
+    tracemalloc.start()
+  if 'cprofile' in profile:
+    import cProfile
+    _settings['profiler'] = cProfile.Profile()
+    _settings['profiler'].enable()
+
+  if (report or profile) and not _settings['registered']:
+    _settings['registered'] = True
+    atexit.register(finish)
+
+def _profile_results() -> dict:
+  results = {}
+  profiler = _settings['profiler']
+  if profiler is not None:
+    import pstats
+
+    profiler.disable()
+    stats = pstats.Stats(profiler)
+    report = _settings['report']
+    if report and report != '-':
+      stats.dump_stats(os.path.splitext(report)[0] + '.prof')
+    top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:25]
+    results['cprofile'] = [
+      {'function': f'{file}:{line}({function})', 'calls': calls, 'own_seconds': own, 'cumulative_seconds': cumulative}
+      for (file, line, function), (_, calls, own, cumulative, _) in top
+    ]
+
+  if 'tracemalloc' in _settings['profile']:
+    import tracemalloc
+
+    if tracemalloc.is_tracing():
+      current, peak = tracemalloc.get_traced_memory()
+      top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+      tracemalloc.stop()
+      results['tracemalloc'] = {
+        'current_bytes': current,
+        'peak_bytes': peak,
+        'top': [{'location': str(stat.traceback), 'bytes': stat.size, 'count': stat.count} for stat in top],
+      }
+  return results
+
+def snapshot() -> dict:
+  """
+  dict: Current timers, counters and diagnostics, ready for JSON.
+  """
+  return {
+    'script': os.path.basename(sys.argv[0]),
+    'argv': sys.argv[1:],
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'wall_seconds': time.perf_counter() - STARTED,
+    'timers': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in _timers.items()},
+    'counters': dict(_counters),
+    'diagnostics': list(_diagnostics),
+  }
+
+def summary(report):
+  """
+  Prints the terminal summary of a report from `snapshot`.
+  """
+  print(f"\n\033[{HEADER}mInstrumentation report ({report['wall_seconds']:.3f} s):\033[0m")
+  for name, timing in sorted(report['timers'].items(), key=lambda item: -item[1]['seconds']):
+    print(f"  {name:<40} {timing['seconds']*1e3:10.3f} ms  ({timing['calls']} call{'s' * (timing['calls'] != 1)})")
+  for name, value in sorted(report['counters'].items()):
+    print(f"  {name:<40} {value:>13,}")
+
+  profile = report.get('profile', {})
+  if 'tracemalloc' in profile:
+    print(f"  {'tracemalloc peak':<40} {profile['tracemalloc']['peak_bytes']:>13,} bytes")
+  if 'cprofile' in profile:
+    print("  top functions (cumulative):")
+    for entry in profile['cprofile'][:10]:
+      print(f"    {entry['cumulative_seconds']*1e3:10.3f} ms  {entry['function']}")
+
+def finish():
+  """
+  Stops the profilers, writes the JSON report and prints the summary. Registered with atexit by
+  `configure`.
+  """
+  path = _settings['report']
+  if path and path != '-' and os.path.dirname(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+  report = snapshot()
+  report['profile'] = _profile_results()
+
+  if path and path != '-':
+    with open(path, 'w') as f:
+      json.dump(report, f, indent=2, default=str)
+
+  summary(report)
+  if path and path != '-':
+    print(f"\033[{RESULT}mReport written to:\033[0m", path)
@@ -0,0 +1,305 @@
+import numpy as np
+from helpers import instrument
+
+INTEGRATORS = ('euler', 'zoh', 'rk45')
+FIXED_STEP_INTEGRATORS = ('euler', 'zoh')
+
+# Step size the scripts have always used with forward Euler
+EULER_DT = .001
+
+# Matrix-vector products of one step of `make_step` and `make_observer_step` (for the instrumentation counters)
+STEP_MATMULS = {'euler': 2, 'zoh': 2}
+OBSERVER_STEP_MATMULS = {'euler': 4, 'zoh': 3}
+
+_discretized = {}
+
+def discretize(A, B, dt) -> tuple:
+  """
+  Computes the exact zero-order-hold discretization of x' = Ax + Bu.
+
+  The matrices are obtained from a single matrix exponential of the augmented matrix
+  [[A, B], [0, 0]] * dt, whose top blocks are Ad = expm(A*dt) and Bd = int_0^dt expm(A*s) ds @ B.
+  With them, x[k+1] = Ad @ x[k] + Bd @ u[k] is exact as long as u is constant over each step.
+
+  Stacked systems (P x n x n and P x n x m) are discretized together. Results are cached per
+  (A, B, dt), so each plant or closed-loop matrix is discretized only once.
+
+  Args:
+    A (np.ndarray): State matrix (n x n), or a stack of them (P x n x n).
+    B (np.ndarray): Input matrix (n x m), or a stack of them (P x n x m).
+    dt (float): Sampling period.
+
+  Returns:
+    tuple: (Ad, Bd) discrete state and input matrices.
+  """
+  A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+  key = (A.shape, B.shape, A.tobytes(), B.tobytes(), float(dt))
+  if key in _discretized:
+    return _discretized[key]
+
+  from scipy.linalg import expm
+
+  n, m = B.shape[-2:]
+  batch = np.broadcast_shapes(A.shape[:-2], B.shape[:-2])
+  M = np.zeros(batch + (n + m, n + m))
+  M[..., :n, :n] = A
+  M[..., :n, n:] = B
+  with instrument.timer('simulation/discretize'):
+    Md = expm(M * dt)
+
+  Ad, Bd = Md[..., :n, :n], Md[..., :n, n:]
+  _discretized[key] = (Ad, Bd)
+  return Ad, Bd
+
+def step_matrices(A, B, dt, integrator='euler') -> tuple:
+  """
+  Returns the (Ad, Bd) pair such that one step of the chosen integrator is x[k+1] = Ad @ x[k] + Bd @ u[k].
+
+  For forward Euler these are (I + A*dt, B*dt); for 'zoh' they come from `discretize`.
+  Stacked systems (P x n x n) are supported.
+
+  Args:
+    A (np.ndarray): State matrix (n x n), or a stack of them.
+    B (np.ndarray): Input matrix (n x m), or a stack of them.
+    dt (float): Integration step.
+    integrator (str): 'euler' or 'zoh'.
+
+  Returns:
+    tuple: (Ad, Bd) one-step state and input matrices.
+  """
+  if integrator == 'euler':
+    A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+    return np.eye(A.shape[-1]) + A*dt, B*dt
+
+  if integrator == 'zoh':
+    return discretize(A, B, dt)
+
+  raise ValueError(f"'{integrator}' is not a fixed-step integrator, expected one of {FIXED_STEP_INTEGRATORS}")
+
+def _block(rows) -> np.ndarray:
+  # np.block for stacked matrices: every block is broadcast over the leading (stack) dimensions
+  batch = np.broadcast_shapes(*(block.shape[:-2] for row in rows for block in row))
+  return np.concatenate([np.concatenate([np.broadcast_to(block, batch + block.shape[-2:]) for block in row], axis=-1)
+                         for row in rows], axis=-2)
+
+def loop_step_matrices(A, B, K, dt, integrator='euler', C=None, L=None, model=None) -> tuple:
+  """
+  Returns the one-step matrices (M, F) of a closed loop, z[k+1] = M @ z[k] + F @ e[k].
+
+  Without observer z = x and u = v - Kx, with the feedforward input v = Nr held over the step as e.
+  With the Luenberger observer x_est' = Am x_est + Bm u + L (Cx + noise - C x_est) of the model
+  (Am, Bm) (the plant itself by default), z = [x; x_est], u = v - K x_est, the plant receives u + w,
+  and e = [v; w; noise] stacks the feedforward input (m), a process disturbance (m) and the measurement
+  noise (p), all held over the step. The columns of F follow that order.
+
+  'euler' gives the forward Euler step of the continuous closed loop. 'zoh' discretizes the continuous
+  closed loop exactly (`discretize`), so u follows the state within the step as in the continuous
+  design: only the exogenous inputs are held. (Stepping the plant alone with u held, as `make_step`
+  does, would instead be a sampled-data controller, whose error grows with dt.)
+
+  Stacked systems (P x n x n, with K, L and the model stacked or shared) are supported.
+
+  Args:
+    A, B (np.ndarray): Plant matrices, (n x n) and (n x m) or stacked.
+    K (np.ndarray): State feedback (m x n).
+    dt (float): Step.
+    integrator (str): 'euler' or 'zoh'.
+    C, L (np.ndarray): Measured output matrix (p x n) and observer gain (n x p), for the loop with observer.
+    model (tuple): (Am, Bm) of the observer, when it differs from the plant.
+
+  Returns:
+    tuple: (M, F), of shapes (n x n) and (n x m) without observer, (2n x 2n) and (2n x (2m + p)) with it.
+  """
+  A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+  K = np.atleast_2d(np.asarray(K, dtype=float))
+  n, m = B.shape[-2:]
+  BK = B @ K
+  if L is None:
+    Acl, Bcl = A - BK, B
+  else:
+    Am, Bm = (A, B) if model is None else (np.asarray(matrix, dtype=float) for matrix in model)
+    LC = L @ C
+    Acl = _block([[A, -BK], [LC, Am - LC - Bm @ K]])
+    Bcl = _block([[B, B, np.zeros((n, L.shape[-1]))], [Bm, np.zeros((n, m)), L]])
+
+  if integrator == 'euler':
+    return np.eye(Acl.shape[-1]) + Acl*dt, Bcl*dt
+
+  if integrator == 'zoh':
+    return discretize(Acl, Bcl, dt)
+
+  raise ValueError(f"'{integrator}' is not a fixed-step integrator, expected one of {FIXED_STEP_INTEGRATORS}")
+
+def make_feedback_step(A, B, K, dt, integrator='euler'):
+  """
+  Builds the one-step propagation function of the state feedback loop u = v - Kx (scripts 2 and 3).
+
+  'euler' steps the plant with u held over the step, as `make_step`. 'zoh' steps the exact
+  discretization of the closed loop (see `loop_step_matrices`), where only v = Nr is held.
+
+  Args:
+    A, B (np.ndarray): Plant matrices.
+    K (np.ndarray): State feedback (m x n).
+    dt (float): Integration step.
+    integrator (str): 'euler' or 'zoh'.
+
+  Returns:
+    callable: step(x, u, v) returning the state after one step, from the input u = v - Kx applied at
+    its start and the feedforward input v.
+  """
+  if integrator == 'euler':
+    return lambda x, u, v: x + (np.dot(A,x)+np.dot(B,u))*dt
+
+  if integrator == 'zoh':
+    M, F = loop_step_matrices(A, B, K, dt, integrator)
+    return lambda x, u, v: M@x + F@v
+
+  raise ValueError(f"'{integrator}' is not a fixed-step integrator, expected one of {FIXED_STEP_INTEGRATORS}")
+
+def make_step(A, B, dt, integrator='euler'):
+  """
+  Builds the one-step propagation function for x' = Ax + Bu, with u held over the step (exact for
+  'zoh' in open loop; closed loops are discretized with `make_feedback_step` or `loop_step_matrices`).
+
+  Args:
+    A (np.ndarray): State matrix (n x n).
+    B (np.ndarray): Input matrix (n x m).
+    dt (float): Integration step.
+    integrator (str): 'euler' for forward Euler or 'zoh' for the exact zero-order-hold discretization.
+
+  Returns:
+    callable: step(x, u) returning the state after one step of size dt.
+  """
+  if integrator == 'euler':
+    return lambda x, u: x + (np.dot(A,x)+np.dot(B,u))*dt
+
+  if integrator == 'zoh':
+    Ad, Bd = discretize(A, B, dt)
+    return lambda x, u: Ad@x + Bd@u
+
+  raise ValueError(f"'{integrator}' is not a fixed-step integrator, expected one of {FIXED_STEP_INTEGRATORS}")
+
+def make_observer_step(A, B, C, L, dt, integrator='euler'):
+  """
+  Builds the one-step propagation function for the Luenberger observer
+  x_est' = A x_est + B u + L (y - C x_est).
+
+  For the zero-order-hold mode the observer is discretized as the closed-loop matrix (A - LC)
+  driven by both u and the measurement y, which are held constant over the step (a sampled-data
+  observer; the exact loop with the plant is `loop_step_matrices`).
+
+  Args:
+    A (np.ndarray): State matrix (n x n).
+    B (np.ndarray): Input matrix (n x m).
+    C (np.ndarray): Measured output matrix (p x n).
+    L (np.ndarray): Observer gain (n x p).
+    dt (float): Integration step.
+    integrator (str): 'euler' or 'zoh'.
+
+  Returns:
+    callable: step(x_est, u, y) returning the estimate after one step of size dt.
+  """
+  if integrator == 'euler':
+    return lambda x_est, u, y: x_est + (np.dot(A,x_est)+np.dot(B,u)+L@(y-C@x_est))*dt
+
+  if integrator == 'zoh':
+    m = B.shape[1]
+    Ad, Bd = discretize(A - L@C, np.hstack((B, L)), dt)
+    Bd_u, Bd_y = Bd[:, :m], Bd[:, m:]
+    return lambda x_est, u, y: Ad@x_est + Bd_u@u + Bd_y@y
+
+  raise ValueError(f"'{integrator}' is not a fixed-step integrator, expected one of {FIXED_STEP_INTEGRATORS}")
+
+def solve_adaptive(f, x0, t0, tf, dt, rtol=1e-6, atol=1e-9) -> tuple:
+  """
+  Integrates x' = f(t, x) with the embedded Dormand-Prince 5(4) pair (scipy's RK45), whose step size
+  follows the local error estimate: small steps in the fast transients, large ones in the settled tail.
+
+  The dense output of the solver is sampled at uniform times t0 + k*dt, so the result can be plotted
+  and compared like the fixed-step runs.
+
+  Args:
+    f (callable): Closed-loop dynamics f(t, x) for a 1-D state x.
+    x0 (np.ndarray): Initial state (n or n x 1).
+    t0 (float): Initial time.
+    tf (float): Final time.
+    dt (float): Spacing of the uniform output samples (does not constrain the solver steps).
+    rtol (float): Relative tolerance.
+    atol (float | np.ndarray): Absolute tolerance, scalar or per state.
+
+  Returns:
+    tuple: (T, X, stats) with T the uniform times (samples,), X the states (n x samples) and stats a
+    dict with the accepted steps, function evaluations and step sizes taken.
+  """
+  from scipy.integrate import solve_ivp
+
+  solution = solve_ivp(f, (t0, tf), np.ravel(x0).astype(float), method='RK45', rtol=rtol, atol=atol,
+                       dense_output=True)
+  if not solution.success:
+    raise RuntimeError(f"Adaptive integration failed: {solution.message}")
+
+  num_steps = int((tf-t0)/dt)
+  T = t0 + dt*np.arange(num_steps + 1)
+  steps = np.diff(solution.t)
+  stats = {
+    'accepted_steps': steps.shape[0],
+    'function_evaluations': solution.nfev,
+    'min_step': steps.min(),
+    'max_step': steps.max(),
+    'fixed_steps': num_steps,
+  }
+
+  instrument.count('steps', stats['accepted_steps'])
+  instrument.count('function_evaluations', stats['function_evaluations'])
+  instrument.section("Adaptive integration (Dormand-Prince RK45):")
+  instrument.note(f"accepted steps: {stats['accepted_steps']} (fixed step dt={dt}: {num_steps}) | "
+                  f"function evaluations: {stats['function_evaluations']} | "
+                  f"step size: {stats['min_step']:.2e} .. {stats['max_step']:.2e} s")
+
+  return T, solution.sol(T), stats
+
+def prepare(integrator, A, B, dt, C=None, L=None, K=None) -> float:
+  """
+  Does the one-off work of an integrator before its run is timed: the scipy import and, for 'zoh', the
+  discretizations of the plant, of the observer and of the closed loop (cached by `discretize`). The
+  timed run then only measures the stepping, like the Euler baseline of `report_speedup`.
+
+  Args:
+    integrator (str): 'euler', 'zoh' or 'rk45'.
+    A, B (np.ndarray): Plant matrices.
+    dt (float): Integration step.
+    C, L (np.ndarray): Measured output matrix and observer gain, when the run has an observer.
+    K (np.ndarray): State feedback, when the run is a closed loop.
+
+  Returns:
+    float: Wall time (s) of the setup.
+  """
+  with instrument.timer('simulation/prepare') as timing:
+    if integrator == 'zoh':
+      step_matrices(A, B, dt, integrator)
+      if L is not None:
+        make_observer_step(A, B, C, L, dt, integrator)
+      if K is not None:
+        loop_step_matrices(A, B, K, dt, integrator, C, L)
+    elif integrator == 'rk45':
+      import scipy.integrate
+  return timing.elapsed
+
+def report_speedup(simulate, elapsed, final_x, setup=0):
+  """
+  Re-runs a simulation with the forward Euler baseline and prints the speedup obtained.
+
+  Args:
+    simulate (callable): simulate(integrator, dt) running the script's loop and returning the final state.
+    elapsed (float): Wall time (s) of the run being compared, without its setup (see `prepare`).
+    final_x (np.ndarray): Final state of the run being compared.
+    setup (float): Wall time (s) of its one-off setup, reported apart.
+  """
+  with instrument.timer('simulation/euler_baseline') as timing:
+    baseline_x = simulate('euler', EULER_DT)
+  baseline_elapsed = timing.elapsed
+
+  instrument.section("Speedup against Euler baseline:")
+  instrument.note(f"euler (dt={EULER_DT}): {baseline_elapsed:.4f} s | this run: {elapsed:.4f} s "
+                  f"(+ {setup:.4f} s setup) | speedup: {baseline_elapsed / elapsed:.1f}x")
+  instrument.note("x - x_euler at tf:", np.ravel(np.asarray(final_x) - baseline_x))
@@ -0,0 +1,159 @@
+import os
+from multiprocessing import shared_memory
+import numpy as np
+from helpers.integrator import loop_step_matrices
+from helpers.pool import count_work, process_pool
+from helpers.sweep import PARAMETERS, build_system
+
+# Series recorded for every run, at the decimated sample times
+SERIES = ('estimation_error', 'tracking_error')
+# Scalars recorded for every run
+SCALARS = ('estimation_error_rms', 'final_tracking_error', 'peak_flow')
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Shared-memory views of the worker processes, set by `_attach`
+_shared = {}
+
+def _attach(names, shapes):
+  # Pool initializer: map the result arrays created by the parent once per worker
+  for key, name in names.items():
+    block = shared_memory.SharedMemory(name=name)
+    _shared[key] = (block, np.ndarray(shapes[key], dtype=float, buffer=block.buf))
+
+def _run_block(task):
+  """
+  Simulates one block of runs, vectorized over the runs, and writes its rows of the shared results.
+  The randomness of a block only depends on its own seed, so results do not depend on how the blocks
+  are spread over the workers.
+  """
+  (first, last, seed, nominal, C, K, N, L, r, x_est0, uncertainty, noise_std, initial_ranges,
+   tf, dt, integrator, record_every) = task
+  rng = np.random.default_rng(seed)
+  b, n = last - first, C.shape[1]
+
+  # True plants: every physical constant perturbed uniformly within +-uncertainty
+  parameters = {name: nominal[name] * rng.uniform(1 - uncertainty, 1 + uncertainty, b) for name in PARAMETERS}
+  A, B = build_system(**parameters)
+
+  # Random initial conditions; the tank pressure balances the spring force (P = kx/A)
+  (position_low, position_high), (speed_low, speed_high) = initial_ranges
+  x = np.zeros((b, n))
+  x[:, 0] = rng.uniform(position_low, position_high, b)
+  x[:, 1] = rng.uniform(speed_low, speed_high, b)
+  x[:, 2] = parameters['spring_constant'] * x[:, 0] / nominal['pipe_section_area']
+
+  # Plant (true parameters) and observer (nominal model) advanced together as z = [x; x_est]:
+  # u = Nr - K x_est, z <- M z + F_r Nr + F_v v, with v the noise on y = Cx (see `loop_step_matrices`)
+  M, F = loop_step_matrices(A, B, K, dt, integrator, C, L, model=(nominal['A'], nominal['B']))
+  offset = (F[..., :1] @ N)[:, :, 0] * r
+  # The measurement noise, held over the step, enters through the observer gain (last column of F)
+  noise_gain = F[:, :, -1]
+  Nr = (N * r)[0, 0]
+
+  z = np.empty((b, 2*n))
+  z[:, :n] = x
+  z[:, n:] = x_est0
+
+  series = {key: _shared[key][1] for key in SERIES}
+  scalars = {key: _shared[key][1] for key in SCALARS}
+  squared_error = np.zeros(b)
+  peak_flow = np.zeros(b)
+
+  num_steps = int(tf/dt)
+  series['estimation_error'][first:last, 0] = z[:, 0] - z[:, n]
+  series['tracking_error'][first:last, 0] = z[:, 0] - r
+  for i in range(num_steps):
+    u = Nr - z[:, n:] @ K[0]
+    noise = rng.normal(0, noise_std, b)
+    z = np.einsum('pij,pj->pi', M, z) + offset + noise[:, None] * noise_gain
+
+    estimation_error = z[:, 0] - z[:, n]
+    squared_error += estimation_error**2
+    np.maximum(peak_flow, np.abs(u), out=peak_flow)
+    if (i + 1) % record_every == 0:
+      k = (i + 1) // record_every
+      series['estimation_error'][first:last, k] = estimation_error
+      series['tracking_error'][first:last, k] = z[:, 0] - r
+
+  scalars['estimation_error_rms'][first:last] = np.sqrt(squared_error / max(num_steps, 1))
+  scalars['final_tracking_error'][first:last] = z[:, 0] - r
+  scalars['peak_flow'][first:last] = peak_flow
+  return last - first
+
+def run_monte_carlo(nominal, C, K, N, L, r, x_est0, runs=1000, tf=15, dt=.01, integrator='zoh', uncertainty=.1,
+                    noise_std=.01, initial_ranges=((1, 3), (-2, 2)), seed=0, workers=None, block_size=64,
+                    record_every=10) -> dict:
+  """
+  Runs a Monte Carlo study of the closed loop with observer (script 4) over a process pool.
+
+  Every run draws its own physical constants (uniformly within +-`uncertainty` of the nominal ones),
+  initial mass position and speed, and Gaussian noise on the position measurement y = Cx. K, N and L
+  are the gains designed for the nominal plant. Runs are split in blocks of `block_size`, each seeded
+  from its own child of a SeedSequence(seed), so the results are reproducible whatever the number of
+  workers. Workers write their rows straight into shared-memory result arrays, and only the block
+  size is sent back.
+
+  Args:
+    nominal (dict): Nominal physical constants (see `helpers.sweep.PARAMETERS`), `pipe_section_area`
+      and the nominal plant matrices 'A' and 'B'.
+    C (np.ndarray): Measured output matrix (1 x n).
+    K, N, L (np.ndarray): Gains designed for the nominal plant.
+    r (float): Mass position reference.
+    x_est0 (np.ndarray): Initial estimate shared by every run (n,).
+    runs (int): Number of runs.
+    tf, dt (float): Horizon and integration step.
+    integrator (str): 'euler' or 'zoh' (exact closed-loop discretization).
+    uncertainty (float): Relative half-width of the physical constant perturbations.
+    noise_std (float): Standard deviation of the measurement noise (m).
+    initial_ranges (tuple): ((low, high) mass position, (low, high) mass speed) of the initial state.
+    seed (int): Root seed.
+    workers (int): Worker processes (defaults to the number of CPUs).
+    block_size (int): Runs per task.
+    record_every (int): Decimation of the recorded series.
+
+  Returns:
+    dict: 'T' (samples,), the per-run series (runs x samples) and scalars (runs,), and 'bands' with the
+    percentiles (`PERCENTILES`) of every series over the runs (len(PERCENTILES) x samples).
+  """
+  workers = workers or os.cpu_count()
+  num_steps = int(tf/dt)
+  samples = num_steps // record_every + 1
+  shapes = {key: (runs, samples) for key in SERIES}
+  shapes.update({key: (runs,) for key in SCALARS})
+
+  blocks = {key: shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+            for key, shape in shapes.items()}
+  try:
+    names = {key: block.name for key, block in blocks.items()}
+    K, N = np.atleast_2d(K), np.atleast_2d(N)
+    x_est0 = np.ravel(x_est0).astype(float)
+    seeds = np.random.SeedSequence(seed).spawn(-(-runs // block_size))
+    tasks = [(first, min(first + block_size, runs), seeds[i], nominal, C, K, N, L, r, x_est0, uncertainty,
+              noise_std, initial_ranges, tf, dt, integrator, record_every)
+             for i, first in enumerate(range(0, runs, block_size))]
+
+    if workers == 1:
+      _attach(names, shapes)
+      for task in tasks:
+        _run_block(task)
+    else:
+      with process_pool(workers, _attach, (names, shapes)) as pool:
+        for _ in pool.map(_run_block, tasks):
+          pass
+
+    results = {key: np.ndarray(shape, dtype=float, buffer=blocks[key].buf).copy() for key, shape in shapes.items()}
+  finally:
+    for key in list(_shared):
+      block, array = _shared.pop(key)
+      del array
+      block.close()
+    for block in blocks.values():
+      block.close()
+      block.unlink()
+
+  count_work(num_steps * runs, 2 * num_steps * runs)
+
+  results['T'] = np.arange(samples) * dt * record_every
+  results['bands'] = {key: np.percentile(results[key], PERCENTILES, axis=0) for key in SERIES}
+  return results
@@ -0,0 +1,153 @@
+import math
+import numpy as np
+from helpers import instrument
+from helpers.control import ackermann, desired_poles
+from helpers.integrator import discretize, step_matrices
+from helpers.recorder import Recorder
+
+def _ratio(period, dt, name) -> int:
+  # Number of plant steps in a period, which must be a whole multiple of the plant step
+  ratio = int(round(period / dt))
+  if ratio < 1 or abs(ratio*dt - period) > 1e-9 * max(period, dt):
+    raise ValueError(f"The {name} period ({period} s) must be a multiple of the plant step ({dt} s)")
+  return ratio
+
+@instrument.timer('design/discrete_gains')
+def discrete_gains(A, B, C, D, period, controller_poles_gain=10, observer_poles_gain=20) -> dict:
+  """
+  Redesigns K, N and L for a controller running every `period` seconds on the zero-order-hold
+  discretization (Ad, Bd) of the plant. The continuous poles of `helpers.control.desired_poles` are
+  mapped to z = exp(s * period), so the sampled loop keeps the dynamics of the continuous design.
+
+  Args:
+    A, B (np.ndarray): Plant matrices (n x n), (n x 1).
+    C (np.ndarray): Measured output matrix (1 x n).
+    D (np.ndarray): Feedthrough matrix (1 x 1).
+    period (float): Controller sample period (s).
+    controller_poles_gain (float): `poles_gain` of K.
+    observer_poles_gain (float): `poles_gain` of L.
+
+  Returns:
+    dict: 'Ad', 'Bd', and the discrete gains 'K' (1 x n), 'N' (1 x 1) and 'L' (n x 1) of the predictor
+    observer x_est[k+1] = Ad x_est[k] + Bd u[k] + L (y[k] - C x_est[k]).
+  """
+  Ad, Bd = discretize(A, B, period)
+  n = A.shape[0]
+
+  K = ackermann(Ad, Bd, np.exp(desired_poles(A, controller_poles_gain) * period))
+  # Observer by duality: L^T places the poles of (Ad^T - C^T L^T)
+  L = ackermann(Ad.T, C.T, np.exp(desired_poles(A, observer_poles_gain) * period)).T
+
+  # Reference gain of the sampled loop: at steady state x = Ad x + Bd u and y = Cx, so
+  # [Nx; Nu] = inv([[Ad - I, Bd], [C, D]]) @ [0; I]
+  extended_matrix = np.block([[Ad - np.eye(n), Bd], [C, D]])
+  extended_state_matrix = np.zeros((n + 1, 1))
+  extended_state_matrix[n, 0] = 1
+  Nx_Nu = np.linalg.solve(extended_matrix, extended_state_matrix)
+  N = Nx_Nu[n:] + K @ Nx_Nu[:n]
+
+  return {'Ad': Ad, 'Bd': Bd, 'K': K, 'N': N, 'L': L}
+
+def simulate_multirate(A, B, x0, t0, tf, dt, control_period, K, N=None, r=None, C=None, L=None, x_est0=None,
+                       sample_period=None, u0=None, integrator='euler') -> Recorder:
+  """
+  Simulates a sampled controller on the continuous plant with three rates:
+
+    - the plant is integrated every `dt` (the only work done at the fine rate, as one stacked product for
+      all the plant steps between two sensor or controller events),
+    - the sensor samples y = Cx (x itself without observer) every `sample_period`, held in between,
+    - the controller (and observer) updates every `control_period`, from the last held sample, and its
+      u is held (zero-order hold) until the next update.
+
+  The control laws follow the scripts: u = -Kx (script 2), u = Nr - Kx (script 3), and u = Nr - K x_est
+  with the predictor observer of `discrete_gains` when L is given (script 4). The gains must be designed
+  for `control_period` (see `discrete_gains`).
+
+  Args:
+    A, B (np.ndarray): Plant matrices.
+    x0 (np.ndarray): Initial state (n x 1).
+    t0, tf, dt (float): Initial time, final time and plant integration step.
+    control_period (float): Controller period, a multiple of dt.
+    K, N, L (np.ndarray): Discrete gains (N and L optional).
+    r (np.ndarray): Reference (m x 1), required with N.
+    C (np.ndarray): Measured output matrix, required with L.
+    x_est0 (np.ndarray): Initial estimate, required with L.
+    sample_period (float): Sensor period, a multiple of dt not shorter than control_period (defaults to it).
+    u0 (np.ndarray): Input recorded with the initial sample (defaults to zero).
+    integrator (str): 'euler' or 'zoh', for the plant only.
+
+  Returns:
+    Recorder: Trajectories 'X', 'U' and, with the observer, 'X_est', sampled every dt.
+  """
+  n, m = B.shape
+  control_ratio = _ratio(control_period, dt, 'controller')
+  sample_ratio = _ratio(control_period if sample_period is None else sample_period, dt, 'sample')
+  if sample_ratio < control_ratio:
+    # Samples between two controller updates would never be read
+    raise ValueError(f"The sample period ({sample_period} s) cannot be shorter than the controller period "
+                     f"({control_period} s)")
+  observe = L is not None
+
+  K = np.atleast_2d(K)
+  Nr = np.zeros((m, 1)) if N is None else np.atleast_2d(N)@r
+  x = np.asarray(x0, dtype=float).reshape(n, 1)
+  u = np.zeros((m, 1)) if u0 is None else np.asarray(u0, dtype=float).reshape(m, 1)
+  series = {'X': x, 'U': u}
+  if observe:
+    Ad, Bd = discretize(A, B, control_period)
+    x_est = np.asarray(x_est0, dtype=float).reshape(n, 1)
+    series['X_est'] = x_est
+
+  # The sensor and the controller only act at multiples of `block` plant steps, and u is constant within a
+  # block, so the plant samples of a whole block come from one product with the stacked step powers:
+  # x[j] = Ad^j x + (Ad^(j-1) + ... + I) Bd u, j = 1..block
+  block = math.gcd(control_ratio, sample_ratio)
+  Ad_fine, Bd_fine = step_matrices(A, B, dt, integrator)
+  powers, inputs = np.empty((block, n, n)), np.empty((block, n, m))
+  power, input_sum = np.eye(n), np.zeros((n, m))
+  for j in range(block):
+    power, input_sum = Ad_fine@power, Ad_fine@input_sum + Bd_fine
+    powers[j], inputs[j] = power, input_sum
+  propagator = np.concatenate((powers, inputs), axis=2).reshape(block*n, n + m)
+
+  num_steps = int((tf-t0)/dt)
+  recorder = Recorder(t0, num_steps, **series)
+
+  updates = blocks = 0
+  for i in range(0, num_steps, block):
+    if i % sample_ratio == 0:
+      sample = C@x if observe else x
+
+    if i % control_ratio == 0:
+      if observe:
+        u = Nr - K@x_est
+        x_est = Ad@x_est + Bd@u + L@(sample - C@x_est)
+      else:
+        u = Nr - K@sample
+      updates += 1
+
+    k = min(block, num_steps - i)
+    X_block = (propagator[:k*n] @ np.concatenate((x[:, 0], u[:, 0]))).reshape(k, n).T
+    x = X_block[:, -1:]
+    blocks += 1
+
+    T_block = t0 + dt*np.arange(i + 1, i + k + 1)
+    if observe:
+      recorder.extend(T_block, X=X_block, U=np.broadcast_to(u, (m, k)), X_est=np.broadcast_to(x_est, (n, k)))
+    else:
+      recorder.extend(T_block, X=X_block, U=np.broadcast_to(u, (m, k)))
+
+  # One block product per block, and K@x (with the observer, its three products and y = Cx) per update
+  instrument.count('steps', num_steps)
+  instrument.count('controller_updates', updates)
+  instrument.count('matmuls', blocks + updates * (1 + 4*observe))
+  return recorder
+
+def report(control_period, sample_period, dt):
+  """
+  Prints the three rates of a multirate run and how many controller updates it saves.
+  """
+  sample_period = control_period if sample_period is None else sample_period
+  instrument.section("Multirate control:", f"plant every {dt:g} s, sensor every {sample_period:g} s, "
+                     f"controller every {control_period:g} s ({_ratio(control_period, dt, 'controller')}x fewer "
+                     f"controller updates)", newline=False)
@@ -0,0 +1,167 @@
+from collections import namedtuple
+import numpy as np
+from helpers import instrument
+from helpers.plant import DEFAULTS
+from helpers.sweep import build_system
+
+# States of one stage, in the order of `helpers.sweep.build_system`
+STAGE_STATES = 3
+
+COUPLING_KINDS = ('spring', 'damper', 'pipe')
+
+Coupling = namedtuple('Coupling', ['first', 'second', 'kind', 'gain'])
+Coupling.__doc__ = """
+Link between two stages of a network: a 'spring' (N/m) or a 'damper' (Ns/m) between their masses, or a
+'pipe' between their tanks, carrying a flow gain * (P_first - P_second) (m^3/(s Pa)).
+"""
+
+def chain(num_stages, kind='pipe', gain=1e-9) -> list:
+  """
+  Couplings of a chain: stage i is linked to stage i + 1.
+
+  Args:
+    num_stages (int): Number of stages.
+    kind (str): Coupling kind, see `Coupling`.
+    gain (float | np.ndarray): Gain of every link, or (num_stages - 1,) gains.
+
+  Returns:
+    list: num_stages - 1 Couplings.
+  """
+  gains = np.broadcast_to(np.asarray(gain, dtype=float), (max(num_stages - 1, 0),))
+  return [Coupling(i, i + 1, kind, gains[i]) for i in range(num_stages - 1)]
+
+def stage_blocks(num_stages, **parameters) -> tuple:
+  """
+  State-space blocks of every stage, without couplings.
+
+  Args:
+    num_stages (int): Number of stages.
+    **parameters (float | np.ndarray): Physical constants overriding `helpers.plant.DEFAULTS`, scalars
+      or (num_stages,) arrays (pipe_section_area and gravity are shared by all stages).
+
+  Returns:
+    tuple: Stacked (A, B) blocks with shapes (N, 3, 3) and (N, 3, 1).
+  """
+  unknown = set(parameters) - set(DEFAULTS)
+  if unknown:
+    raise TypeError(f"Unknown plant parameters: {', '.join(sorted(unknown))}")
+  parameters = {**DEFAULTS, **parameters}
+  pipe_section_area, gravity = parameters.pop('pipe_section_area'), parameters.pop('gravity')
+  return build_system(
+    **{name: np.broadcast_to(np.asarray(value, dtype=float), (num_stages,)) for name, value in parameters.items()},
+    pipe_section_area=pipe_section_area, gravity=gravity)
+
+@instrument.timer('network/build')
+def build_network(num_stages, couplings=(), **parameters) -> tuple:
+  """
+  Composes `num_stages` mass-spring-damper + pipe + tank modules, joined by `couplings`, into one sparse
+  state-space system. Stage i owns the states 3i..3i+2 (mass position, mass speed, tank pressure) and
+  the input i (its own flow rate).
+
+  Every stage block comes from `stage_blocks`, so each stage can have its own physical constants. The
+  matrices are assembled directly in CSR form: their size is linear in the number of stages and
+  couplings.
+
+  Args:
+    num_stages (int): Number of stages.
+    couplings (iterable): Couplings between stages (see `Coupling` and `chain`).
+    **parameters (float | np.ndarray): Physical constants of the stages (see `stage_blocks`).
+
+  Returns:
+    tuple: (A, B) as scipy.sparse CSR matrices of shapes (3N x 3N) and (3N x N).
+  """
+  from scipy import sparse
+
+  blocks_A, blocks_B = stage_blocks(num_stages, **parameters)
+  pipe_section_area = parameters.get('pipe_section_area', DEFAULTS['pipe_section_area'])
+
+  # Stage blocks: nonzeros of the (N, 3, 3) stack, shifted to their diagonal position
+  stage, row, column = np.nonzero(blocks_A)
+  rows, columns, values = [STAGE_STATES*stage + row], [STAGE_STATES*stage + column], [blocks_A[stage, row, column]]
+
+  # The mass rows are divided by the effective mass over the piston area (A[1, 2] = 1/_A), and the tank
+  # pressure grows with the flow by rho*g/tank_area (B[2, 0])
+  inverse_mass = blocks_A[:, 1, 2] / pipe_section_area
+  pressure_gain = blocks_B[:, 2, 0]
+  for coupling in couplings:
+    if coupling.kind not in COUPLING_KINDS:
+      raise ValueError(f"Unknown coupling kind '{coupling.kind}', expected one of {COUPLING_KINDS}")
+    i, j, gain = coupling.first, coupling.second, float(coupling.gain)
+
+    # Rows of each stage affected by the link, the coupled state, and the coefficient of each row
+    if coupling.kind == 'pipe':
+      row, state, coefficients = 2, 2, (pressure_gain[i]*gain, pressure_gain[j]*gain)
+    else:
+      row, state = 1, 0 if coupling.kind == 'spring' else 1
+      coefficients = (inverse_mass[i]*gain, inverse_mass[j]*gain)
+
+    # first: -c_i (s_i - s_j), second: -c_j (s_j - s_i)
+    for stage_a, stage_b, coefficient in ((i, j, coefficients[0]), (j, i, coefficients[1])):
+      rows.append([STAGE_STATES*stage_a + row] * 2)
+      columns.append([STAGE_STATES*stage_a + state, STAGE_STATES*stage_b + state])
+      values.append([-coefficient, coefficient])
+
+  n = STAGE_STATES * num_stages
+  A = sparse.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))), shape=(n, n))
+  B = sparse.coo_matrix((pressure_gain, (STAGE_STATES*np.arange(num_stages) + 2, np.arange(num_stages))),
+                        shape=(n, num_stages))
+  # Duplicate entries (several links on one stage) are summed by the conversion
+  return A.tocsr(), B.tocsr()
+
+def decentralized_gain(K) -> object:
+  """
+  Block-diagonal state feedback from per-stage gains: u_i = -K_i x_i.
+
+  Args:
+    K (np.ndarray): Stacked stage gains (N x 1 x 3), e.g. from `helpers.sweep.design_gains`.
+
+  Returns:
+    scipy.sparse.csr_matrix: (N x 3N) gain.
+  """
+  from scipy import sparse
+
+  num_stages = K.shape[0]
+  rows = np.repeat(np.arange(num_stages), STAGE_STATES)
+  columns = np.arange(STAGE_STATES * num_stages)
+  return sparse.csr_matrix((np.reshape(K, -1), (rows, columns)), shape=(num_stages, STAGE_STATES * num_stages))
+
+@instrument.timer('network/simulate')
+def simulate_network(A, B, x0, t0, tf, dt, u=None, K=None, every=1) -> tuple:
+  """
+  Simulates x' = Ax + Bu with u = u0 - Kx (u0 = `u`, K optional) by forward Euler, the loop folded into
+  one sparse one-step matrix, so every step is a single sparse matrix-vector product (its cost and
+  memory are linear in the number of stages).
+
+  Args:
+    A, B (scipy.sparse matrix): Network matrices from `build_network`.
+    x0 (np.ndarray): Initial state (3N,).
+    t0, tf, dt (float): Initial time, final time and integration step.
+    u (np.ndarray): Constant input (N,), defaults to zero flow.
+    K (scipy.sparse matrix): State feedback (N x 3N), e.g. from `decentralized_gain`.
+    every (int): Decimation of the recorded trajectory.
+
+  Returns:
+    tuple: (T, X) with T (samples,) and X (3N x samples), column-major.
+  """
+  from scipy import sparse
+
+  n, m = B.shape
+  closed_loop = A if K is None else A - B @ K
+  step = (sparse.identity(n, format='csr') + dt*closed_loop).tocsr()
+  offset = np.zeros(n) if u is None else dt * (B @ np.asarray(u, dtype=float))
+
+  num_steps = int((tf-t0)/dt)
+  samples = num_steps // every + 1
+  X = np.empty((n, samples), order='F')
+  x = np.asarray(x0, dtype=float).reshape(n)
+  X[:, 0] = x
+  instrument.count('allocated_bytes', X.nbytes)
+
+  for i in range(num_steps):
+    x = step @ x + offset
+    if (i + 1) % every == 0:
+      X[:, (i + 1) // every] = x
+
+  instrument.count('steps', num_steps)
+  instrument.count('matmuls', num_steps)
+  return t0 + dt * every * np.arange(samples), X
@@ -0,0 +1,84 @@
+import argparse
+import os
+from helpers import instrument, plotting
+from helpers.integrator import INTEGRATORS, EULER_DT
+
+def make_parser(description=None, **defaults) -> argparse.ArgumentParser:
+  """
+  Builds the command line parser shared by the simulation scripts.
+
+  Args:
+    description (str): Text shown by --help.
+    **defaults: Script specific defaults overriding the shared ones (e.g. integrator='zoh').
+
+  Returns:
+    argparse.ArgumentParser: Parser with the shared options, ready for script specific additions.
+  """
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('--integrator', choices=INTEGRATORS, default='euler',
+                      help="'euler' (forward Euler), 'zoh' (exact zero-order-hold discretization of the closed loop) "
+                           "or 'rk45' (adaptive Dormand-Prince)")
+  parser.add_argument('--tf', type=float, default=None, help='simulation horizon (s)')
+  parser.add_argument('--dt', type=float, default=EULER_DT,
+                      help='integration step (s); output sample spacing for rk45')
+  parser.add_argument('--rtol', type=float, default=1e-6, help='relative tolerance of rk45')
+  parser.add_argument('--atol', type=float, default=1e-9, help='absolute tolerance of rk45')
+  parser.add_argument('--plot', choices=plotting.PLOT_MODES, default=os.environ.get('SIM_PLOT', 'show'),
+                      help="'show' (interactive), 'save' (PNG files, no display needed) or 'none' (default: $SIM_PLOT or show)")
+  parser.add_argument('--plot-dir', default='figures', help="directory of the figures written by --plot save")
+  parser.add_argument('--plot-format', choices=plotting.PLOT_FORMATS, default='png', help="file format of --plot save")
+  parser.add_argument('--plot-points', type=int, default=2000,
+                      help='point budget per plotted series, downsampled to keep its shape (0: plot every sample)')
+  parser.add_argument('--downsample', choices=plotting.DOWNSAMPLING_METHODS, default='minmax',
+                      help="'minmax' (extremes of every bin) or 'lttb' (Largest-Triangle-Three-Buckets)")
+  parser.add_argument('--timings', action='store_true', help='report import and startup time')
+  parser.add_argument('--report', default=os.environ.get('SIM_REPORT') or None,
+                      help="write the instrumentation report (timers, counters, diagnostics) to this JSON file, "
+                           "or '-' for the terminal summary only (default: $SIM_REPORT)")
+  parser.add_argument('--profile', choices=instrument.PROFILERS, action='append',
+                      default=[name for name in os.environ.get('SIM_PROFILE', '').split(',') if name],
+                      help="capture a profile into the report: 'cprofile' and/or 'tracemalloc' "
+                           "(repeatable, default: $SIM_PROFILE, comma separated)")
+  parser.set_defaults(**defaults)
+  return parser
+
+def add_multirate_options(parser):
+  """
+  Adds the options of the multirate mode (see `helpers.multirate`) to the parser of a closed-loop script.
+
+  Args:
+    parser (argparse.ArgumentParser): Parser from `make_parser`.
+  """
+  parser.add_argument('--control-period', type=float, default=None,
+                      help='run the controller (and observer) every this many seconds, a multiple of --dt, with '
+                           'gains redesigned for that period and u held in between (default: every plant step)')
+  parser.add_argument('--sample-period', type=float, default=None,
+                      help='sample the sensor every this many seconds, a multiple of --dt not shorter than '
+                           '--control-period (default: --control-period)')
+
+def parse_options(description=None, args=None, parser=None, **defaults) -> argparse.Namespace:
+  """
+  Parses the command line options shared by the simulation scripts and applies the plotting and
+  instrumentation settings.
+
+  Args:
+    description (str): Text shown by --help.
+    args (list): Arguments to parse. Defaults to sys.argv.
+    parser (argparse.ArgumentParser): Parser from `make_parser` with script specific additions.
+    **defaults: Script specific defaults overriding the shared ones.
+
+  Returns:
+    argparse.Namespace: Parsed options.
+  """
+  if parser is None:
+    parser = make_parser(description, **defaults)
+  options = parser.parse_args(args)
+  if getattr(options, 'sample_period', None) is not None:
+    # The controller only reads the last sample, so a faster sensor would change nothing
+    if not options.control_period:
+      parser.error("--sample-period needs --control-period")
+    if options.sample_period < options.control_period:
+      parser.error("--sample-period cannot be shorter than --control-period")
+  plotting.configure(options.plot, options.plot_dir, options.plot_points, options.downsample, options.plot_format)
+  instrument.configure(options.report, options.profile)
+  return options
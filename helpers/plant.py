@@ -0,0 +1,233 @@
+import functools
+import inspect
+import numpy as np
+from helpers import instrument
+from helpers.conditions import check_controllability, check_observability
+from helpers.control import calculate_K
+from helpers.estimator import calculate_L, calculate_kalman_L
+from helpers.integrator import step_matrices
+from helpers.reference import calculate_N
+from helpers.sweep import GRAVITY, PIPE_SECTION_AREA, build_system
+
+WATER_DENSITY = 1000
+MERCURY_DENSITY = 13546
+
+# Physical constants of the scripts
+DEFAULTS = {
+  'mass': 5,                              # kg
+  'spring_constant': 500,                 # N/m
+  'damping_constant': 40,                 # Ns/m
+  'fluid_density': MERCURY_DENSITY,       # kg/m^3
+  'tank_area': 0.05,                      # m^2 (0.005 is a 7cm x 7cm square tank)
+  'pipe_length': 10,                      # m
+  'pipe_section_area': PIPE_SECTION_AREA, # m^2, also the piston area
+  'gravity': GRAVITY,                     # m/s^2
+}
+
+def _hashable(value):
+  # Sequence arguments (e.g. outputs=[0] or an array) as nested tuples, so they can be part of a key
+  if isinstance(value, np.ndarray):
+    value = value.tolist()
+  if isinstance(value, (list, tuple)):
+    return tuple(_hashable(item) for item in value)
+  return value
+
+def _derived(*parameters, ignore=()):
+  """
+  Decorator caching a Plant artifact per call arguments. The cached value is dropped when one of the
+  physical `parameters` it depends on changes, so other artifacts survive. Arguments listed in
+  `ignore` (e.g. plot) do not take part in the key.
+  """
+  def decorator(method):
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+      bound = signature.bind(self, *args, **kwargs)
+      bound.apply_defaults()
+      key = (method.__name__,) + tuple((name, _hashable(value)) for name, value in bound.arguments.items()
+                                       if name != 'self' and name not in ignore)
+      if key not in self._cache:
+        instrument.count(f'plant/{method.__name__}')
+        self._cache[key] = (frozenset(parameters), method(self, *args, **kwargs))
+      return self._cache[key][1]
+    return wrapper
+  return decorator
+
+ALL = tuple(DEFAULTS)
+
+class Plant:
+  """
+  Mass-spring-damper coupled to a tank through a pipe (Ax'' + Bx' + Cx - P1 = 0, P1' = Dx' + EJ), built
+  from a set of physical constants.
+
+  Derived artifacts (state-space matrices, eigenvalues, controllability and observability, gains,
+  one-step matrices) are computed on first use and cached. Changing a constant (`update`, or assigning
+  the attribute) only drops the artifacts that depend on it: the input matrix B, for instance, survives
+  a change of mass.
+
+  Args:
+    **parameters: Physical constants overriding `DEFAULTS`.
+
+  Example:
+    plant = Plant(mass=6)
+    A, B = plant.A, plant.B
+    K = plant.K(poles_gain=10)
+    plant.mass = 7       # A, K, ... are recomputed on next use, B is kept
+  """
+
+  def __init__(self, **parameters):
+    unknown = set(parameters) - set(DEFAULTS)
+    if unknown:
+      raise TypeError(f"Unknown plant parameters: {', '.join(sorted(unknown))}")
+
+    object.__setattr__(self, '_parameters', {**DEFAULTS, **parameters})
+    object.__setattr__(self, '_cache', {})
+
+  def __getattr__(self, name):
+    parameters = self.__dict__.get('_parameters', {})
+    if name in parameters:
+      return parameters[name]
+    raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+  def __setattr__(self, name, value):
+    if name in DEFAULTS:
+      self.update(**{name: value})
+    else:
+      object.__setattr__(self, name, value)
+
+  def update(self, **changes):
+    """
+    Changes physical constants, dropping the cached artifacts that depend on them.
+
+    Args:
+      **changes: New values of some of the constants.
+    """
+    unknown = set(changes) - set(DEFAULTS)
+    if unknown:
+      raise TypeError(f"Unknown plant parameters: {', '.join(sorted(unknown))}")
+
+    changed = {name for name, value in changes.items() if self._parameters[name] != value}
+    self._parameters.update(changes)
+    for key in [key for key, (dependencies, _) in self._cache.items() if dependencies & changed]:
+      del self._cache[key]
+
+  @property
+  def parameters(self) -> dict:
+    """dict: Copy of the physical constants."""
+    return dict(self._parameters)
+
+  @property
+  def A(self) -> np.ndarray:
+    """np.ndarray: State matrix (3 x 3)."""
+    return self._state_matrix()
+
+  @property
+  def B(self) -> np.ndarray:
+    """np.ndarray: Input matrix (3 x 1)."""
+    return self._input_matrix()
+
+  def C(self, outputs=(0, 1, 2)) -> np.ndarray:
+    """
+    Output matrix selecting the given states (mass position, mass speed, tank pressure).
+
+    Args:
+      outputs (tuple): Indices of the measured states.
+
+    Returns:
+      np.ndarray: (len(outputs) x 3) output matrix.
+    """
+    return np.eye(3, dtype=int)[list(outputs)]
+
+  @property
+  def D(self) -> np.ndarray:
+    """np.ndarray: Feedthrough matrix (1 x 1)."""
+    return np.array([[0]])
+
+  @property
+  def pressure_scale(self) -> float:
+    """float: gravity * fluid_density, converting a tank height into its pressure."""
+    return self.gravity*self.fluid_density
+
+  def rest_tank_height(self, mass_position) -> float:
+    """
+    Tank height balancing the spring force at a mass position (P = g*p*h = k*x/A).
+
+    Args:
+      mass_position (float): Mass position (m).
+
+    Returns:
+      float: Tank height (m).
+    """
+    return (self.spring_constant*mass_position) / (self.fluid_density*self.gravity*self.pipe_section_area)
+
+  @_derived(*ALL)
+  def _state_matrix(self) -> np.ndarray:
+    return build_system(**self._parameters)[0][0]
+
+  @_derived('fluid_density', 'gravity', 'tank_area')
+  def _input_matrix(self) -> np.ndarray:
+    return np.array([[0], [0], [self.fluid_density*self.gravity / self.tank_area]])
+
+  @property
+  def eigenvalues(self) -> np.ndarray:
+    """np.ndarray: Open-loop poles."""
+    return self._eigenvalues()
+
+  @_derived(*ALL)
+  def _eigenvalues(self) -> np.ndarray:
+    return np.linalg.eigvals(self.A)
+
+  @property
+  def controllable(self) -> bool:
+    """bool: Whether (A, B) is controllable."""
+    return self._controllable()
+
+  @_derived(*ALL)
+  def _controllable(self) -> bool:
+    return check_controllability(self.A, self.B)
+
+  @_derived(*ALL)
+  def observable(self, outputs=(0, 1, 2)) -> bool:
+    """
+    Whether (A, C) is observable when measuring the given states.
+    """
+    return check_observability(self.A, self.C(outputs))
+
+  @_derived(*ALL, ignore=('plot',))
+  def K(self, poles_gain=10, plot=False) -> np.ndarray:
+    """
+    State feedback gain (see `helpers.control.calculate_K`).
+    """
+    return calculate_K(self.A, self.B, poles_gain=poles_gain, plot=plot)
+
+  @_derived(*ALL)
+  def N(self, poles_gain=10, outputs=(0,)) -> np.ndarray:
+    """
+    Reference gain for the feedback K(poles_gain), tracking the given output (see
+    `helpers.reference.calculate_N`).
+    """
+    A, B = self.A, self.B
+    return calculate_N(A, B, self.C(outputs), self.D, self.K(poles_gain), A.shape[1], B.shape[1])
+
+  @_derived(*ALL, ignore=('plot',))
+  def L(self, poles_gain=20, outputs=(0,), plot=False) -> np.ndarray:
+    """
+    Observer gain for the given measured states (see `helpers.estimator.calculate_L`).
+    """
+    return calculate_L(self.A, self.C(outputs), poles_gain=poles_gain, plot=plot)
+
+  @_derived(*ALL)
+  def kalman_L(self, process_noise, measurement_noise, dt, integrator='euler', outputs=(0,)) -> np.ndarray:
+    """
+    Steady-state Kalman observer gain for a flow disturbance and a measurement noise of the given standard
+    deviations (see `helpers.estimator.calculate_kalman_L`).
+    """
+    return calculate_kalman_L(self.A, self.B, self.C(outputs), process_noise**2, measurement_noise**2, dt, integrator)
+
+  @_derived(*ALL)
+  def step_matrices(self, dt, integrator='euler') -> tuple:
+    """
+    One-step matrices (Ad, Bd) of the plant (see `helpers.integrator.step_matrices`).
+    """
+    return step_matrices(self.A, self.B, dt, integrator)
@@ -0,0 +1,183 @@
+import atexit
+import os
+import sys
+import numpy as np
+from helpers import instrument
+
+PLOT_MODES = ('show', 'save', 'none')
+PLOT_FORMATS = ('png', 'svg')
+DOWNSAMPLING_METHODS = ('minmax', 'lttb')
+
+_settings = {'mode': 'show', 'directory': 'figures', 'points': 2000, 'method': 'minmax', 'format': 'png'}
+
+# Background rendering of the saved figures, started by the first `show` in 'save' mode
+_renderer = {'executor': None, 'pending': []}
+
+def configure(mode=None, directory=None, points=None, method=None, format=None):
+  """
+  Selects how the scripts render their figures.
+
+  Args:
+    mode (str): 'show' opens the interactive window (blocking), 'save' renders to files with the
+      non-interactive Agg backend in a background thread, 'none' skips plotting entirely.
+    directory (str): Where 'save' writes the figures.
+    points (int): Point budget per plotted series (see `downsample`); 0 plots every sample.
+    method (str): Downsampling method, 'minmax' or 'lttb'.
+    format (str): File format of 'save', 'png' or 'svg'.
+  """
+  if mode is not None:
+    if mode not in PLOT_MODES:
+      raise ValueError(f"Unknown plot mode '{mode}', expected one of {PLOT_MODES}")
+    _settings['mode'] = mode
+  if directory is not None:
+    _settings['directory'] = directory
+  if points is not None:
+    _settings['points'] = int(points)
+  if method is not None:
+    if method not in DOWNSAMPLING_METHODS:
+      raise ValueError(f"Unknown downsampling method '{method}', expected one of {DOWNSAMPLING_METHODS}")
+    _settings['method'] = method
+  if format is not None:
+    if format not in PLOT_FORMATS:
+      raise ValueError(f"Unknown figure format '{format}', expected one of {PLOT_FORMATS}")
+    _settings['format'] = format
+
+def mode() -> str:
+  """str: Current plot mode."""
+  return _settings['mode']
+
+def enabled() -> bool:
+  """bool: False when plotting is skipped, so callers can avoid building figures at all."""
+  return _settings['mode'] != 'none'
+
+def _minmax(y, points) -> np.ndarray:
+  # Minimum and maximum of each of points/2 equal bins, so every peak survives
+  n = y.shape[0]
+  bins = max(points // 2, 1)
+  width = -(-n // bins)
+  padded = np.empty(bins * width)
+  padded[:n] = y
+  padded[n:] = y[-1]
+  blocks = padded.reshape(bins, width)
+  offsets = np.arange(bins) * width
+  indices = np.concatenate(([0, n - 1], offsets + blocks.argmin(axis=1), offsets + blocks.argmax(axis=1)))
+  return np.unique(np.minimum(indices, n - 1))
+
+def _lttb(x, y, points) -> np.ndarray:
+  # Largest-Triangle-Three-Buckets: in each bucket keep the point forming the largest triangle with the
+  # previously kept point and the mean of the next bucket
+  n = y.shape[0]
+  edges = (np.arange(points - 1) * (n - 2) / (points - 2)).astype(int) + 1
+  edges[-1] = n - 1
+  indices = np.empty(points, dtype=int)
+  indices[0], indices[-1] = 0, n - 1
+
+  a = 0
+  for i in range(points - 2):
+    start, end = edges[i], edges[i + 1]
+    next_end = edges[i + 2] if i + 2 < points - 1 else n
+    mean_x, mean_y = x[end:next_end].mean(), y[end:next_end].mean()
+    area = np.abs((x[a] - mean_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (mean_y - y[a]))
+    a = start + int(np.argmax(area))
+    indices[i + 1] = a
+  return indices
+
+def downsample(x, y, points=None, method=None) -> tuple:
+  """
+  Reduces a series to a point budget while keeping its visual shape, so long trajectories plot fast and
+  with little memory: 'minmax' keeps the extremes of every bin (no peak is lost), 'lttb' keeps the most
+  visually significant point of every bucket (Largest-Triangle-Three-Buckets).
+
+  Args:
+    x (np.ndarray): Sample times (samples,).
+    y (np.ndarray): Series values (samples,).
+    points (int): Point budget, defaults to the configured one; 0 keeps every sample.
+    method (str): 'minmax' or 'lttb', defaults to the configured one.
+
+  Returns:
+    tuple: (x, y) of at most about `points` samples, in time order.
+  """
+  points = _settings['points'] if points is None else points
+  method = _settings['method'] if method is None else method
+  x, y = np.asarray(x), np.asarray(y)
+  if not points or y.shape[0] <= max(points, 3):
+    return x, y
+
+  with instrument.timer('plotting/downsample'):
+    indices = _minmax(y, points) if method == 'minmax' else _lttb(x, y, max(points, 3))
+  return x[indices], y[indices]
+
+def _has_display() -> bool:
+  if sys.platform in ('win32', 'darwin'):
+    return True
+  return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+def pyplot():
+  """
+  Imports matplotlib.pyplot on first use. In 'save' mode (or 'show' without a display, which falls
+  back to 'save') the non-interactive Agg backend is selected before the import.
+
+  Returns:
+    module: matplotlib.pyplot.
+  """
+  if 'matplotlib.pyplot' not in sys.modules:
+    if _settings['mode'] == 'show' and not _has_display():
+      instrument.section("No display available, saving figures to", _settings['directory'], color=instrument.WARNING,
+                         newline=False)
+      _settings['mode'] = 'save'
+    if _settings['mode'] != 'show':
+      import matplotlib
+      matplotlib.use('Agg')
+
+    with instrument.timer('plotting/import'):
+      import matplotlib.pyplot
+
+  import matplotlib.pyplot as plt
+  return plt
+
+def _render(figure, path):
+  with instrument.timer('plotting/render'):
+    figure.savefig(path)
+  instrument.section("Saved figure:", path, color=instrument.RESULT, newline=False)
+  return path
+
+def wait() -> list:
+  """
+  Waits for the figures being rendered in the background, re-raising any rendering error.
+
+  Returns:
+    list: Paths of the figures written since the last call.
+  """
+  pending, _renderer['pending'] = _renderer['pending'], []
+  return [future.result() for future in pending]
+
+def show(name):
+  """
+  Finishes the current figure: shows it (blocking) in 'show' mode. In 'save' mode, it is detached from
+  pyplot and written to `<directory>/<name>.<format>` by a background thread, so the caller can go on
+  building the next figures; `wait` (also run at exit) collects them.
+
+  Args:
+    name (str): File name (without extension) used in 'save' mode.
+  """
+  if not enabled():
+    return
+
+  plt = pyplot()
+  if _settings['mode'] == 'show':
+    with instrument.timer('plotting/show'):
+      plt.show()
+    return
+
+  if _renderer['executor'] is None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    _renderer['executor'] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='plotting')
+    atexit.register(wait)
+
+  os.makedirs(_settings['directory'], exist_ok=True)
+  path = os.path.join(_settings['directory'], f"{name}.{_settings['format']}")
+  figure = plt.gcf()
+  # Once closed, pyplot holds no reference to the figure, and only the rendering thread touches it
+  plt.close(figure)
+  _renderer['pending'].append(_renderer['executor'].submit(_render, figure, path))
@@ -0,0 +1,36 @@
+import concurrent.futures
+import multiprocessing
+from helpers import instrument
+
+def process_pool(workers, initializer=None, initargs=()) -> concurrent.futures.ProcessPoolExecutor:
+  """
+  Creates the worker processes of the parallel studies and of the service.
+
+  Workers are forked where the platform supports it: they start instantly and do not re-import the
+  calling script. Their `helpers.instrument` counters are lost with their processes, so the work done
+  in them is counted by the parent with `count_work`.
+
+  Args:
+    workers (int): Number of worker processes.
+    initializer (callable): Called once in every worker, with `initargs` (optional).
+    initargs (tuple): Arguments of the initializer.
+
+  Returns:
+    concurrent.futures.ProcessPoolExecutor: The pool, to be shut down by the caller (or used as a context manager).
+  """
+  methods = multiprocessing.get_all_start_methods()
+  context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+  return concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=initializer,
+                                                initargs=initargs)
+
+def count_work(steps, matmuls=0):
+  """
+  Counts, in the calling process, simulation steps and matrix products done by `process_pool` workers.
+
+  Args:
+    steps (int): Simulation steps.
+    matmuls (int): Matrix products.
+  """
+  instrument.count('steps', steps)
+  if matmuls:
+    instrument.count('matmuls', matmuls)
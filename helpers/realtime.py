@@ -0,0 +1,153 @@
+import time
+import numpy as np
+from helpers import instrument
+from helpers.integrator import step_matrices
+
+class RealtimeController:
+  """
+  Stateful controller + observer of script 4 for hardware-in-the-loop use:
+  u = Nr - K x_est, then x_est <- x_est one step ahead from u and the measurement y = Cx.
+
+  Every step is a single product of one fused, precomputed matrix with the buffer w = [x_est; r; y]:
+
+    [u; x_est'] = [[-K,          N,      0   ],   @ [x_est; r; y]
+                   [Ao - Bo_u K, Bo_u N, Bo_y]]
+
+  where (Ao, [Bo_u Bo_y]) is the one-step discretization of the observer (A - LC, [B L]). All buffers
+  are allocated once, and the step writes into them with `out=` arguments, so no array is created per
+  step. The latency of every step is kept in a ring buffer for the percentiles of `latency_stats`.
+
+  Args:
+    A, B (np.ndarray): Plant model matrices.
+    C (np.ndarray): Measured output matrix (p x n).
+    K, N, L (np.ndarray): State feedback, reference and observer gains.
+    x_est0 (np.ndarray): Initial estimate.
+    dt (float): Control period.
+    integrator (str): Observer discretization, 'euler' or 'zoh'.
+    history (int): Number of most recent step latencies kept.
+
+  Example:
+    controller = RealtimeController(A, B, C, K, N, L, x_est0, dt=.001)
+    while running:
+      u = controller.step(read_sensor(), r)
+      write_actuator(u)
+    controller.report(deadline=.001)
+  """
+
+  def __init__(self, A, B, C, K, N, L, x_est0, dt, integrator='euler', history=65536):
+    n, m = B.shape
+    K, N = np.atleast_2d(K), np.atleast_2d(N)
+    p, q = C.shape[0], N.shape[1]
+
+    Ao, Bo = step_matrices(A - L@C, np.hstack((B, L)), dt, integrator)
+    Bo_u, Bo_y = Bo[:, :m], Bo[:, m:]
+
+    self._M = np.zeros((m + n, n + q + p))
+    self._M[:m, :n] = -K
+    self._M[:m, n:n+q] = N
+    self._M[m:, :n] = Ao - Bo_u@K
+    self._M[m:, n:n+q] = Bo_u@N
+    self._M[m:, n+q:] = Bo_y
+
+    # Input buffer [x_est; r; y], output buffer [u; x_est'], and fixed views on their parts
+    self._w = np.zeros(n + q + p)
+    self._out = np.empty(m + n)
+    self._x_est, self._r, self._y = self._w[:n], self._w[n:n+q], self._w[n+q:]
+    self._u, self._x_est_next = self._out[:m], self._out[m:]
+
+    self._latencies = np.zeros(int(history), dtype=np.int64)
+    self._count = 0
+    self.dt = dt
+    self.reset(x_est0)
+
+  def reset(self, x_est0):
+    """
+    Sets the estimate and clears the latency history.
+
+    Args:
+      x_est0 (np.ndarray): New estimate (n or n x 1).
+    """
+    self._x_est[:] = np.ravel(x_est0)
+    self._count = 0
+
+  @property
+  def x_est(self) -> np.ndarray:
+    """np.ndarray: Copy of the current estimate, shape (n,)."""
+    return self._x_est.copy()
+
+  def step(self, y, r, out=None) -> np.ndarray:
+    """
+    Runs one control period.
+
+    Args:
+      y (np.ndarray | float): Measurement of this period (p,).
+      r (np.ndarray | float): Reference (q,).
+      out (np.ndarray): Optional (m,) array receiving u.
+
+    Returns:
+      np.ndarray: u (m,), either `out` or an internal buffer overwritten by the next step.
+    """
+    start = time.perf_counter_ns()
+
+    np.copyto(self._y, y)
+    np.copyto(self._r, r)
+    np.dot(self._M, self._w, out=self._out)
+    np.copyto(self._x_est, self._x_est_next)
+    if out is not None:
+      np.copyto(out, self._u)
+    else:
+      out = self._u
+
+    self._latencies[self._count % self._latencies.shape[0]] = time.perf_counter_ns() - start
+    self._count += 1
+    return out
+
+  def latencies(self) -> np.ndarray:
+    """np.ndarray: Recorded step latencies (s), at most the `history` most recent ones."""
+    return self._latencies[:min(self._count, self._latencies.shape[0])] * 1e-9
+
+  def histogram(self, bins=50) -> tuple:
+    """
+    Histogram of the recorded step latencies.
+
+    Args:
+      bins (int | np.ndarray): Bins, as for `np.histogram`.
+
+    Returns:
+      tuple: (counts, edges), with the edges in seconds.
+    """
+    return np.histogram(self.latencies(), bins=bins)
+
+  def latency_stats(self, deadline=None) -> dict:
+    """
+    Summarizes the recorded step latencies.
+
+    Args:
+      deadline (float): Optional budget per step (s); steps over it are counted as misses.
+
+    Returns:
+      dict: 'steps', 'p50', 'p99', 'max' and 'mean' (s), plus 'deadline_misses' when a deadline is given.
+    """
+    latencies = self.latencies()
+    if latencies.shape[0] == 0:
+      raise ValueError("No step has been run yet")
+
+    p50, p99 = np.percentile(latencies, (50, 99))
+    stats = {'steps': self._count, 'p50': p50, 'p99': p99, 'max': latencies.max(), 'mean': latencies.mean()}
+    if deadline is not None:
+      stats['deadline_misses'] = int(np.count_nonzero(latencies > deadline))
+    return stats
+
+  def report(self, deadline=None):
+    """
+    Prints the latency summary.
+
+    Args:
+      deadline (float): Optional budget per step (s), defaults to the control period.
+    """
+    deadline = self.dt if deadline is None else deadline
+    stats = self.latency_stats(deadline)
+
+    instrument.section("Real-time controller step latency:")
+    instrument.note(f"steps: {stats['steps']} | p50: {stats['p50']*1e6:.2f} us | p99: {stats['p99']*1e6:.2f} us | "
+                    f"max: {stats['max']*1e6:.2f} us | deadline {deadline*1e3:g} ms missed: {stats['deadline_misses']}")
@@ -0,0 +1,192 @@
+import numpy as np
+from helpers import instrument
+
+class Recorder:
+  """
+  Preallocated trajectory recorder for the simulation loops.
+
+  Each recorded series (states, inputs, estimates, ...) lives in a column-major (n x capacity) buffer,
+  so every sample is written into one contiguous column instead of copying the whole history with
+  `np.append`. Time is kept in its own 1-D buffer.
+
+  Args:
+    t (float): Initial time, recorded as the first sample.
+    num_steps (int | None): Number of integration steps the loop will run. When known, the buffers
+      are allocated once with the exact size. When None, they grow in chunks of `chunk_size` samples.
+    every (int): Decimation factor; only every k-th step is stored. The last step is always kept.
+    chunk_size (int): Growth increment (in samples) used when `num_steps` is unknown.
+    **series (np.ndarray): Initial value of each series to record, e.g. X=x, U=u.
+
+  Example:
+    recorder = Recorder(t, num_steps, X=x, U=u)
+    for i in range(num_steps):
+      ...
+      recorder.record(t, X=x, U=u)
+    T, X, U = recorder.T, recorder['X'], recorder['U']
+  """
+
+  def __init__(self, t, num_steps=None, every=1, chunk_size=4096, **series):
+    if every < 1:
+      raise ValueError("every must be a positive integer")
+
+    self.every = int(every)
+    self.chunk_size = int(chunk_size)
+    self.num_steps = num_steps
+
+    # Initial sample + one per `every` steps + a possible trailing sample
+    if num_steps is not None:
+      capacity = int(num_steps) // self.every + 2
+    else:
+      capacity = self.chunk_size
+
+    self._t = np.empty(capacity, dtype=float)
+    self._buffers = {
+      name: np.empty((np.size(value), capacity), dtype=float, order='F')
+      for name, value in series.items()
+    }
+    self._last = {name: np.empty(np.size(value), dtype=float) for name, value in series.items()}
+    instrument.count('allocated_bytes', self._t.nbytes + sum(buffer.nbytes for buffer in self._buffers.values()))
+    self._last_t = t
+    self._step = 0
+    self._size = 0
+    self._pending = False
+
+    self._store(t, series)
+
+  @classmethod
+  def from_arrays(cls, T, **series):
+    """
+    Builds a recorder holding already computed trajectories (e.g. dense output sampled at uniform times).
+
+    Args:
+      T (np.ndarray): Sample times, shape (samples,).
+      **series (np.ndarray): Values of each series, shape (n, samples) or (samples,).
+
+    Returns:
+      Recorder: Recorder whose arrays are the given trajectories.
+    """
+    T = np.asarray(T, dtype=float)
+    samples = T.shape[0]
+    series = {name: np.reshape(values, (-1, samples)) for name, values in series.items()}
+
+    recorder = cls(T[0], samples - 1, **{name: values[:, 0] for name, values in series.items()})
+    recorder._t[:samples] = T
+    for name, values in series.items():
+      recorder._buffers[name][:, :samples] = values
+    recorder._step = recorder._size = samples
+    return recorder
+
+  @property
+  def capacity(self):
+    return self._t.shape[0]
+
+  def __len__(self):
+    return self._size
+
+  def _grow(self):
+    # Grow geometrically, rounded up to a whole number of chunks, so the total copy cost stays linear
+    extra = max(self.chunk_size, self.capacity)
+    extra = -(-extra // self.chunk_size) * self.chunk_size
+    new_capacity = self.capacity + extra
+
+    t = np.empty(new_capacity, dtype=float)
+    t[:self._size] = self._t[:self._size]
+    self._t = t
+
+    for name, buffer in self._buffers.items():
+      grown = np.empty((buffer.shape[0], new_capacity), dtype=float, order='F')
+      grown[:, :self._size] = buffer[:, :self._size]
+      self._buffers[name] = grown
+    instrument.count('allocated_bytes', t.nbytes + sum(buffer.nbytes for buffer in self._buffers.values()))
+
+  def _store(self, t, values):
+    if self._size == self.capacity:
+      self._grow()
+
+    k = self._size
+    self._t[k] = t
+    for name, buffer in self._buffers.items():
+      buffer[:, k] = np.reshape(values[name], -1)
+    self._size += 1
+
+  def record(self, t, **values):
+    """
+    Records one integration step. Only every `every`-th step is written to the buffers; the values
+    of skipped steps are kept aside so that `finish` can store the last one.
+
+    Args:
+      t (float): Time of the sample.
+      **values (np.ndarray): Current value of every series given at construction.
+    """
+    self._step += 1
+    if self._step % self.every == 0:
+      self._store(t, values)
+      self._pending = False
+      return
+
+    self._last_t = t
+    for name, last in self._last.items():
+      last[:] = np.reshape(values[name], -1)
+    self._pending = True
+
+  def extend(self, T, **values):
+    """
+    Records a block of consecutive integration steps at once (e.g. a chunk from `helpers.stream`),
+    with the same decimation as `record`.
+
+    Args:
+      T (np.ndarray): Times of the steps, shape (k,).
+      **values (np.ndarray): Values of every series given at construction, shape (n, k).
+    """
+    count = T.shape[0]
+    if count == 0:
+      return
+
+    steps = self._step + 1 + np.arange(count)
+    keep = np.flatnonzero(steps % self.every == 0)
+    while self._size + keep.shape[0] > self.capacity:
+      self._grow()
+
+    end = self._size + keep.shape[0]
+    self._t[self._size:end] = T[keep]
+    for name, buffer in self._buffers.items():
+      buffer[:, self._size:end] = np.reshape(values[name], (-1, count))[:, keep]
+    self._size = end
+    self._step += count
+
+    self._pending = keep.shape[0] == 0 or keep[-1] != count - 1
+    if self._pending:
+      self._last_t = T[-1]
+      for name, last in self._last.items():
+        last[:] = np.reshape(values[name], (-1, count))[:, -1]
+
+  def finish(self):
+    """
+    Stores the last skipped step (if any) for good. Reads already include it without storing it, so
+    this is only needed when more steps will not follow and `len` must count it.
+    """
+    if self._pending:
+      self._pending = False
+      self._store(self._last_t, self._last)
+
+  def _visible(self) -> int:
+    # Number of samples a read exposes: the stored ones, plus the last skipped step written in the free
+    # slot after them. That slot is not committed, so the next stored step overwrites it and a read in
+    # the middle of a run never leaves an off-grid sample behind.
+    if not self._pending:
+      return self._size
+    if self._size == self.capacity:
+      self._grow()
+    self._t[self._size] = self._last_t
+    for name, buffer in self._buffers.items():
+      buffer[:, self._size] = self._last[name]
+    return self._size + 1
+
+  @property
+  def T(self) -> np.ndarray:
+    """np.ndarray: Recorded times, shape (samples,). A view, valid until the next recorded step."""
+    return self._t[:self._visible()]
+
+  def __getitem__(self, name) -> np.ndarray:
+    """np.ndarray: Recorded series `name`, shape (n, samples). A view, valid until the next recorded step."""
+    return self._buffers[name][:, :self._visible()]
@@ -1,5 +1,9 @@
 import numpy as np
+from helpers import instrument
+from helpers.cache import memoize
 
+@instrument.timer('design/calculate_N')
+@memoize('N')
 def calculate_N(A, B, C, D, K, x_dot_rows_num, r_rows_num) -> np.ndarray:
   """
   Computes the feedforward gain matrix N for reference tracking in state-space control systems.
@@ -30,13 +34,14 @@ def calculate_N(A, B, C, D, K, x_dot_rows_num, r_rows_num) -> np.ndarray:
   extended_state_matrix = np.concatenate((extended_x_dot, extended_y), axis=0)
 
 
-  Nx_Nu = np.linalg.inv(extended_matrix) @ extended_state_matrix
+  with instrument.timer('design/inv'):
+    Nx_Nu = np.linalg.inv(extended_matrix) @ extended_state_matrix
   Nx = Nx_Nu[:x_dot_rows_num, :]
   Nu = Nx_Nu[x_dot_rows_num:, :]
 
   #print(f"Solution for Nx: {Nx}")
   #print(f"Solution for Nu: {Nu}")
-  print("\n\033[95mSolution for N:\033[0m")
-  print(Nu + K@Nx)
+  instrument.section("Solution for N:")
+  instrument.note(Nu + K@Nx)
 
   return Nu + K@Nx
\ No newline at end of file
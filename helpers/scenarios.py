@@ -0,0 +1,147 @@
+import itertools
+import numpy as np
+from helpers import instrument
+from helpers.integrator import (OBSERVER_STEP_MATMULS, STEP_MATMULS, loop_step_matrices, make_step,
+                                make_observer_step)
+
+def make_scenarios(**axes) -> dict:
+  """
+  Builds every combination of the given per-scenario values, as the columns of the scenario matrices.
+
+  Args:
+    **axes (iterable): Values of each varied quantity, e.g. r=[3, 4, 5], initial_mass_position=[1, 2].
+
+  Returns:
+    dict: Flattened (S,) arrays, one per quantity, with S the product of the axes lengths.
+  """
+  names = list(axes)
+  points = np.array(list(itertools.product(*(np.asarray(axes[name], dtype=float) for name in names))))
+  return {name: points[:, i] for i, name in enumerate(names)}
+
+def simulate_scenarios(A, B, X0, t0, tf, dt, K=None, N=None, R=None, C=None, L=None, X_est0=None,
+                       integrator='euler', every=1, settling_band=.02) -> dict:
+  """
+  Simulates one designed loop for S scenarios (initial conditions and references) together. The states
+  of all scenarios are the columns of an (n x S) matrix, so every step is one matrix-matrix product per
+  term of the loop instead of S matrix-vector products, with the same control laws as `helpers.stream`:
+  u = Nr - Kx, or u = Nr - K x_est with a Luenberger observer (y = Cx) when L is given. With 'zoh' and
+  feedback, the closed loop is discretized exactly, as in `helpers.stream`.
+
+  Args:
+    A, B (np.ndarray): Plant matrices (n x n), (n x m).
+    X0 (np.ndarray): Initial states (n x S).
+    t0, tf, dt (float): Initial time, final time and integration step.
+    K, N (np.ndarray): State feedback and reference gains (optional; u = 0 without K).
+    R (np.ndarray): References (q x S), constant, or a schedule (q x S x steps) whose R[..., i] is applied
+      during step i. Required with N.
+    C, L (np.ndarray): Measured output matrix and observer gain (optional).
+    X_est0 (np.ndarray): Initial estimates (n x S), required with L.
+    integrator (str): 'euler' or 'zoh' (exact closed-loop discretization).
+    every (int): Decimation of the recorded trajectories (the metrics use every step). The last step is
+      always recorded.
+    settling_band (float): Settling band relative to the initial distance to the final reference.
+
+  Returns:
+    dict: 'T' (samples,), 'X' and 'X_est' (S x n x samples), 'U' (S x m x samples), and per-scenario (S,)
+    metrics of the mass position (first state) against the final reference: final_position, overshoot,
+    settling_time, peak_flow and, with the observer, estimation_error_rms.
+  """
+  n, m = B.shape
+  X = np.array(X0, dtype=float, ndmin=2)
+  S = X.shape[1]
+  K = None if K is None else np.atleast_2d(K)
+  observe = L is not None
+  X_est = np.array(X_est0, dtype=float, ndmin=2) * np.ones((1, S)) if observe else None
+
+  num_steps = int((tf-t0)/dt)
+  R = None if N is None else np.asarray(R, dtype=float).reshape(N.shape[1], S, -1)
+  scheduled = R is not None and R.shape[2] > 1
+  if scheduled and R.shape[2] < num_steps:
+    raise ValueError(f"The reference schedule has {R.shape[2]} steps, expected {num_steps}")
+  NR = np.zeros((m, S)) if N is None else N@R[:, :, 0]
+  U = np.zeros((m, S))
+
+  step = make_step(A, B, dt, integrator)
+  step_est = make_observer_step(A, B, C, L, dt, integrator) if observe else None
+  exact = integrator == 'zoh' and K is not None
+  if exact:
+    # Exact closed loop: Z <- M Z + F_r NR, with Z = [X; X_est] or X
+    M, F = loop_step_matrices(A, B, K, dt, integrator, C, L)
+    F_r = F[:, :m]
+    offset = F_r@NR
+
+  # Sample-major buffers, so each recorded sample is one contiguous write; returned as (S x n x samples).
+  # The last step is recorded even when it falls between two decimated samples.
+  samples = num_steps // every + 1 + (num_steps % every != 0)
+  X_buf = np.empty((samples, n, S))
+  U_buf = np.empty((samples, m, S))
+  X_est_buf = np.empty((samples, n, S)) if observe else None
+  instrument.count('allocated_bytes', sum(buffer.nbytes for buffer in (X_buf, U_buf, X_est_buf) if buffer is not None))
+
+  X_buf[0], U_buf[0] = X, U
+  if observe:
+    X_est_buf[0] = X_est
+
+  # Running metrics of the mass position against the final reference of every scenario
+  target = X[0].copy() if R is None else R[0, :, max(num_steps - 1, 0) if scheduled else 0]
+  distance = np.abs(target - X[0])
+  direction = np.sign(target - X[0])
+  band = settling_band * np.where(distance > 0, distance, 1)
+  overshoot = np.zeros(S)
+  settling_time = np.zeros(S)
+  peak_flow = np.zeros(S)
+  squared_error = np.zeros(S)
+
+  for i in range(num_steps):
+    if K is not None:
+      if scheduled:
+        NR = N@R[:, :, i]
+        if exact:
+          offset = F_r@NR
+      U = NR - K@(X_est if observe else X)
+
+    if exact and observe:
+      Z = M@np.vstack((X, X_est)) + offset
+      X, X_est = Z[:n], Z[n:]
+    elif exact:
+      X = M@X + offset
+    else:
+      if observe:
+        X_est = step_est(X_est, U, C@X)
+      X = step(X, U)
+
+    position = X[0]
+    np.maximum(overshoot, (position - target) * direction, out=overshoot)
+    np.maximum(peak_flow, np.abs(U).max(axis=0), out=peak_flow)
+    settling_time[np.abs(position - target) > band] = (i + 1) * dt
+    if observe:
+      squared_error += (position - X_est[0])**2
+
+    if (i + 1) % every == 0 or i == num_steps - 1:
+      k = -(-(i + 1) // every)
+      X_buf[k], U_buf[k] = X, U
+      if observe:
+        X_est_buf[k] = X_est
+
+  step_matmuls = STEP_MATMULS[integrator] + (K is not None) + (K is not None and scheduled)
+  if observe:
+    step_matmuls += OBSERVER_STEP_MATMULS[integrator] + 1
+  if exact:
+    # Closed-loop step and K@X, plus N@R and F_r@NR with a schedule
+    step_matmuls = 2 + 2*scheduled
+  instrument.count('steps', num_steps * S)
+  instrument.count('matmuls', num_steps * step_matmuls)
+
+  results = {
+    'T': t0 + dt * np.minimum(every * np.arange(samples), num_steps),
+    'X': X_buf.transpose(2, 1, 0),
+    'U': U_buf.transpose(2, 1, 0),
+    'final_position': X[0].copy(),
+    'overshoot': overshoot / np.where(distance > 0, distance, 1),
+    'settling_time': settling_time,
+    'peak_flow': peak_flow,
+  }
+  if observe:
+    results['X_est'] = X_est_buf.transpose(2, 1, 0)
+    results['estimation_error_rms'] = np.sqrt(squared_error / max(num_steps, 1))
+  return results
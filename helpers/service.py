@@ -0,0 +1,371 @@
+import asyncio
+import collections
+import concurrent.futures
+import json
+import math
+import os
+import socket
+import time
+import numpy as np
+from helpers import instrument
+from helpers.cache import make_key
+from helpers.integrator import EULER_DT
+from helpers.plant import DEFAULTS as PLANT_DEFAULTS, Plant
+from helpers.pool import count_work, process_pool
+from helpers.scenarios import make_scenarios, simulate_scenarios
+
+# Fields of a simulation request and their defaults (the loop of script 4)
+REQUEST_DEFAULTS = {
+  'references': [5],
+  'initial_positions': [2],
+  'initial_speeds': [-2],
+  'tf': 15,
+  'dt': EULER_DT,
+  'integrator': 'euler',
+  'every': 10,
+  'parameters': {},
+  'controller_poles_gain': 10,
+  'observer_poles_gain': 20,
+  'arrays': ['T', 'X', 'U', 'X_est'],
+  'dtype': 'float32',
+}
+
+# Fields defining the simulated loop: requests that agree on them are batched into one simulation
+LOOP_FIELDS = ('tf', 'dt', 'integrator', 'every', 'parameters', 'controller_poles_gain', 'observer_poles_gain')
+
+ARRAYS = ('T', 'X', 'U', 'X_est')
+DTYPES = ('float32', 'float64')
+METRICS = ('final_position', 'overshoot', 'settling_time', 'peak_flow', 'estimation_error_rms')
+
+def _number(value, name, positive=False) -> float:
+  # A finite number (booleans and strings are refused), positive when asked
+  if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+    raise ValueError(f"{name} must be a finite number, got {value!r}")
+  if positive and value <= 0:
+    raise ValueError(f"{name} must be positive, got {value!r}")
+  return float(value)
+
+def _numbers(value, name) -> list:
+  # A non-empty flat list of finite numbers
+  if not isinstance(value, list) or not value:
+    raise ValueError(f"{name} must be a non-empty list of numbers, got {value!r}")
+  return [_number(item, f"{name} item") for item in value]
+
+def _normalize(request) -> dict:
+  # Request with its defaults, fully checked before it reaches a batch (a bad request must not fail the others)
+  unknown = set(request) - set(REQUEST_DEFAULTS) - {'id'}
+  if unknown:
+    raise ValueError(f"Unknown request fields: {', '.join(sorted(unknown))}")
+  request = {**REQUEST_DEFAULTS, **request}
+
+  for axis in ('references', 'initial_positions', 'initial_speeds'):
+    request[axis] = _numbers(request[axis], axis)
+
+  parameters = request['parameters']
+  if not isinstance(parameters, dict):
+    raise ValueError(f"parameters must be an object of plant constants, got {parameters!r}")
+  unknown = set(parameters) - set(PLANT_DEFAULTS)
+  if unknown:
+    raise ValueError(f"Unknown plant parameters: {', '.join(sorted(unknown))}")
+  request['parameters'] = {name: _number(value, name, positive=True) for name, value in parameters.items()}
+
+  for field in ('tf', 'dt', 'controller_poles_gain', 'observer_poles_gain'):
+    request[field] = _number(request[field], field, positive=True)
+  if isinstance(request['every'], bool) or not isinstance(request['every'], int) or request['every'] < 1:
+    raise ValueError(f"every must be a positive integer, got {request['every']!r}")
+
+  if request['integrator'] not in ('euler', 'zoh'):
+    raise ValueError("The service simulates with a fixed-step integrator: 'euler' or 'zoh'")
+  if not isinstance(request['arrays'], list) or not all(name in ARRAYS for name in request['arrays']):
+    raise ValueError(f"arrays must be a list of names among {ARRAYS}")
+  if request['dtype'] not in DTYPES:
+    raise ValueError(f"dtype must be one of {DTYPES}")
+  return request
+
+def _simulate(task) -> tuple:
+  # Runs in a worker: one simulation for every scenario of a batch, and its duration
+  start = time.perf_counter()
+  results = simulate_scenarios(*task['matrices'], **task['options'])
+  return results, time.perf_counter() - start
+
+def _percentiles(values) -> dict:
+  if not values:
+    return {}
+  values = np.asarray(values)
+  return {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+
+class Service:
+  """
+  Local simulation service: keeps the plants and their designed K, N and L in memory, and answers
+  closed-loop simulation requests (the loop of script 4) over a Unix socket or a localhost TCP port.
+
+  Requests and responses are framed on one connection, several of them in flight at once:
+
+    - request: one JSON line with the fields of `REQUEST_DEFAULTS` (any subset) and an optional 'id'. The
+      scenarios are every combination of references, initial positions and initial speeds, as in
+      `helpers.scenarios.make_scenarios`. {"command": "stats"} returns the service metrics instead.
+    - response: one JSON line with the same 'id', a 'status' ('ok' or 'error' with a 'message'), the
+      per-scenario 'metrics', the request 'latency' (queued, simulation and total seconds), the
+      'batch_size', and the 'arrays' specs (name, dtype, shape), followed by the raw bytes of these arrays
+      in that order (see `read_response`).
+
+  Requests for the same loop (`LOOP_FIELDS`) arriving within `batch_window` seconds are merged: their
+  scenarios become the columns of one `simulate_scenarios` call on the worker pool, then are split back.
+
+  Args:
+    workers (int): Worker processes of the simulations (1: one worker thread).
+    batch_window (float): Seconds a request waits for others to join its batch.
+    max_batch (int): Scenarios that dispatch a batch right away.
+  """
+
+  def __init__(self, workers=1, batch_window=.005, max_batch=256):
+    self.batch_window = batch_window
+    self.max_batch = max_batch
+    self._processes = workers > 1
+    if self._processes:
+      self._executor = process_pool(workers)
+    else:
+      # The event loop keeps accepting requests while a simulation runs
+      self._executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    self._plants = {}
+    self._pending = {}
+    self._timers = {}
+    self._tasks = set()
+    self._latencies = collections.deque(maxlen=1000)
+    self._totals = {'requests': 0, 'batches': 0, 'scenarios': 0, 'errors': 0}
+
+  def design(self, request) -> tuple:
+    """
+    Plant and gains of a request's loop, designed once per set of parameters and pole gains.
+
+    Returns:
+      tuple: (plant, A, B, C, K, N, L), C measuring the mass position.
+    """
+    key = make_key('service/plant', request['parameters'])
+    if key not in self._plants:
+      self._plants[key] = Plant(**request['parameters'])
+      instrument.count('service/plants')
+    plant = self._plants[key]
+    return (plant, plant.A, plant.B, plant.C((0,)), plant.K(poles_gain=request['controller_poles_gain']),
+            plant.N(poles_gain=request['controller_poles_gain'], outputs=(0,)),
+            plant.L(poles_gain=request['observer_poles_gain'], outputs=(0,)))
+
+  async def submit(self, request) -> tuple:
+    """
+    Queues a simulation request into the batch of its loop and waits for its results.
+
+    Args:
+      request (dict): Request fields (see `REQUEST_DEFAULTS`).
+
+    Returns:
+      tuple: (header, arrays) of the response, the arrays as a dict of np.ndarray by name.
+    """
+    request = _normalize(request)
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    key = make_key('service/loop', {field: request[field] for field in LOOP_FIELDS})
+
+    batch = self._pending.setdefault(key, [])
+    batch.append((request, time.perf_counter(), future))
+    if len(batch) == 1:
+      self._timers[key] = loop.call_later(self.batch_window, self._dispatch, key)
+    if sum(len(queued['references']) * len(queued['initial_positions']) * len(queued['initial_speeds'])
+           for queued, _, _ in batch) >= self.max_batch:
+      self._dispatch(key)
+    return await future
+
+  def _dispatch(self, key):
+    batch = self._pending.pop(key, None)
+    timer = self._timers.pop(key, None)
+    if timer is not None:
+      timer.cancel()
+    if batch:
+      task = asyncio.ensure_future(self._run(batch))
+      self._tasks.add(task)
+      task.add_done_callback(self._tasks.discard)
+
+  def _columns(self, plant, request) -> dict:
+    # Scenario columns of one request: every combination of its axes, as in script 8
+    scenario = make_scenarios(r=request['references'], initial_mass_position=request['initial_positions'],
+                              initial_mass_speed=request['initial_speeds'])
+    positions = scenario['initial_mass_position']
+    scenario['X0'] = np.vstack((positions, scenario['initial_mass_speed'], plant.rest_tank_height(positions)))
+    scenario['X_est0'] = np.vstack((positions, np.zeros_like(positions), np.zeros_like(positions)))
+    return scenario
+
+  async def _run(self, batch):
+    try:
+      with instrument.timer('service/design'):
+        plant, *system = self.design(batch[0][0])
+    except Exception as error:
+      # The requests of a batch share their plant and gains, hence their design
+      for _, _, future in batch:
+        if not future.done():
+          future.set_exception(error)
+      return
+
+    # Each request's columns are built on their own, so a failure only reaches its own future
+    entries = []
+    for request, arrival, future in batch:
+      try:
+        entries.append((request, arrival, future, self._columns(plant, request)))
+      except Exception as error:
+        if not future.done():
+          future.set_exception(error)
+    if entries:
+      await self._simulate_batch(entries, system)
+
+  async def _simulate_batch(self, entries, system):
+    A, B, C, K, N, L = system
+    first = entries[0][0]
+    scenarios = [scenario for _, _, _, scenario in entries]
+    X0 = np.hstack([scenario['X0'] for scenario in scenarios])
+    task = {'matrices': (A, B, X0, 0, first['tf'], first['dt']),
+            'options': {'K': K, 'N': N, 'R': np.concatenate([scenario['r'] for scenario in scenarios])[None, :],
+                        'C': C, 'L': L, 'X_est0': np.hstack([scenario['X_est0'] for scenario in scenarios]),
+                        'integrator': first['integrator'], 'every': first['every']}}
+    dispatched = time.perf_counter()
+    try:
+      results, elapsed = await asyncio.get_running_loop().run_in_executor(self._executor, _simulate, task)
+    except Exception as error:
+      if len(entries) > 1:
+        # Retried one request at a time, so only the request causing the failure gets it
+        await asyncio.gather(*(self._simulate_batch([entry], system) for entry in entries))
+      elif not entries[0][2].done():
+        entries[0][2].set_exception(error)
+      return
+
+    self._totals['batches'] += 1
+    self._totals['scenarios'] += X0.shape[1]
+    instrument.count('service/batches')
+    if self._processes:
+      count_work(int(first['tf']/first['dt']) * X0.shape[1])
+
+    start = 0
+    for request, arrival, future, scenario in entries:
+      stop = start + scenario['r'].size
+      arrays = {name: results[name] if name == 'T' else results[name][start:stop] for name in request['arrays']}
+      header = {
+        'status': 'ok',
+        'scenarios': {'r': scenario['r'].tolist(), 'initial_position': scenario['initial_mass_position'].tolist(),
+                      'initial_speed': scenario['initial_mass_speed'].tolist()},
+        'metrics': {name: results[name][start:stop].tolist() for name in METRICS},
+        'batch_size': len(entries),
+        'latency': {'queued': dispatched - arrival, 'simulation': elapsed, 'total': time.perf_counter() - arrival},
+      }
+      self._latencies.append(header['latency']['total'])
+      if not future.done():
+        future.set_result((header, {name: np.ascontiguousarray(array, dtype=request['dtype'])
+                                    for name, array in arrays.items()}))
+      start = stop
+
+  def stats(self) -> dict:
+    """dict: Request, batch and scenario totals, and the latency percentiles of the last 1000 requests."""
+    batches = max(self._totals['batches'], 1)
+    return {**self._totals, 'plants': len(self._plants), 'scenarios_per_batch': self._totals['scenarios'] / batches,
+            'latency': _percentiles(list(self._latencies))}
+
+  async def _respond(self, line, writer, lock):
+    identifier, arrays = None, {}
+    try:
+      request = json.loads(line)
+      if not isinstance(request, dict):
+        raise ValueError("A request is a JSON object")
+      identifier = request.pop('id', None)
+      self._totals['requests'] += 1
+      instrument.count('service/requests')
+      if request.get('command') == 'stats':
+        header = {'status': 'ok', 'stats': self.stats()}
+      else:
+        header, arrays = await self.submit(request)
+    except Exception as error:
+      # Any failure is reported to its client only: the service and the other requests carry on
+      self._totals['errors'] += 1
+      header = {'status': 'error', 'message': f"{type(error).__name__}: {error}"}
+
+    header = {'id': identifier, **header,
+              'arrays': [{'name': name, 'dtype': array.dtype.str, 'shape': array.shape}
+                         for name, array in arrays.items()]}
+    # A response is written whole, so concurrent responses on one connection never interleave
+    async with lock:
+      writer.write(json.dumps(header).encode() + b'\n')
+      for array in arrays.values():
+        writer.write(memoryview(array).cast('B'))
+        await writer.drain()
+      await writer.drain()
+
+  async def _handle(self, reader, writer):
+    lock = asyncio.Lock()
+    tasks = set()
+    try:
+      while line := await reader.readline():
+        if line.strip():
+          task = asyncio.ensure_future(self._respond(line, writer, lock))
+          tasks.add(task)
+          task.add_done_callback(tasks.discard)
+      await asyncio.gather(*tasks, return_exceptions=True)
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+
+  async def serve(self, path=None, host='127.0.0.1', port=8765):
+    """
+    Accepts connections until cancelled.
+
+    Args:
+      path (str): Unix socket path (takes precedence over host and port).
+      host, port: TCP address otherwise.
+    """
+    if path:
+      server = await asyncio.start_unix_server(self._handle, path)
+    else:
+      server = await asyncio.start_server(self._handle, host, port)
+    try:
+      async with server:
+        await server.serve_forever()
+    finally:
+      if path and os.path.exists(path):
+        os.remove(path)
+
+  def close(self):
+    """Stops the worker pool."""
+    self._executor.shutdown(cancel_futures=True)
+
+def read_response(stream) -> tuple:
+  """
+  Reads one response of the service from a binary file-like stream (e.g. `socket.makefile('rb')`).
+
+  Returns:
+    tuple: (header, arrays), the arrays as a dict of np.ndarray by name.
+  """
+  header = json.loads(stream.readline())
+  arrays = {}
+  for spec in header['arrays']:
+    dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+    arrays[spec['name']] = np.frombuffer(stream.read(dtype.itemsize * int(np.prod(shape))), dtype).reshape(shape)
+  return header, arrays
+
+def request(address, **fields) -> tuple:
+  """
+  Sends one request to a running service and waits for its response:
+
+    header, arrays = request('/tmp/simulation.sock', references=[3, 4, 5], tf=10)
+    X = arrays['X']  # (scenarios x 3 x samples)
+
+  Args:
+    address (str | tuple): Unix socket path, or (host, port).
+    **fields: Request fields (see `REQUEST_DEFAULTS`).
+
+  Returns:
+    tuple: (header, arrays), see `read_response`.
+  """
+  if isinstance(address, str):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(address)
+  else:
+    connection = socket.create_connection(address)
+  with connection, connection.makefile('rb') as stream:
+    connection.sendall(json.dumps(fields).encode() + b'\n')
+    return read_response(stream)
@@ -0,0 +1,20 @@
+import sys
+import time
+
+# Imported first by the scripts, so this is (almost) the moment their imports start
+STARTED = time.perf_counter()
+
+HEAVY_MODULES = ('scipy', 'sympy', 'matplotlib', 'tqdm')
+
+def report_startup(label='Startup'):
+  """
+  Prints the time elapsed since the scripts started importing, and which heavy modules are loaded so far.
+
+  Args:
+    label (str): Name of the phase being reported.
+  """
+  loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+  from helpers import instrument
+
+  instrument.section(f"{label}:", f"{time.perf_counter() - STARTED:.3f} s")
+  instrument.note("heavy modules loaded:", ", ".join(loaded) if loaded else "none")
@@ -0,0 +1,268 @@
+import os
+from collections import namedtuple
+import numpy as np
+from helpers import instrument
+from helpers.integrator import (OBSERVER_STEP_MATMULS, STEP_MATMULS, loop_step_matrices, make_step, make_observer_step,
+                                step_matrices)
+
+Chunk = namedtuple('Chunk', ['T', 'X', 'U', 'X_est'])
+Chunk.__doc__ = """
+Fixed-size block of a simulated trajectory: times (k,), states (n x k), inputs (m x k) and
+estimates (n x k, or None without observer).
+"""
+
+def stream(A, B, x0, t0, tf, dt, u0=None, K=None, N=None, r=None, C=None, L=None, x_est0=None,
+           integrator='euler', chunk_size=10000, include_initial=True, checkpoint=None, resume=None,
+           gain_schedule=None, process_noise=0, measurement_noise=0, seed=None):
+  """
+  Simulates the mass-tank loop as a generator of fixed-size chunks, so arbitrarily long horizons run in
+  constant memory.
+
+  The control law follows the scripts: u = 0 without K (script 1), u = -Kx (script 2),
+  u = Nr - Kx (script 3), and u = Nr - K x_est with a Luenberger observer when L is given (script 4,
+  measuring y = Cx).
+
+  With 'zoh' and feedback, the closed loop is discretized exactly (`helpers.integrator.loop_step_matrices`):
+  only Nr and the noises are held over a step, so the result does not depend on dt at the sample times.
+
+  The chunk buffers are reused between iterations: copy them if they must outlive the iteration.
+
+  With a `checkpoint`, the chunk in progress is yielded early whenever a checkpoint is due, and once the
+  consumer asks for the next chunk (it has stored this one), the state reached so far is saved: step,
+  t, x, x_est, u and the number of samples produced. Passing that state back as `resume` continues the
+  run from there with exactly the same operations, so the remaining samples are bit-identical.
+
+  Args:
+    A, B (np.ndarray): Plant matrices.
+    x0 (np.ndarray): Initial state (n x 1).
+    t0, tf, dt (float): Initial time, final time and integration step.
+    u0 (np.ndarray): Input recorded with the initial sample (defaults to zero).
+    K, N (np.ndarray): State feedback and reference gains (optional).
+    r (np.ndarray): Reference (m x 1), required with N.
+    C, L (np.ndarray): Measured output matrix and observer gain (optional).
+    x_est0 (np.ndarray): Initial estimate, required with L.
+    integrator (str): 'euler' or 'zoh'.
+    chunk_size (int): Samples per chunk (the last chunk may be shorter).
+    include_initial (bool): Whether the first chunk starts with the initial sample.
+    checkpoint (helpers.checkpoint.Checkpointer): Saves the state periodically (optional).
+    resume (dict): State of a checkpoint to continue from (see `helpers.checkpoint.load_checkpoint`).
+    gain_schedule (iterable): Per-step observer gains Ld (e.g. `helpers.estimator.KalmanSchedule`), applied
+      as x_est <- Ad x_est + Bd u + Ld (y - C x_est) until exhausted (a discrete observer, with the plant
+      stepped under a held u); L is used from then on.
+    process_noise (float): Standard deviation of a Gaussian disturbance added to the plant input.
+    measurement_noise (float): Standard deviation of a Gaussian noise added to the measurement y.
+    seed (int): Seed of the noises.
+
+  Yields:
+    Chunk: Views on the chunk buffers.
+  """
+  n, m = B.shape
+  x = np.asarray(x0, dtype=float).reshape(n, 1)
+  u = np.zeros((m, 1)) if u0 is None else np.asarray(u0, dtype=float).reshape(m, 1)
+  K = None if K is None else np.atleast_2d(K)
+  Nr = np.zeros((m, 1)) if N is None else N@r
+  observe = L is not None
+  x_est = np.asarray(x_est0, dtype=float).reshape(n, 1) if observe else None
+
+  step = make_step(A, B, dt, integrator)
+  step_est = make_observer_step(A, B, C, L, dt, integrator) if observe else None
+  schedule = iter(gain_schedule) if observe and gain_schedule is not None else None
+  if schedule is not None:
+    Ad_est, Bd_est = step_matrices(A, B, dt, integrator)
+  rng = np.random.default_rng(seed) if process_noise or measurement_noise else None
+
+  exact = integrator == 'zoh' and K is not None
+  if exact:
+    # Exact closed loop: z <- M z + F [Nr; w; noise] (z = [x; x_est]), or x <- M x + F (Nr + w)
+    if observe:
+      M, F = loop_step_matrices(A, B, K, dt, integrator, C, L)
+      F_r, F_w, F_noise = F[:, :m], F[:, m:2*m], F[:, 2*m:]
+    else:
+      M, F_r = loop_step_matrices(A, B, K, dt, integrator)
+      F_w = F_r
+    offset = F_r@Nr
+
+  T_buf = np.empty(chunk_size)
+  X_buf = np.empty((n, chunk_size), order='F')
+  U_buf = np.empty((m, chunk_size), order='F')
+  X_est_buf = np.empty((n, chunk_size), order='F') if observe else None
+
+  instrument.count('allocated_bytes', sum(buffer.nbytes for buffer in (T_buf, X_buf, U_buf, X_est_buf)
+                                         if buffer is not None))
+  # Plant step, K@x and, with the observer, its step and y = Cx
+  step_matmuls = STEP_MATMULS[integrator] + (K is not None)
+  if observe:
+    step_matmuls += OBSERVER_STEP_MATMULS[integrator] + 1
+  if exact:
+    # Closed-loop step and K@x for the recorded u
+    step_matmuls = 2
+
+  def chunk(k):
+    return Chunk(T_buf[:k], X_buf[:, :k], U_buf[:, :k], X_est_buf[:, :k] if observe else None)
+
+  k = 0
+  t = t0
+  first = 0
+  if resume is not None:
+    # Continue from a checkpoint: the sample it was taken at is already stored
+    first, t = int(resume['step']), resume['t']
+    x, u = resume['x'].reshape(n, 1), resume['u'].reshape(m, 1)
+    if observe:
+      x_est = resume['x_est'].reshape(n, 1)
+  elif include_initial:
+    T_buf[0], X_buf[:, 0], U_buf[:, 0] = t0, x[:, 0], u[:, 0]
+    if observe:
+      X_est_buf[:, 0] = x_est[:, 0]
+    k = 1
+  # Samples handed to the consumer so far, over the whole run
+  produced = 0 if resume is None else int(resume['samples'])
+  if checkpoint is not None:
+    checkpoint.start(first)
+
+  num_steps = int((tf-t0)/dt)
+  counted = first
+  for i in range(first, num_steps):
+    if checkpoint is not None and checkpoint.due(i):
+      # Samples up to step i are out once the consumer resumes us, so the state before step i is saved
+      if k:
+        instrument.count('steps', i - counted)
+        instrument.count('matmuls', (i - counted) * step_matmuls)
+        counted = i
+        yield chunk(k)
+        produced += k
+        k = 0
+      checkpoint.save(i, t=t, x=x, u=u, samples=produced,
+                      **({'x_est': x_est} if observe else {}))
+
+    if K is not None:
+      u = Nr - K@(x_est if observe else x)
+
+    if observe:
+      if rng is not None:
+        noise = rng.normal(0, measurement_noise, (C.shape[0], 1))
+      Ld = None if schedule is None else next(schedule, None)
+      if Ld is None:
+        schedule = None
+    if rng is not None:
+      disturbance = rng.normal(0, process_noise, u.shape)
+
+    if exact and schedule is None:
+      if observe:
+        z = M@np.vstack((x, x_est)) + offset
+        if rng is not None:
+          z += F_w@disturbance + F_noise@noise
+        x, x_est = z[:n], z[n:]
+      else:
+        x = M@x + offset
+        if rng is not None:
+          x += F_w@disturbance
+      t = t + dt
+    else:
+      if observe:
+        y = C@x
+        if rng is not None:
+          y = y + noise
+        if Ld is None:
+          x_est = step_est(x_est, u, y)
+        else:
+          x_est = Ad_est@x_est + Bd_est@u + Ld@(y - C@x_est)
+      t, x = t + dt, step(x, u if rng is None else u + disturbance)
+
+    if k == chunk_size:
+      # Steps 0..i-1 are in the buffers so far
+      instrument.count('steps', i - counted)
+      instrument.count('matmuls', (i - counted) * step_matmuls)
+      counted = i
+      yield chunk(k)
+      produced += k
+      k = 0
+
+    T_buf[k], X_buf[:, k], U_buf[:, k] = t, x[:, 0], u[:, 0]
+    if observe:
+      X_est_buf[:, k] = x_est[:, 0]
+    k += 1
+
+  if k:
+    instrument.count('steps', num_steps - counted)
+    instrument.count('matmuls', (num_steps - counted) * step_matmuls)
+    yield chunk(k)
+
+def mass_tank_outputs(C, pressure_scale):
+  """
+  Builds the per-chunk computation of the derived outputs plotted by the scripts.
+
+  Args:
+    C (np.ndarray): Output matrix (rows: mass position, mass speed, tank pressure).
+    pressure_scale (float): gravity * fluid_density, converting pressure to tank height.
+
+  Returns:
+    callable: outputs(chunk) returning a dict of (k,) arrays.
+  """
+  def outputs(chunk):
+    output = C@chunk.X
+    derived = {
+      'mass_position': output[0],
+      'mass_speed': output[1],
+      'tank_height': output[2] / pressure_scale,
+    }
+    if chunk.X_est is not None:
+      est_output = C@chunk.X_est
+      derived['mass_position_est'] = est_output[0]
+      derived['mass_speed_est'] = est_output[1]
+      derived['tank_height_est'] = est_output[2] / pressure_scale
+    return derived
+  return outputs
+
+def write_npy(chunks, directory, num_samples, outputs=None, start=0) -> dict:
+  """
+  Writes a chunk stream to memory-mapped .npy files (T.npy, X.npy, U.npy, X_est.npy and one file per
+  derived output). Arrays keep the (n x samples) layout of the scripts, stored column-major so every
+  chunk is a contiguous write.
+
+  Args:
+    chunks (iterable): Chunks from `stream`.
+    directory (str): Output directory.
+    num_samples (int): Total number of samples the stream will produce.
+    outputs (callable): Optional outputs(chunk) -> dict of derived (k,) arrays, computed per chunk.
+    start (int): Sample at which the chunks start. When resuming a checkpointed stream, the files
+      already written are reopened and only the samples from `start` on are written.
+
+  Returns:
+    dict: Read-only memory maps of every written array.
+  """
+  os.makedirs(directory, exist_ok=True)
+  files = {}
+
+  def create_file(name, rows):
+    # Write the .npy header and size the file, then keep only its layout: chunks are written through
+    # short-lived maps of their own window, so the mapped (resident) size never grows with the horizon
+    path = os.path.join(directory, f'{name}.npy')
+    shape = (num_samples,) if rows is None else (rows, num_samples)
+    if start:
+      memmap = np.lib.format.open_memmap(path, mode='r+')
+      if memmap.shape != shape or not memmap.flags.f_contiguous:
+        raise ValueError(f"{path} does not hold the {shape} trajectory being resumed")
+    else:
+      memmap = np.lib.format.open_memmap(path, mode='w+', dtype=float, shape=shape, fortran_order=True)
+    files[name] = (path, memmap.offset, 1 if rows is None else rows)
+    del memmap
+
+  for chunk in chunks:
+    arrays = {name: value for name, value in chunk._asdict().items() if value is not None}
+    if outputs is not None:
+      arrays.update(outputs(chunk))
+
+    if not files:
+      for name, value in arrays.items():
+        create_file(name, None if value.ndim == 1 else value.shape[0])
+
+    k = chunk.T.shape[0]
+    for name, value in arrays.items():
+      path, offset, rows = files[name]
+      window = np.memmap(path, dtype=float, mode='r+', offset=offset + start*rows*8, shape=(rows, k), order='F')
+      window[:] = np.reshape(value, (rows, k))
+      window.flush()
+      del window
+    start += k
+
+  return {name: np.load(path, mmap_mode='r')[..., :start] for name, (path, _, _) in files.items()}
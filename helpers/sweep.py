@@ -0,0 +1,177 @@
+import itertools
+import numpy as np
+from helpers import instrument
+from helpers.control import ackermann
+from helpers.integrator import loop_step_matrices
+
+GRAVITY = 9.81
+PIPE_SECTION_AREA = 0.00125664
+
+# Physical constants that can be swept, in the order used by `build_system`
+PARAMETERS = ('mass', 'spring_constant', 'damping_constant', 'fluid_density', 'tank_area', 'pipe_length')
+
+def make_grid(**axes) -> dict:
+  """
+  Builds the full cartesian product of the given parameter axes.
+
+  Args:
+    **axes (np.ndarray): Values of each swept parameter, e.g. mass=np.linspace(2, 10, 10).
+
+  Returns:
+    dict: Flattened (P,) arrays, one per parameter, with P the product of the axes lengths.
+  """
+  names = list(axes)
+  points = np.array(list(itertools.product(*(np.asarray(axes[name], dtype=float) for name in names))))
+  return {name: points[:, i] for i, name in enumerate(names)}
+
+def build_system(mass, spring_constant, damping_constant, fluid_density, tank_area, pipe_length,
+                 pipe_section_area=PIPE_SECTION_AREA, gravity=GRAVITY) -> tuple:
+  """
+  Builds the state-space matrices of the mass-tank system for many parameter sets at once.
+
+  The same equations as the simulation scripts are used (Ax'' + Bx' + Cx - P1 = 0, P1' = Dx' + EJ),
+  with every parameter broadcast against the others.
+
+  Args:
+    mass, spring_constant, damping_constant, fluid_density, tank_area, pipe_length (np.ndarray):
+      Physical constants, scalars or (P,) arrays.
+    pipe_section_area (float): Pipe (and piston) section area (m^2).
+    gravity (float): Gravity acceleration (m/s^2).
+
+  Returns:
+    tuple: Stacked (A, B) matrices with shapes (P, 3, 3) and (P, 3, 1).
+  """
+  mass, spring_constant, damping_constant, fluid_density, tank_area, pipe_length = np.broadcast_arrays(
+    *(np.atleast_1d(np.asarray(p, dtype=float))
+      for p in (mass, spring_constant, damping_constant, fluid_density, tank_area, pipe_length)))
+  piston_area = pipe_section_area
+
+  _A = (mass / piston_area) + (fluid_density*pipe_length*piston_area / pipe_section_area)
+  _B = damping_constant / piston_area
+  _C = spring_constant / piston_area
+  _D = piston_area*fluid_density*gravity / tank_area
+  _E = fluid_density*gravity / tank_area
+
+  P = mass.shape[0]
+  A = np.zeros((P, 3, 3))
+  A[:, 0, 1] = 1
+  A[:, 1, 0] = -_C/_A
+  A[:, 1, 1] = -_B/_A
+  A[:, 1, 2] = 1/_A
+  A[:, 2, 1] = _D
+
+  B = np.zeros((P, 3, 1))
+  B[:, 2, 0] = _E
+  return A, B
+
+def _triple_pole(A, poles_gain) -> np.ndarray:
+  # Same placement rule as calculate_K/calculate_L: a triple pole at -|mean(Re(eig(A)))| * poles_gain.
+  # The mean of the eigenvalues is trace(A)/n, and their imaginary parts cancel out for real A.
+  n = A.shape[-1]
+  new_x = -np.abs(np.trace(A, axis1=-2, axis2=-1) / n) * poles_gain
+  return np.repeat(new_x[:, None], n, axis=1)
+
+def design_gains(A, B, C, D, controller_poles_gain=10, observer_poles_gain=20) -> tuple:
+  """
+  Designs K, N and L for every parameter set, with the same pole rules as scripts 3 and 4.
+
+  Args:
+    A (np.ndarray): Stacked state matrices (P x n x n).
+    B (np.ndarray): Stacked input matrices (P x n x 1).
+    C (np.ndarray): Measured output matrix (1 x n).
+    D (np.ndarray): Feedthrough matrix (1 x 1).
+    controller_poles_gain (float): `poles_gain` used for K.
+    observer_poles_gain (float): `poles_gain` used for L.
+
+  Returns:
+    tuple: Stacked (K, N, L) with shapes (P, 1, n), (P, 1, 1) and (P, n, 1).
+  """
+  P, n = A.shape[:2]
+  K = ackermann(A, B, _triple_pole(A, controller_poles_gain))
+
+  # Observer by duality: L^T places the poles of (A^T - C^T L^T)
+  At = np.swapaxes(A, -1, -2)
+  Ct = np.broadcast_to(C.T, (P,) + C.T.shape)
+  L = np.swapaxes(ackermann(At, Ct, _triple_pole(A, observer_poles_gain)), -1, -2)
+
+  # Reference gain, as in calculate_N: [Nx; Nu] = inv([[A, B], [C, D]]) @ [0; I]
+  extended_matrix = np.concatenate((
+    np.concatenate((A, B), axis=-1),
+    np.broadcast_to(np.concatenate((C, D), axis=-1), (P, 1, n + 1))), axis=-2)
+  extended_state_matrix = np.zeros((P, n + 1, 1))
+  extended_state_matrix[:, n, 0] = 1
+  Nx_Nu = np.linalg.solve(extended_matrix, extended_state_matrix)
+  N = Nx_Nu[:, n:, :] + K @ Nx_Nu[:, :n, :]
+
+  return K, N, L
+
+def simulate_sweep(A, B, C, K, N, L, x0, x_est0, r, tf, dt, integrator='zoh', settling_band=.02) -> dict:
+  """
+  Simulates the closed loop with observer (as in script 4) for all parameter sets together.
+
+  Every step advances the P plants and P observers with one batched product on stacked matrices.
+  Only running summary metrics are kept, so memory does not grow with the horizon.
+
+  Args:
+    A, B (np.ndarray): Stacked plant matrices (P x n x n), (P x n x 1).
+    C (np.ndarray): Measured output matrix (1 x n).
+    K, N, L (np.ndarray): Stacked gains from `design_gains`.
+    x0, x_est0 (np.ndarray): Initial state and estimate, (n x 1) or stacked (P x n x 1).
+    r (float): Mass position reference.
+    tf (float): Simulation horizon (s).
+    dt (float): Integration step (s).
+    integrator (str): 'euler' or 'zoh' (exact closed-loop discretization).
+    settling_band (float): Settling band relative to the initial distance to the reference.
+
+  Returns:
+    dict: (P,) arrays of final_position, overshoot, settling_time, peak_flow, estimation_error_rms
+      and the boolean stable flag.
+  """
+  P, n = A.shape[:2]
+
+  # The loop is linear, so plant and observer are fused into one (2n x 2n) step per parameter set,
+  # z <- M z + F_r Nr with z = [x; x_est] and u = Nr - K x_est. With 'zoh' it is the exact
+  # discretization of the continuous closed loop, so the metrics do not depend on dt beyond the sampling.
+  M, F = loop_step_matrices(A, B, K, dt, integrator, C, L)
+  offset = (F[..., :1] @ N)[:, :, 0] * r
+  K_row, Nr = K[:, 0, :], N[:, 0, 0] * r
+
+  z = np.empty((P, 2*n))
+  z[:, :n] = np.broadcast_to(x0, (P, n, 1))[:, :, 0]
+  z[:, n:] = np.broadcast_to(x_est0, (P, n, 1))[:, :, 0]
+
+  distance = np.abs(r - z[:, 0])
+  direction = np.sign(r - z[:, 0])
+  band = settling_band * np.where(distance > 0, distance, 1)
+
+  overshoot = np.zeros(P)
+  settling_time = np.zeros(P)
+  peak_flow = np.zeros(P)
+  squared_error = np.zeros(P)
+
+  num_steps = int(tf/dt)
+  with np.errstate(over='ignore', invalid='ignore'):
+    for i in range(num_steps):
+      u = Nr - np.einsum('pj,pj->p', K_row, z[:, n:])
+      z = np.einsum('pij,pj->pi', M, z) + offset
+
+      position = z[:, 0]
+      np.maximum(overshoot, (position - r) * direction, out=overshoot)
+      np.maximum(peak_flow, np.abs(u), out=peak_flow)
+      squared_error += (position - z[:, n])**2
+      settling_time[np.abs(position - r) > band] = (i + 1) * dt
+
+  # One batched (2n x 2n) and one K product per parameter set and step
+  instrument.count('steps', num_steps * P)
+  instrument.count('matmuls', 2 * num_steps * P)
+
+  x = z[:, :n, None]
+  stable = np.all(np.isfinite(x[:, :, 0]), axis=1)
+  return {
+    'final_position': x[:, 0, 0],
+    'overshoot': overshoot / np.where(distance > 0, distance, 1),
+    'settling_time': np.where(stable, settling_time, np.inf),
+    'peak_flow': peak_flow,
+    'estimation_error_rms': np.sqrt(squared_error / max(num_steps, 1)),
+    'stable': stable,
+  }
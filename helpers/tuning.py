@@ -0,0 +1,158 @@
+import os
+import numpy as np
+from helpers import instrument
+from helpers.pool import count_work, process_pool
+from helpers.sweep import design_gains, make_grid, simulate_sweep
+
+# Scores of every candidate, all minimized
+OBJECTIVES = ('settling_time', 'overshoot', 'peak_flow', 'estimation_error_rms')
+
+def pareto_front(scores) -> np.ndarray:
+  """
+  Finds the non-dominated rows of a score table: no other row is at least as good on every column and
+  strictly better on one.
+
+  Args:
+    scores (np.ndarray): (P x objectives) scores, lower is better.
+
+  Returns:
+    np.ndarray: (P,) boolean mask of the Pareto front.
+  """
+  no_worse = np.all(scores[:, None, :] <= scores[None, :, :], axis=-1)
+  better = np.any(scores[:, None, :] < scores[None, :, :], axis=-1)
+  # dominated[i] when some row j dominates row i
+  dominated = np.any(no_worse & better, axis=0)
+  return ~dominated
+
+def pareto_ranks(scores) -> np.ndarray:
+  """
+  Non-dominated sorting: rank 0 is the Pareto front, rank 1 the front of what is left, and so on.
+
+  Args:
+    scores (np.ndarray): (P x objectives) scores, lower is better.
+
+  Returns:
+    np.ndarray: (P,) front index of every row.
+  """
+  ranks = np.full(scores.shape[0], -1)
+  remaining = np.arange(scores.shape[0])
+  rank = 0
+  while remaining.size:
+    front = pareto_front(scores[remaining])
+    ranks[remaining[front]] = rank
+    remaining = remaining[~front]
+    rank += 1
+  return ranks
+
+def _evaluate(task):
+  """
+  Designs and simulates one block of candidates on the stacked plant, returning their metrics.
+  """
+  A, B, C, D, controller_poles_gain, observer_poles_gain, x0, x_est0, r, tf, dt, integrator = task
+  P = controller_poles_gain.shape[0]
+  A, B = np.broadcast_to(A, (P,) + A.shape), np.broadcast_to(B, (P,) + B.shape)
+  with np.errstate(over='ignore', invalid='ignore'):
+    K, N, L = design_gains(A, B, C, D, controller_poles_gain, observer_poles_gain)
+    return simulate_sweep(A, B, C, K, N, L, x0, x_est0, r, tf, dt, integrator)
+
+def _prune(metrics, keep) -> np.ndarray:
+  # Unstable candidates go first; the others are ordered by Pareto front, then by their mean rank
+  # over the objectives, and the best `keep` fraction survives
+  scores = np.column_stack([metrics[name] for name in OBJECTIVES])
+  stable = metrics['stable'] & np.all(np.isfinite(scores), axis=1)
+  survivors = np.flatnonzero(stable)
+  if survivors.size == 0:
+    return survivors
+
+  scores = scores[survivors]
+  mean_rank = np.argsort(np.argsort(scores, axis=0), axis=0).mean(axis=1)
+  order = np.lexsort((mean_rank, pareto_ranks(scores)))
+  return np.sort(survivors[order[:max(int(np.ceil(keep * survivors.size)), 1)]])
+
+@instrument.timer('tuning/tune')
+def tune(A, B, C, D, controller_poles_gains, observer_poles_gains, x0, x_est0, r, tf, dt=.01, integrator='zoh',
+         rungs=4, keep=.5, workers=None, block_size=32) -> dict:
+  """
+  Searches the controller and observer pole gains (`poles_gain` of `calculate_K` and `calculate_L`) of
+  the closed loop with observer (script 4), scoring every candidate on `OBJECTIVES`.
+
+  Every pair of the two gain lists is a candidate. They are evaluated by successive halving: the first
+  rung simulates all of them over tf / 2^(rungs-1), keeps the best `keep` fraction (unstable ones are
+  dropped, the others are ordered by Pareto front), and every following rung doubles the horizon for
+  the survivors, up to tf. Candidates of a rung are split in blocks of `block_size`, designed and
+  simulated on stacked matrices, over a process pool.
+
+  Args:
+    A, B (np.ndarray): Plant matrices (n x n), (n x 1).
+    C (np.ndarray): Measured output matrix (1 x n).
+    D (np.ndarray): Feedthrough matrix (1 x 1).
+    controller_poles_gains, observer_poles_gains (np.ndarray): Gains to try for K and L.
+    x0, x_est0 (np.ndarray): Initial state and estimate (n x 1).
+    r (float): Mass position reference.
+    tf (float): Horizon of the last rung (s).
+    dt (float): Integration step (s).
+    integrator (str): 'euler' or 'zoh' (exact closed-loop discretization, see `simulate_sweep`).
+    rungs (int): Number of successive halving rungs, at least 1.
+    keep (float): Fraction of the candidates kept after each rung but the last, in (0, 1).
+    workers (int): Worker processes (defaults to the number of CPUs).
+    block_size (int): Candidates per task.
+
+  Returns:
+    dict: For the candidates of the last rung reached: 'controller_poles_gain', 'observer_poles_gain',
+    their metrics (see `helpers.sweep.simulate_sweep`) over 'horizon', and the boolean 'pareto' mask of
+    the front. 'completed' is False when no stable candidate survived an earlier rung: the search then
+    stopped there, over a horizon shorter than tf, and the front is empty. 'rungs' lists the (horizon,
+    number of candidates) of every rung run.
+  """
+  if rungs < 1:
+    raise ValueError(f"Expected at least one rung, got {rungs}")
+  if not 0 < keep < 1:
+    raise ValueError(f"keep must be a fraction between 0 and 1 (exclusive), got {keep}")
+
+  workers = workers or os.cpu_count()
+  grid = make_grid(controller_poles_gain=controller_poles_gains, observer_poles_gain=observer_poles_gains)
+  candidates = np.arange(grid['controller_poles_gain'].shape[0])
+  history = []
+
+  pool = process_pool(workers) if workers > 1 else None
+
+  try:
+    for rung in range(rungs):
+      horizon = tf / 2**(rungs - 1 - rung)
+      tasks = [(A, B, C, D, grid['controller_poles_gain'][block], grid['observer_poles_gain'][block],
+                x0, x_est0, r, horizon, dt, integrator)
+               for block in np.array_split(candidates, -(-candidates.size // block_size))]
+
+      with instrument.timer('tuning/rung'):
+        results = list(pool.map(_evaluate, tasks)) if pool else [_evaluate(task) for task in tasks]
+      metrics = {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+      history.append((horizon, candidates.size))
+
+      if pool:
+        count_work(int(horizon/dt) * candidates.size, 2 * int(horizon/dt) * candidates.size)
+
+      if rung < rungs - 1:
+        survivors = _prune(metrics, keep)
+        if survivors.size == 0:
+          break
+        candidates = candidates[survivors]
+  finally:
+    if pool:
+      pool.shutdown()
+
+  scores = np.column_stack([metrics[name] for name in OBJECTIVES])
+  stable = metrics['stable'] & np.all(np.isfinite(scores), axis=1)
+  completed = rung == rungs - 1
+  pareto = np.zeros(candidates.size, dtype=bool)
+  if completed:
+    pareto[stable] = pareto_front(scores[stable])
+
+  return {
+    'controller_poles_gain': grid['controller_poles_gain'][candidates],
+    'observer_poles_gain': grid['observer_poles_gain'][candidates],
+    **metrics,
+    'pareto': pareto,
+    'horizon': horizon,
+    'completed': completed,
+    'rungs': history,
+  }
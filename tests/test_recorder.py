@@ -0,0 +1,20 @@
+import numpy as np
+from helpers.recorder import Recorder
+
+def record(num_steps, every, read_at=()):
+  recorder = Recorder(0, num_steps, every=every, X=np.zeros(1))
+  for i in range(1, num_steps + 1):
+    recorder.record(i, X=np.array([i]))
+    if i in read_at:
+      assert recorder.T[-1] == i
+  return recorder
+
+def test_reads_include_the_last_step():
+  recorder = record(10, 3)
+  assert list(recorder.T) == [0, 3, 6, 9, 10]
+  assert list(recorder['X'][0]) == [0, 3, 6, 9, 10]
+
+def test_read_mid_run_leaves_no_off_grid_sample():
+  recorder = record(10, 3, read_at=(4, 5, 7))
+  assert list(recorder.T) == [0, 3, 6, 9, 10]
+  assert list(recorder['X'][0]) == [0, 3, 6, 9, 10]
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from helpers.plant import Plant
+from helpers.scenarios import simulate_scenarios
+
+@pytest.mark.parametrize('every', [1, 3, 7, 10])
+def test_decimated_run_keeps_the_final_state(every):
+  plant = Plant()
+  K, N = plant.K(poles_gain=10), plant.N(poles_gain=10, outputs=(0,))
+  X0 = np.array([[1., 2.], [0, 0], [0, 0]])
+  R = np.array([[3., 5.]])
+
+  full = simulate_scenarios(plant.A, plant.B, X0, 0, .5, .01, K=K, N=N, R=R)
+  decimated = simulate_scenarios(plant.A, plant.B, X0, 0, .5, .01, K=K, N=N, R=R, every=every)
+
+  assert decimated['T'][-1] == pytest.approx(.5)
+  assert np.array_equal(decimated['X'][:, :, -1], full['X'][:, :, -1])
+  assert np.array_equal(decimated['X'][:, :, -1][:, 0], decimated['final_position'])
+  assert np.array_equal(decimated['X'], full['X'][:, :, np.minimum(every * np.arange(decimated['T'].size), 50)])
+
+def test_zoh_does_not_depend_on_the_step():
+  plant = Plant()
+  K, N = plant.K(poles_gain=10), plant.N(poles_gain=10, outputs=(0,))
+  L, C = plant.L(poles_gain=20, outputs=(0,)), plant.C((0,))
+  X0, R = np.array([[2.], [-2], [0]]), np.array([[5.]])
+
+  final = [simulate_scenarios(plant.A, plant.B, X0, 0, 5, dt, K=K, N=N, R=R, C=C, L=L, X_est0=np.zeros((3, 1)),
+                              integrator='zoh')['X'][0, :, -1] for dt in (.05, .01)]
+  assert np.allclose(final[0], final[1], rtol=1e-8)
@@ -0,0 +1,64 @@
+import asyncio
+import numpy as np
+import pytest
+from helpers import service
+from helpers.service import Service
+
+# Short runs: the checks are about batching and isolation, not about the trajectories
+FAST = {'tf': .5, 'dt': .01, 'every': 5}
+
+def submit_together(requests, **options):
+  # Submits the requests at once, so they fall into one batch, and returns their results or exceptions
+  async def run():
+    server = Service(workers=1, batch_window=.05, **options)
+    try:
+      return await asyncio.gather(*(server.submit({**FAST, **request}) for request in requests), return_exceptions=True)
+    finally:
+      server.close()
+  return asyncio.run(run())
+
+@pytest.mark.parametrize('bad', [
+  {'references': 5},
+  {'references': ['abc']},
+  {'initial_positions': [[1, 2]]},
+  {'references': []},
+  {'references': [float('nan')]},
+  {'every': 10.0},
+  {'parameters': {'mass': 'heavy'}},
+  {'parameters': {'colour': 1}},
+  {'parameters': [1]},
+  {'dt': -1},
+])
+def test_bad_request_does_not_fail_its_batch(bad):
+  good, failed, other = submit_together([{'references': [3]}, bad, {'references': [4]}])
+
+  assert isinstance(failed, ValueError)
+  for result, reference in ((good, 3), (other, 4)):
+    header, arrays = result
+    assert header['status'] == 'ok'
+    assert header['batch_size'] == 2
+    assert header['scenarios']['r'] == [reference]
+    assert arrays['X'].shape == (1, 3, 11)
+
+def test_failed_simulation_is_retried_per_request(monkeypatch):
+  simulate = service._simulate
+
+  def failing(task):
+    # Fails every simulation holding the reference 13
+    if np.any(task['options']['R'] == 13):
+      raise FloatingPointError("diverged")
+    return simulate(task)
+
+  monkeypatch.setattr(service, '_simulate', failing)
+  good, failed, other = submit_together([{'references': [3]}, {'references': [13]}, {'references': [4, 5]}])
+
+  assert isinstance(failed, FloatingPointError)
+  assert good[0]['status'] == 'ok' and good[0]['batch_size'] == 1
+  assert other[0]['scenarios']['r'] == [4, 5]
+
+def test_batched_results_match_single_requests():
+  together = submit_together([{'references': [3], 'dtype': 'float64'}, {'references': [4, 5], 'dtype': 'float64'}])
+  alone = submit_together([{'references': [4, 5], 'dtype': 'float64'}])
+
+  assert together[1][0]['batch_size'] == 2
+  np.testing.assert_array_equal(together[1][1]['X'], alone[0][1]['X'])
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from scipy.integrate import solve_ivp
+from helpers.sweep import build_system, design_gains, make_grid, simulate_sweep
+
+C = np.array([[1, 0, 0]])
+D = np.array([[0]])
+x0 = np.array([[2.], [0], [0]])
+r, tf = 5, 15
+
+def reference_metrics(A, B, K, N, L, dt, settling_band=.02):
+  # Continuous closed loop with observer, integrated tightly and sampled on the sweep grid
+  n, Nr = A.shape[0], (N*r)[:, 0]
+
+  def closed_loop(t, z):
+    x, x_est = z[:n], z[n:]
+    u = Nr - K@x_est
+    return np.concatenate((A@x + B@u, A@x_est + B@u + L@(C@x - C@x_est)))
+
+  T = dt*np.arange(1, int(tf/dt) + 1)
+  Z = solve_ivp(closed_loop, (0, tf), np.concatenate((x0[:, 0], x0[:, 0])), t_eval=T, method='DOP853',
+                rtol=1e-10, atol=1e-12).y
+  distance = r - x0[0, 0]
+  outside = np.abs(Z[0] - r) > settling_band*distance
+  return {
+    'final_position': Z[0, -1],
+    'overshoot': max(np.max(Z[0] - r), 0) / distance,
+    'settling_time': T[outside][-1] if outside.any() else 0,
+  }
+
+@pytest.mark.parametrize('fluid_density', [1000, 13546])
+def test_zoh_sweep_matches_continuous_loop(fluid_density):
+  dt = .01
+  grid = make_grid(mass=[6], spring_constant=[500], damping_constant=[50], fluid_density=[fluid_density],
+                   tank_area=[.05], pipe_length=[5])
+  A, B = build_system(**grid)
+  K, N, L = design_gains(A, B, C, D)
+
+  metrics = simulate_sweep(A, B, C, K, N, L, x0, x0, r, tf, dt, 'zoh')
+  expected = reference_metrics(A[0], B[0], K[0], N[0], L[0], dt)
+
+  assert metrics['stable'][0]
+  assert metrics['final_position'][0] == pytest.approx(expected['final_position'], abs=1e-6)
+  assert metrics['overshoot'][0] == pytest.approx(expected['overshoot'], abs=1e-6)
+  assert abs(metrics['settling_time'][0] - expected['settling_time']) <= dt